@@ -0,0 +1,212 @@
+import os
+import re
+import tempfile
+from collections import namedtuple
+from local_postgres import to_postgres, local_loaders, json_files
+
+# An engine the pipeline steps can run on: how a statement of
+# sql_queries.py is rewritten for it, how a session is opened, what
+# replaces the S3 COPY steps, how many steps may run at once and how it
+# writes a query to a directory of Parquet files in place of UNLOAD (None
+# when it can't). Redshift runs the statements as written and COPYs from
+# S3; the local engines bulk load the files of a directory laid out like
+# the S3 sources (see data_generator.py).
+Backend = namedtuple("Backend", ["name", "render", "connect", "loaders", "maxConcurrency", "unload"],
+    defaults=(None,))
+
+BACKENDS = ["redshift", "postgres", "duckdb"]
+
+# The directory under data_dir each local load reads, by the COPY step it replaces
+LOCAL_SOURCES = {"copy_staging_events": "log_data", "copy_staging_songs": "song_data"}
+
+# PostgreSQL syntax DuckDB reads differently
+DUCKDB_ONLY = [
+    (re.compile(r"^\s*set\s+search_path\s+to\s+(\w+)\s*$", re.IGNORECASE), r"set search_path = '\1'"),
+    (re.compile(r"\('x' \|\| substring\(md5\((.*?)\), 1, 7\)\)::bit\(28\)::int", re.DOTALL),
+        r"('0x' || substring(md5(\1), 1, 7))::bigint")
+]
+
+# Statements DuckDB answers with a single "Count" row of the rows affected
+ROW_COUNT_STATEMENTS = ("insert", "delete", "update", "copy")
+
+# UNLOAD of a query to Parquet files of about max_file_bytes each
+DUCKDB_EXPORT = "copy ({select}) to '{path}' (format parquet, file_size_bytes {max_file_bytes})"
+
+COPY_FROM_STDIN = re.compile(r"\bfrom\s+stdin\s+with\s+csv\s*$", re.IGNORECASE)
+
+
+def to_duckdb(query):
+    '''
+    Rewrites a statement from sql_queries.py so it runs on DuckDB
+    '''
+    query = to_postgres(query)
+    for pattern, replacement in DUCKDB_ONLY:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+class RenderingCursor():
+    def __init__(self, cursor, render):
+        '''
+        Wraps a DB-API cursor so every statement run through it is first
+        rewritten for the engine. Other attributes are passed through.
+
+        Args:
+            cursor: the DB-API cursor to wrap
+            render: callable
+                render(query) returns the statement to execute
+        '''
+        self.cursor = cursor
+        self.render = render
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def execute(self, query, params=None):
+        if params is None:
+            return self.cursor.execute(self.render(query))
+        return self.cursor.execute(self.render(query), params)
+
+
+class DuckDBSession():
+    def __init__(self, database):
+        '''
+        One session on a DuckDB database with the parts of the psycopg2
+        connection and cursor interfaces the ETL uses: statements run in a
+        transaction that is opened by the first statement and ended by
+        commit() or rollback(), %s parameters and copy_expert(). Serves
+        as both the connection and the cursor of a pooled pair.
+
+        Args:
+            database: duckdb.DuckDBPyConnection
+                the database handle shared by all sessions
+        '''
+        self.connection = database.cursor()
+        self.inTransaction = False
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, query, params=None):
+        if not self.inTransaction:
+            self.connection.execute("begin transaction")
+            self.inTransaction = True
+        if params is None:
+            self.connection.execute(query)
+        else:
+            self.connection.execute(query.replace("%s", "?"), list(params))
+        self.description = self.connection.description
+        self.rowcount = -1
+        if query.split(None, 1)[0].lower() in ROW_COUNT_STATEMENTS:
+            self.rowcount = self.connection.fetchone()[0]
+
+    def fetchone(self):
+        return self.connection.fetchone()
+
+    def fetchall(self):
+        return self.connection.fetchall()
+
+    def copy_expert(self, query, buffer):
+        '''
+        Runs a psycopg2 style "copy <table> (<columns>) from stdin with csv"
+        by spooling the buffer to a temporary file DuckDB reads
+        '''
+        handle, path = tempfile.mkstemp(suffix=".csv")
+        try:
+            with os.fdopen(handle, "w") as f:
+                f.write(buffer.read())
+            self.execute(COPY_FROM_STDIN.sub("from '{}' (format csv, header false)".format(
+                path.replace("'", "''")), query))
+        finally:
+            os.remove(path)
+
+    def cursor(self):
+        return self
+
+    def commit(self):
+        if self.inTransaction:
+            self.inTransaction = False
+            self.connection.execute("commit")
+
+    def rollback(self):
+        if self.inTransaction:
+            self.inTransaction = False
+            self.connection.execute("rollback")
+
+    def close(self):
+        self.connection.close()
+
+
+def open_session(conn, cur, schema, render):
+    '''
+    Creates the schema if needed, puts it on the search_path of a new
+    session and wraps its cursor so statements are rendered for the engine
+    '''
+    cur = RenderingCursor(cur, render)
+    cur.execute("create schema if not exists " + schema)
+    cur.execute("set search_path to " + schema)
+    conn.commit()
+    return conn, cur
+
+
+def postgres_backend(dsn, schema, dataDir):
+    '''
+    Returns the PostgreSQL backend: sessions on the database of a libpq
+    dsn, COPY from S3 replaced by COPY ... FROM STDIN of the local files
+    '''
+    import psycopg2
+
+    def connect():
+        conn = psycopg2.connect(dsn)
+        return open_session(conn, conn.cursor(), schema, to_postgres)
+    return Backend("postgres", to_postgres, connect, local_loaders(dataDir), None)
+
+
+def duckdb_unload(select, path, maxFileMb):
+    '''
+    Returns the statement writing a query to Parquet files in a directory,
+    whose parent has to exist
+    '''
+    return DUCKDB_EXPORT.format(select=select, path=path.replace("'", "''"),
+        max_file_bytes=maxFileMb * 1024 * 1024)
+
+
+def duckdb_backend(path, schema, dataDir):
+    '''
+    Returns the DuckDB backend: sessions on a database file (":memory:"
+    keeps it in memory), COPY from S3 replaced by reads of the local files.
+    Concurrent DDL conflicts in DuckDB's catalog, so steps run one at a time.
+    '''
+    import duckdb
+    database = duckdb.connect(path)
+
+    def connect():
+        session = DuckDBSession(database)
+        return open_session(session, session, schema, to_duckdb)
+    return Backend("duckdb", to_duckdb, connect, local_loaders(dataDir), 1, duckdb_unload)
+
+
+def local_backend(config, name, schema):
+    '''
+    Creates a local backend from the LOCAL section of the config file:
+    data_dir, the directory of the source files, and postgres_dsn or
+    duckdb_path
+    '''
+    dataDir = config.get("LOCAL","data_dir")
+    if name == "postgres":
+        return postgres_backend(config.get("LOCAL","postgres_dsn"), schema, dataDir)
+    if name == "duckdb":
+        return duckdb_backend(config.get("LOCAL","duckdb_path", fallback=":memory:"), schema, dataDir)
+    raise ValueError("Unknown local backend: {}".format(name))
+
+
+def local_listing(directory):
+    '''
+    Lists the .json files under a directory like an S3 listing, so their
+    keys, sizes and modification times can be hashed for resuming runs
+    '''
+    objects = []
+    for path in json_files(directory):
+        stat = os.stat(path)
+        objects.append({"Key": os.path.relpath(path, directory).replace(os.sep, "/"),
+            "Size": stat.st_size, "LastModified": stat.st_mtime})
+    return objects
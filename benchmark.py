@@ -0,0 +1,240 @@
+import configparser
+import getopt
+import json
+import os
+import sys
+import tempfile
+import time
+from query_registry import QueryRegistry
+from data_generator import generate
+from backends import postgres_backend, duckdb_backend
+from db_pool import ConnectionPool
+from scheduler import run_steps, critical_path
+
+# Row counts and songplay match rate after a load
+result_counts = ("""
+    select
+        (select count(*) from staging_events) as staging_events,
+        (select count(*) from staging_songs) as staging_songs,
+        (select count(*) from songplay) as songplay,
+        (select count(*) from songplay where song_id is not null) as matched_songplays,
+        (select count(*) from users) as users,
+        (select count(*) from songs) as songs,
+        (select count(*) from artists) as artists,
+        (select count(*) from time) as time
+""")
+
+# The songplay join on the raw artist, title and duration columns, and on
+# the precomputed match key, for comparing match rate and join time
+join_comparison = [
+    ("raw_columns", """
+        select count(*), count(s.song_id)
+        from staging_events e left outer join staging_songs s on
+        (
+            s.artist_name = e.artist and
+            s.title       = e.song and
+            s.duration    = e.length
+        )
+    """),
+    ("match_key", """
+        select count(*), count(s.song_id)
+        from staging_events_keyed e left outer join staging_songs_keyed s on
+        s.match_key = e.match_key
+    """)
+]
+
+
+def benchmark_steps(queries, loaders):
+    # Stop before the staging tables are dropped so the results can be counted
+    return [step for step in queries.steps(replaced=loaders) if not step.name.endswith("_after_load")]
+
+
+def create_backend(name, target, schema, dataDir):
+    '''
+    Creates the local backend a benchmark runs on: target is the dsn of a
+    PostgreSQL database or the path of a DuckDB database file
+    '''
+    if name == "postgres":
+        return postgres_backend(target, schema, dataDir)
+    return duckdb_backend(target or ":memory:", schema, dataDir)
+
+
+def timed_runner(loaders, timings):
+    '''
+    Returns a run(step, pool) callable for scheduler.run_steps that executes
+    a step on a local backend, using the local loaders in place of the S3 COPYs,
+    and records its wall time, rows and bytes in timings
+    '''
+    def run(step, pool):
+        pair = pool.acquire()
+        conn, cur = pair
+        try:
+            started = time.perf_counter()
+            loaded = None
+            if step.name in loaders:
+                rows, loaded = loaders[step.name](cur)
+            else:
+                cur.execute(step.query)
+                rows = cur.rowcount if cur.rowcount >= 0 else None
+            conn.commit()
+            seconds = time.perf_counter() - started
+            timings[step.name] = {"seconds": round(seconds, 4), "rows": rows, "bytes": loaded}
+            if rows and seconds > 0:
+                timings[step.name]["rows_per_s"] = round(rows / seconds, 1)
+            if loaded and seconds > 0:
+                timings[step.name]["mb_per_s"] = round(loaded / 1e6 / seconds, 2)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.release(pair)
+    return run
+
+
+def compare_joins(cur):
+    '''
+    Runs both variants of the songplay join over the loaded staging tables
+
+    Returns:
+        dict of variant -> rows, matched rows, match rate and seconds
+    '''
+    results = {}
+    for variant, query in join_comparison:
+        started = time.perf_counter()
+        cur.execute(query)
+        rows, matched = cur.fetchone()
+        results[variant] = {"rows": rows, "matched": matched,
+            "match_rate": round(matched / float(rows), 4) if rows else 0.0,
+            "seconds": round(time.perf_counter() - started, 4)}
+    return results
+
+
+def run_scale_factor(backendName, target, scale, dataDir, concurrency, generator_options, config):
+    '''
+    Generates the workload of one scale factor, runs the pipeline steps on
+    a local backend and returns the per-step timings and result counts.
+    The steps are rendered with the ETL settings of config, in a schema of
+    their own.
+    '''
+    print("Scale factor {}: generating data".format(scale))
+    generated = generate(dataDir, scale=scale, **generator_options)
+
+    schema = "benchmark_sf{}".format(str(scale).replace(".", "_"))
+    timings = {}
+    backend = create_backend(backendName, target, schema, dataDir)
+    steps = benchmark_steps(QueryRegistry(config, "benchmark", schema), backend.loaders)
+    concurrency = min(concurrency, backend.maxConcurrency or concurrency)
+    pool = ConnectionPool(backend.connect, concurrency)
+    try:
+        print("Scale factor {}: running the pipeline".format(scale))
+        started = time.perf_counter()
+        run_steps(steps, pool, concurrency,
+            run=timed_runner(backend.loaders, timings))
+        total = time.perf_counter() - started
+
+        conn, cur = pool.acquire()
+        cur.execute(result_counts)
+        counts = dict(zip([c[0] for c in cur.description], cur.fetchone()))
+        joins = compare_joins(cur)
+        conn.commit()
+        pool.release((conn, cur))
+    finally:
+        pool.closeAll()
+
+    path_seconds, path = critical_path(steps,
+        dict((name, t["seconds"]) for name, t in timings.items()))
+    return {
+        "backend": backend.name,
+        "scale": scale,
+        "concurrency": concurrency,
+        "generated": generated,
+        "seconds": round(total, 4),
+        "critical_path_seconds": round(path_seconds, 4),
+        "critical_path": path,
+        "steps": timings,
+        "counts": counts,
+        "join_comparison": joins,
+        "match_rate": round(counts["matched_songplays"] / float(counts["songplay"]), 4)
+            if counts["songplay"] else 0.0,
+        "intended_match_rate": round(generated["matching_events"] / float(generated["events"]), 4)
+            if generated["events"] else 0.0
+    }
+
+
+def print_results(result):
+    print("\n{} scale factor {}: {} s total, critical path {} s, songplay match rate {} (generated {})".format(
+        result["backend"], result["scale"], result["seconds"], result["critical_path_seconds"],
+        result["match_rate"], result["intended_match_rate"]))
+    print("{:<28} {:>10} {:>12} {:>12} {:>10}".format("step", "seconds", "rows", "rows/s", "MB/s"))
+    for name, t in sorted(result["steps"].items(), key=lambda i: -i[1]["seconds"]):
+        print("{:<28} {:>10} {:>12} {:>12} {:>10}".format(name, t["seconds"],
+            t["rows"] if t["rows"] is not None else "", t.get("rows_per_s", ""), t.get("mb_per_s", "")))
+    print("\n{:<28} {:>10} {:>12} {:>12}".format("songplay join", "seconds", "matched", "match rate"))
+    for variant, j in result["join_comparison"].items():
+        print("{:<28} {:>10} {:>12} {:>12}".format(variant, j["seconds"], j["matched"], j["match_rate"]))
+
+
+def usage(program_name):
+    print(('{} {} {} {} {} {} {}').format(program_name, '[-b postgres|duckdb]',
+        '[-d <postgres dsn | duckdb file>]', '[-s <scale>,<scale>...]',
+        '[-p <concurrency>]', '[-w <work dir>]', '[-o <results.json>]'))
+    print("runs the ETL steps against a local PostgreSQL or DuckDB database for each scale factor")
+    print("PostgreSQL needs a dsn; DuckDB runs in memory unless given a database file")
+
+
+def main(argv):
+    backendName = "postgres"
+    target = None
+    scales = [1]
+    concurrency = 4
+    workDir = None
+    output = None
+
+    try:
+        program_name = argv[0]
+        opts, _ = getopt.getopt(argv[1:], "b:d:s:p:w:o:")
+        for k, v in opts:
+            if k == '-b':
+                if v not in ("postgres", "duckdb"):
+                    raise ValueError(v)
+                backendName = v
+            if k == '-d':
+                target = v
+            if k == '-s':
+                scales = [float(s) for s in v.split(",")]
+            if k == '-p':
+                concurrency = int(v)
+            if k == '-w':
+                workDir = v
+            if k == '-o':
+                output = v
+        if backendName == "postgres" and target is None:
+            raise ValueError("a PostgreSQL dsn is required")
+    except (getopt.GetoptError, ValueError) as e:
+        print(e)
+        usage(program_name)
+        return
+
+    # only the ETL section is used, and it is optional
+    config = configparser.ConfigParser()
+    config.read("dwh.cfg")
+
+    workDir = workDir or tempfile.mkdtemp(prefix="etl-benchmark-")
+    results = []
+    for scale in scales:
+        dataDir = os.path.join(workDir, "sf{}".format(scale))
+        try:
+            result = run_scale_factor(backendName, target, scale, dataDir, concurrency, {}, config)
+        except Exception as e:
+            print(e)
+            return
+        print_results(result)
+        results.append(result)
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,100 @@
+from collections import namedtuple
+from s3_manifest import list_objects
+
+# Provisioned node types: slices per node, storage per node (GB; managed
+# storage for RA3), allowed node counts (a minimum of 1 for the types that
+# also run as a single node) and the approximate on-demand price per
+# node-hour in us-east-1
+NodeType = namedtuple("NodeType", ["name", "slices", "storageGB", "minNodes", "maxNodes", "hourlyPrice"])
+
+NODE_TYPES = [
+    NodeType("dc2.large", 2, 160, 1, 32, 0.25),
+    NodeType("ra3.xlplus", 2, 32000, 1, 16, 1.086),
+    NodeType("ra3.4xlarge", 4, 128000, 2, 32, 3.26),
+    NodeType("dc2.8xlarge", 16, 2560, 2, 128, 4.80),
+    NodeType("ra3.16xlarge", 16, 128000, 2, 128, 13.04)
+]
+
+# COPY throughput of one slice reading JSON from S3, and the fixed cost of
+# each file it opens; override in the SIZING section of the config file
+MB_PER_SLICE_S = 4.0
+FILES_PER_SLICE_S = 10.0
+
+# Disk the data takes on the cluster per byte of source data: staging,
+# keyed staging and final tables (and shadows when publishing) coexist
+STORAGE_FACTOR = 1.5
+
+
+def source_volume(s3Client, urls):
+    '''
+    Totals the objects and bytes under S3 prefixes
+
+    Args:
+        s3Client: boto3 S3 client
+        urls: list of s3://bucket/prefix
+    Returns:
+        dict with objects and bytes, in total and per url under "sources"
+    '''
+    volume = {"objects": 0, "bytes": 0, "sources": {}}
+    for url in urls:
+        objects = list_objects(s3Client, url)
+        size = sum(o["Size"] for o in objects)
+        volume["sources"][url] = {"objects": len(objects), "bytes": size}
+        volume["objects"] += len(objects)
+        volume["bytes"] += size
+    return volume
+
+
+def load_seconds(volume, nodeType, nodes, mbPerSlice=MB_PER_SLICE_S, filesPerSlice=FILES_PER_SLICE_S):
+    '''
+    Estimates how long the COPYs of a volume take on a cluster, assuming
+    the files spread evenly over its slices
+    '''
+    slices = nodeType.slices * nodes
+    return volume["bytes"] / 1e6 / (slices * mbPerSlice) + volume["objects"] / (slices * filesPerSlice)
+
+
+def recommend_size(volume, budgetSeconds, mbPerSlice=MB_PER_SLICE_S, filesPerSlice=FILES_PER_SLICE_S,
+        storageFactor=STORAGE_FACTOR):
+    '''
+    Recommends a node type and count for loading a volume within a time
+    budget: for every node type the fewest nodes that hold the data and
+    meet the budget, then the type that makes the load cheapest. When no
+    cluster meets the budget, the fastest one is returned.
+
+    Returns:
+        dict with node_type, nodes, load_seconds, hourly_price, load_cost
+        and meets_budget
+    '''
+    neededGB = volume["bytes"] / 1e9 * storageFactor
+    candidates = []
+    for nodeType in NODE_TYPES:
+        for nodes in range(nodeType.minNodes, nodeType.maxNodes + 1):
+            if nodeType.storageGB * nodes < neededGB:
+                continue
+            seconds = load_seconds(volume, nodeType, nodes, mbPerSlice, filesPerSlice)
+            candidates.append({"node_type": nodeType.name, "nodes": nodes,
+                "load_seconds": round(seconds, 1),
+                "hourly_price": round(nodeType.hourlyPrice * nodes, 2),
+                "load_cost": round(nodeType.hourlyPrice * nodes * seconds / 3600.0, 2),
+                "meets_budget": seconds <= budgetSeconds})
+            if seconds <= budgetSeconds:
+                break
+    if not candidates:
+        raise ValueError("{:.0f} GB does not fit on any cluster".format(neededGB))
+
+    meeting = [c for c in candidates if c["meets_budget"]]
+    if meeting:
+        return min(meeting, key=lambda c: (c["load_cost"], c["hourly_price"]))
+    return min(candidates, key=lambda c: (c["load_seconds"], c["hourly_price"]))
+
+
+def sizing_options(config):
+    '''
+    Reads the throughput model from the SIZING section of the config file
+    '''
+    return {
+        "mbPerSlice": config.getfloat("SIZING","mb_per_slice_s", fallback=MB_PER_SLICE_S),
+        "filesPerSlice": config.getfloat("SIZING","files_per_slice_s", fallback=FILES_PER_SLICE_S),
+        "storageFactor": config.getfloat("SIZING","storage_factor", fallback=STORAGE_FACTOR)
+    }
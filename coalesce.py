@@ -0,0 +1,254 @@
+import gzip
+import heapq
+import math
+import tempfile
+from s3_manifest import split_s3_url, write_manifest
+
+# COPY options matching each supported chunk compression
+COMPRESSION_OPTIONS = {
+    "gzip": "gzip",
+    "zstd": "zstd"
+}
+
+FILE_EXTENSIONS = {
+    "gzip": ".gz",
+    "zstd": ".zst"
+}
+
+
+def open_compressor(fileobj, compression):
+    '''
+    Wraps a binary file object in a streaming compressor
+
+    Args:
+        fileobj: binary file object the compressed bytes are written to
+        compression: str
+            "gzip" or "zstd". zstd needs the zstandard package
+    Returns:
+        a writable file object; closing it flushes the compressed stream
+        but leaves fileobj open
+    '''
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="wb")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+    raise ValueError("Unsupported compression: {}".format(compression))
+
+
+def split_objects(objects, targetChunkBytes):
+    '''
+    Splits the objects larger than targetChunkBytes into pieces of about
+    that size, so a single large file is loaded by several slices. A piece
+    is the object's listing with a "Range" of (start, end) bytes and holds
+    the lines that start in that range, see piece_lines; only
+    newline-delimited files can be split this way.
+
+    Returns:
+        list of objects and pieces, in key order
+    '''
+    pieces = []
+    for obj in objects:
+        count = int(math.ceil(obj["Size"] / float(targetChunkBytes)))
+        if count <= 1:
+            pieces.append(obj)
+            continue
+        bounds = [obj["Size"] * i // count for i in range(count + 1)]
+        for start, end in zip(bounds, bounds[1:]):
+            pieces.append(dict(obj, Size=end - start, Range=(start, end)))
+    return pieces
+
+
+def piece_lines(s3, piece):
+    '''
+    Yields the lines, newline included, that start within the byte range
+    of a piece. The object is read from the byte before the range, so a
+    line the previous piece started is recognised and skipped.
+    '''
+    start, end = piece["Range"]
+    first = max(start - 1, 0)
+    body = s3.get_object(Bucket=piece["Bucket"], Key=piece["Key"],
+        Range="bytes={}-".format(first))["Body"]
+    try:
+        offset = first
+        skip = start > 0
+        pending = b""
+        for block in iter(lambda: body.read(1024 * 1024), b""):
+            lines = (pending + block).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                lineStart = offset
+                offset += len(line) + 1
+                if skip:
+                    skip = False
+                elif lineStart >= end:
+                    return
+                else:
+                    yield line + b"\n"
+        if pending and not skip and offset < end:
+            yield pending + b"\n"
+    finally:
+        body.close()
+
+
+def chunk_count(totalBytes, fileCount, slices, targetChunkBytes):
+    '''
+    Picks a number of chunks that is a multiple of the slice count and keeps
+    each chunk near targetChunkBytes of uncompressed input, without making
+    more chunks than there are input files (or pieces of split files). With
+    fewer files than slices every file gets a chunk of its own, so as many
+    slices as there are files load in parallel.
+    '''
+    if fileCount < slices:
+        return max(fileCount, 1)
+    multiple = max(1, int(math.ceil(totalBytes / float(slices * targetChunkBytes))))
+    return slices * min(multiple, fileCount // slices)
+
+
+def assign_chunks(objects, chunks):
+    '''
+    Spreads objects over chunks so that their sizes come out as even as
+    possible: largest objects first, each into the currently smallest chunk.
+    Objects, and the pieces of a split object, keep their order inside a
+    chunk.
+
+    Returns:
+        list of lists of objects, one list per non-empty chunk
+    '''
+    heap = [(0, i) for i in range(chunks)]
+    assigned = [[] for _ in range(chunks)]
+    for obj in sorted(objects, key=lambda o: o["Size"], reverse=True):
+        size, i = heapq.heappop(heap)
+        assigned[i].append(obj)
+        heapq.heappush(heap, (size + obj["Size"], i))
+    return [sorted(a, key=lambda o: (o["Key"], o.get("Range", (0, 0)))) for a in assigned if a]
+
+
+def slice_balance(sizes, slices):
+    '''
+    Measures how a set of COPY input files spreads over the cluster slices,
+    with files handed out to slices in turn as Redshift does
+
+    Args:
+        sizes: list of int
+            the size of each input file in bytes
+        slices: int
+            number of slices in the cluster
+    Returns:
+        dict with the file count, total bytes, the most and fewest files on
+        a slice and the ratio of the busiest slice's bytes to the mean
+    '''
+    files = [0] * slices
+    bytesPerSlice = [0] * slices
+    for i, size in enumerate(sizes):
+        files[i % slices] += 1
+        bytesPerSlice[i % slices] += size
+    mean = sum(bytesPerSlice) / float(slices)
+    return {
+        "files": len(sizes),
+        "bytes": sum(sizes),
+        "max_files_per_slice": max(files),
+        "min_files_per_slice": min(files),
+        "max_slice_bytes": max(bytesPerSlice),
+        "skew": round(max(bytesPerSlice) / mean, 3) if mean else 0.0
+    }
+
+
+def write_chunk(s3, objects, chunkUrl, compression):
+    '''
+    Concatenates objects, and pieces of split objects, into one compressed,
+    newline-delimited chunk and uploads it. The chunk is spooled to disk
+    once it grows past 64MB.
+
+    Returns:
+        size of the compressed chunk in bytes
+    '''
+    bucket, key = split_s3_url(chunkUrl)
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+        writer = open_compressor(spool, compression)
+        for obj in objects:
+            if "Range" in obj:
+                for line in piece_lines(s3, obj):
+                    writer.write(line)
+                continue
+            body = s3.get_object(Bucket=obj["Bucket"], Key=obj["Key"])["Body"]
+            last = b""
+            for block in iter(lambda: body.read(1024 * 1024), b""):
+                writer.write(block)
+                last = block
+            body.close()
+            if last and not last.endswith(b"\n"):
+                writer.write(b"\n")
+        writer.close()
+
+        size = spool.tell()
+        spool.seek(0)
+        s3.put_object(Bucket=bucket, Key=key, Body=spool)
+    return size
+
+
+def coalesce_objects(s3, objects, destUrl, slices, compression="gzip",
+        targetChunkBytes=128 * 1024 * 1024, splitLines=False):
+    '''
+    Coalesces many small JSON objects into compressed chunks, sized so the
+    chunk count is a multiple of the slice count, and writes a COPY manifest
+    listing them. Objects larger than a chunk are split when they hold one
+    JSON record per line.
+
+    Args:
+        s3: boto3 S3 client or s3_manifest.DirectoryS3Client
+        objects: list of dicts as returned by s3_manifest.list_objects
+        destUrl: str
+            s3://bucket/prefix the chunks and manifest are written under
+        slices: int
+            number of slices in the cluster
+        compression: str
+            "gzip" or "zstd"
+        targetChunkBytes: int
+            uncompressed input per chunk to aim for
+        splitLines: boolean
+            the objects are newline-delimited and may be split
+    Returns:
+        (manifestUrl, report): the manifest location and a dict with the
+        slice balance of the input ("before") and of the chunks ("after"),
+        and the objects or pieces coalesced into each chunk url ("chunks")
+    '''
+    if compression not in COMPRESSION_OPTIONS:
+        raise ValueError("Unsupported compression: {}".format(compression))
+
+    destUrl = destUrl.rstrip("/")
+    pieces = split_objects(objects, targetChunkBytes) if splitLines else objects
+    chunks = assign_chunks(pieces, chunk_count(
+        sum(o["Size"] for o in objects), len(pieces), slices, targetChunkBytes))
+
+    split_s3_url(destUrl)
+    entries = []
+    for i, chunk in enumerate(chunks):
+        chunkUrl = "{}/part-{:05d}.json{}".format(destUrl, i, FILE_EXTENSIONS[compression])
+        size = write_chunk(s3, chunk, chunkUrl, compression)
+        entries.append({
+            "url": chunkUrl,
+            "mandatory": True,
+            "meta": {"content_length": size}
+        })
+
+    manifestUrl = write_manifest(s3, destUrl + "/chunks.manifest", {"entries": entries})
+    report = {
+        "before": slice_balance([o["Size"] for o in objects], slices),
+        "after": slice_balance([e["meta"]["content_length"] for e in entries], slices),
+        "chunks": dict((e["url"], chunk) for e, chunk in zip(entries, chunks))
+    }
+    return manifestUrl, report
+
+
+def print_report(source, report):
+    before, after = report["before"], report["after"]
+    print("{}: {} files / {} bytes -> {} chunks / {} bytes".format(source,
+        before["files"], before["bytes"], after["files"], after["bytes"]))
+    print("{}: files per slice {}-{} -> {}-{}, slice skew {} -> {}".format(source,
+        before["min_files_per_slice"], before["max_files_per_slice"],
+        after["min_files_per_slice"], after["max_files_per_slice"],
+        before["skew"], after["skew"]))
@@ -0,0 +1,250 @@
+import bisect
+import datetime
+import getopt
+import json
+import os
+import random
+import string
+import sys
+
+# Columns of staging_events in table order; the generated jsonpaths file
+# maps each of them to the event field of the same name
+EVENT_FIELDS = ["artist", "auth", "firstName", "gender", "itemInSession", "lastName",
+    "length", "level", "location", "method", "page", "registration", "sessionId",
+    "song", "status", "ts", "userAgent", "userId"]
+
+PAGES = ["Home", "Login", "Logout", "Settings", "Help", "About", "Upgrade", "Downgrade"]
+
+LOCATIONS = ["New Orleans-Metairie, LA", "San Francisco-Oakland-Hayward, CA",
+    "Atlanta-Sandy Springs-Roswell, GA", "Chicago-Naperville-Elgin, IL-IN-WI",
+    "Portland-South Portland, ME", "Lansing-East Lansing, MI", "Houston-The Woodlands-Sugar Land, TX"]
+
+USER_AGENTS = [
+    "\"Mozilla/5.0 (Windows NT 6.3; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36\"",
+    "\"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2 (KHTML, like Gecko) Version/7.0.6 Safari/537.78.2\"",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0"
+]
+
+
+def scale_parameters(scale):
+    '''
+    Returns the workload size of a scale factor. Scale 1 is roughly the
+    size of the course dataset's log month with a matching song catalogue.
+
+    Args:
+        scale: float
+    Returns:
+        dict with songs, artists, users, events and log_files
+    '''
+    return {
+        "songs": int(1000 * scale),
+        "artists": max(1, int(700 * scale)),
+        "users": max(10, int(100 * scale ** 0.5)),
+        "events": int(8000 * scale),
+        "log_files": 30
+    }
+
+
+def zipf_sampler(rnd, n, skew):
+    '''
+    Returns a function drawing indexes in [0, n) with a Zipf-like skew;
+    skew 0 draws uniformly
+    '''
+    cumulative = []
+    total = 0.0
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** skew
+        cumulative.append(total)
+    return lambda: min(n - 1, bisect.bisect_left(cumulative, rnd.random() * total))
+
+
+def random_id(rnd, prefix, length=16):
+    return prefix + "".join(rnd.choice(string.ascii_uppercase + string.digits)
+        for _ in range(length))
+
+
+def random_title(rnd, words):
+    return " ".join(rnd.choice(words).capitalize() for _ in range(rnd.randint(1, 4)))
+
+
+def write_json(path, records, newline_delimited=True):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(("\n" if newline_delimited else "").join(json.dumps(r) for r in records))
+    return os.path.getsize(path)
+
+
+def generate(outDir, scale=1, songs=None, artists=None, users=None, events=None,
+        logFiles=None, songsPerFile=1, artistSkew=1.0, songSkew=1.1, matchRate=0.8,
+        nextSongRate=0.8, seed=42,
+        start=datetime.datetime(2018, 11, 1, tzinfo=datetime.timezone.utc)):
+    '''
+    Writes a synthetic song catalogue and event log under outDir, laid out
+    and shaped like the S3 sources:
+
+        song_data/A/B/C/<id>.json               song records
+        log_data/YYYY/MM/YYYY-MM-DD-events.json one event per line
+        log_json_path.json                      jsonpaths for staging_events
+
+    Args:
+        outDir: str
+        scale: float
+            scale factor the sizes below default to (see scale_parameters)
+        songs, artists, users, events: int
+            number of each to generate
+        logFiles: int
+            number of daily log files the events are spread over
+        songsPerFile: int
+            song records per song file
+        artistSkew, songSkew: float
+            Zipf exponents for how songs are spread over artists and how
+            plays are spread over songs
+        matchRate: float
+            fraction of NextSong events that play a song from the catalogue
+            (same artist, title and duration); the rest play unknown songs
+        nextSongRate: float
+            fraction of events that are NextSong page views
+        seed: int
+    Returns:
+        dict describing what was generated: counts, files and bytes
+    '''
+    rnd = random.Random(seed)
+    sizes = scale_parameters(scale)
+    songs = songs if songs is not None else sizes["songs"]
+    artists = artists if artists is not None else sizes["artists"]
+    users = users if users is not None else sizes["users"]
+    events = events if events is not None else sizes["events"]
+    logFiles = logFiles if logFiles is not None else sizes["log_files"]
+    words = ["".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(3, 9)))
+        for _ in range(500)]
+
+    artistRecords = []
+    for _ in range(artists):
+        located = rnd.random() < 0.4
+        artistRecords.append({
+            "artist_id": random_id(rnd, "AR"),
+            "artist_name": random_title(rnd, words),
+            "artist_location": rnd.choice(LOCATIONS) if located else "",
+            "artist_latitude": round(rnd.uniform(-60, 70), 5) if located else None,
+            "artist_longitude": round(rnd.uniform(-150, 150), 5) if located else None
+        })
+
+    drawArtist = zipf_sampler(rnd, artists, artistSkew)
+    songRecords = []
+    for _ in range(songs):
+        song = {"num_songs": 1, "song_id": random_id(rnd, "SO"),
+            "title": random_title(rnd, words),
+            "duration": round(rnd.uniform(60, 600), 5),
+            "year": rnd.choice([0, rnd.randint(1960, 2018)])}
+        song.update(artistRecords[drawArtist()])
+        songRecords.append(song)
+
+    summary = {"songs": songs, "artists": artists, "users": users, "events": events,
+        "song_files": 0, "song_bytes": 0, "log_files": 0, "log_bytes": 0,
+        "next_song_events": 0, "matching_events": 0}
+
+    for i in range(0, songs, songsPerFile):
+        records = songRecords[i:i + songsPerFile]
+        trackId = random_id(rnd, "TR")
+        path = os.path.join(outDir, "song_data", trackId[2], trackId[3], trackId[4],
+            trackId + ".json")
+        summary["song_bytes"] += write_json(path, records, newline_delimited=False)
+        summary["song_files"] += 1
+
+    userRecords = []
+    for i in range(users):
+        userRecords.append({
+            "userId": str(i + 1),
+            "firstName": random_title(rnd, words).split()[0],
+            "lastName": random_title(rnd, words).split()[0],
+            "gender": rnd.choice(["M", "F"]),
+            "level": rnd.choice(["free", "paid"]),
+            "location": rnd.choice(LOCATIONS),
+            "userAgent": rnd.choice(USER_AGENTS),
+            "registration": float(int((start - datetime.timedelta(days=rnd.randint(30, 400)))
+                .timestamp() * 1000))
+        })
+
+    drawSong = zipf_sampler(rnd, max(1, songs), songSkew)
+    drawUser = zipf_sampler(rnd, users, 0.8)
+    perFile = [events // logFiles + (1 if i < events % logFiles else 0) for i in range(logFiles)]
+    sessionId = 0
+    for day, count in enumerate(perFile):
+        date = start + datetime.timedelta(days=day)
+        dayStart = int(date.timestamp() * 1000)
+        records = []
+        for ts in sorted(rnd.randint(dayStart, dayStart + 86399999) for _ in range(count)):
+            user = dict(userRecords[drawUser()])
+            if rnd.random() < 0.05:
+                user["level"] = "paid" if user["level"] == "free" else "free"
+            sessionId += 1 if rnd.random() < 0.1 else 0
+            event = {"auth": "Logged In", "itemInSession": rnd.randint(0, 100),
+                "method": "PUT", "sessionId": sessionId, "status": 200, "ts": ts,
+                "artist": None, "song": None, "length": None, "page": "NextSong"}
+            event.update(user)
+
+            if rnd.random() < nextSongRate and songs > 0:
+                summary["next_song_events"] += 1
+                if rnd.random() < matchRate:
+                    song = songRecords[drawSong()]
+                    event.update({"artist": song["artist_name"], "song": song["title"],
+                        "length": song["duration"]})
+                    summary["matching_events"] += 1
+                else:
+                    event.update({"artist": random_title(rnd, words),
+                        "song": random_title(rnd, words),
+                        "length": round(rnd.uniform(60, 600), 5)})
+            else:
+                event.update({"page": rnd.choice(PAGES), "method": "GET"})
+                if event["page"] in ("Login", "Home") and rnd.random() < 0.3:
+                    event.update({"auth": "Logged Out", "userId": "", "firstName": None,
+                        "lastName": None, "gender": None, "level": "free",
+                        "registration": None, "location": None, "userAgent": None})
+            records.append(event)
+
+        path = os.path.join(outDir, "log_data", date.strftime("%Y"), date.strftime("%m"),
+            date.strftime("%Y-%m-%d") + "-events.json")
+        summary["log_bytes"] += write_json(path, records)
+        summary["log_files"] += 1
+
+    with open(os.path.join(outDir, "log_json_path.json"), "w") as f:
+        json.dump({"jsonpaths": ["$['{}']".format(field) for field in EVENT_FIELDS]}, f, indent=2)
+
+    return summary
+
+
+def usage(program_name):
+    print(('{} {} {} {} {} {}').format(program_name, '-o <output dir>', '[-s <scale factor>]',
+        '[-m <match rate>]', '[-k <artist skew>,<song skew>]', '[-f <log files>]'))
+
+
+def main(argv):
+    outDir = None
+    options = {}
+
+    try:
+        program_name = argv[0]
+        opts, _ = getopt.getopt(argv[1:], "o:s:m:k:f:")
+        for k, v in opts:
+            if k == '-o':
+                outDir = v
+            if k == '-s':
+                options["scale"] = float(v)
+            if k == '-m':
+                options["matchRate"] = float(v)
+            if k == '-k':
+                options["artistSkew"], options["songSkew"] = [float(x) for x in v.split(",")]
+            if k == '-f':
+                options["logFiles"] = int(v)
+        if outDir is None:
+            raise ValueError("an output directory is required")
+    except (getopt.GetoptError, ValueError) as e:
+        print(e)
+        usage(program_name)
+        return
+
+    print(json.dumps(generate(outDir, **options), indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,156 @@
+import queue
+import threading
+from query_registry import quote_literal
+
+# Session settings a stage runs with, see stage_settings; the query group
+# is filled in as a quoted literal
+set_query_group = "set query_group to {}"
+reset_query_group = "reset query_group"
+set_statement_timeout = "set statement_timeout to {}"
+
+
+def connection_options(config):
+    '''
+    Returns the libpq connection parameters from the ETL section of the
+    config file: TCP keepalives, so idle connections waiting on a long COPY
+    are not dropped by NAT gateways, and a connect timeout
+    '''
+    return {
+        "keepalives": 1,
+        "keepalives_idle": config.getint("ETL","keepalives_idle", fallback=60),
+        "keepalives_interval": config.getint("ETL","keepalives_interval", fallback=10),
+        "keepalives_count": config.getint("ETL","keepalives_count", fallback=5),
+        "connect_timeout": config.getint("ETL","connect_timeout", fallback=30)
+    }
+
+
+def stage_settings(config, stage):
+    '''
+    Reads the WLM query group and statement timeout of a stage from the
+    WLM section of the config file, e.g. copy_query_group and
+    copy_statement_timeout, falling back to query_group and
+    statement_timeout
+
+    Returns:
+        (query group or None, statement timeout in ms, 0 for none)
+    '''
+    group = config.get("WLM", "{}_query_group".format(stage),
+        fallback=config.get("WLM", "query_group", fallback=None))
+    timeout = config.getint("WLM", "{}_statement_timeout".format(stage),
+        fallback=config.getint("WLM", "statement_timeout", fallback=0))
+    return group, timeout
+
+
+class ConnectionPool():
+    def __init__(self, connect, maxSize, settings=None):
+        '''
+        Instantiates a bounded pool of database connections. Connections are
+        opened lazily, at most maxSize of them, and handed back out to the
+        next caller once released.
+
+        Args:
+            connect: callable
+                returns a new (conn, cur) pair, e.g. etl.connect_to_db
+            maxSize: int
+                the largest number of connections held open at once
+            settings: callable
+                settings(stage) returns the (query group, statement timeout)
+                a connection is set to when acquired for that stage
+        '''
+        self.connect    = connect
+        self.maxSize    = maxSize
+        self.settings   = settings
+        self.idle       = queue.LifoQueue()
+        self.opened     = 0
+        self.lock       = threading.Lock()
+        self.all        = []
+        self.applied    = {}
+
+    def acquire(self, stage=None):
+        '''
+        Returns an idle (conn, cur) pair, opening a new connection if the
+        pool has not reached its size yet and blocking otherwise. Given a
+        stage, the connection is first set to that stage's settings.
+        '''
+        pair = self._acquire()
+        try:
+            self.configure(pair, stage)
+        except Exception:
+            self.release(pair)
+            raise
+        return pair
+
+    def configure(self, pair, stage, commit=True):
+        '''
+        Sets a connection's query group and statement timeout to those of a
+        stage. Sessions keep them, so nothing is sent when the connection
+        already has them. With commit False the settings join the open
+        transaction; call forget if it is rolled back.
+        '''
+        if stage is None or self.settings is None:
+            return
+        group, timeout = self.settings(stage)
+        conn, cur = pair
+        if self.applied.get(id(conn), (None, 0)) == (group, timeout):
+            return
+        cur.execute(set_query_group.format(quote_literal(group)) if group else reset_query_group)
+        cur.execute(set_statement_timeout.format(timeout))
+        if commit:
+            try:
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        self.applied[id(conn)] = (group, timeout)
+
+    def forget(self, pair):
+        '''
+        Drops what is known of a connection's settings, e.g. after rolling
+        back a transaction that changed them
+        '''
+        self.applied.pop(id(pair[0]), None)
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            canOpen = self.opened < self.maxSize
+            if canOpen:
+                self.opened += 1
+
+        if canOpen:
+            try:
+                pair = self.connect()
+            except Exception:
+                with self.lock:
+                    self.opened -= 1
+                raise
+            with self.lock:
+                self.all.append(pair)
+            return pair
+
+        return self.idle.get()
+
+    def release(self, pair):
+        '''
+        Returns a (conn, cur) pair to the pool
+        '''
+        self.idle.put(pair)
+
+    def closeAll(self):
+        '''
+        Closes every connection opened by the pool
+        '''
+        with self.lock:
+            pairs, self.all = self.all, []
+            self.opened = 0
+            self.applied = {}
+        for conn, _ in pairs:
+            try:
+                conn.close()
+            except Exception as e:
+                print(e)
+        self.idle = queue.LifoQueue()
@@ -14,12 +14,14 @@ def main(argv):
                 config_file = v
             if k == '-r':
                 useExistingRole = True
-            if k == '-c':
+            if k == '-v':
                 useExistingVpc =True
     except getopt.GetoptError:
         print (('{} {} {} {}').format(program_name,'-c <config file>','[-r]','[-v]'))
         print ("use the -r flag when you want to use an existing Iam Role in AWS to access S3")
         print ("use the -v flag when you want to use an already existing Vpc connection")
+        print ("rerun after a timeout to pick up the cluster being created, or to resume a paused one")
+        return
     
     cluster_gen = RedshiftClusterGenerator(config_file,useExistingRole,useExistingVpc)
     if(cluster_gen.configFileOK == True):
@@ -0,0 +1,349 @@
+import configparser
+import getopt
+import json
+import re
+import sys
+
+# Catalog queries of a live cluster. pg_table_def only lists the tables of
+# schemas on the search_path, so the session's search_path is set first.
+table_info_select = ("""
+    select "table", tbl_rows, size, skew_rows, diststyle, sortkey1, unsorted
+    from svv_table_info
+    where schema = %s
+""")
+
+column_select = ("""
+    select tablename, "column", type, notnull, encoding, distkey, sortkey
+    from pg_table_def
+    where schemaname = %s
+""")
+
+scan_select = ("""
+    select trim(perm_table_name), count(distinct query), sum(rows), sum(bytes),
+        count(distinct case when is_rrscan = 't' then query end)
+    from stl_scan
+    where type = 2
+    group by 1
+""")
+
+analyze_compression = "analyze compression {}"
+
+DEFAULT_TABLES = ["songplay", "users", "songs", "artists", "time"]
+
+# Tables up to this many rows are copied to every node (diststyle all)
+ALL_MAX_ROWS = 3000000
+
+# Rough bytes per value of a column type, to weigh the columns of a table
+TYPE_WIDTHS = [
+    (re.compile(r"^(smallint|int2)"), 2),
+    (re.compile(r"^(integer|int4|int\b|date|real|float4)"), 4),
+    (re.compile(r"^(bigint|int8|timestamp|double|float8|float|numeric|decimal)"), 8),
+    (re.compile(r"^bool"), 1),
+    (re.compile(r"^(character|char)\((\d+)\)"), None),
+    (re.compile(r"^(character varying|varchar)"), 32)
+]
+
+
+def column_width(columnType):
+    '''
+    Estimates the bytes a value of a column type takes before compression
+    '''
+    for pattern, width in TYPE_WIDTHS:
+        match = pattern.match(columnType.lower())
+        if match is not None:
+            return width if width is not None else int(match.group(2))
+    return 16
+
+
+def take_snapshot(cur, schema, tables):
+    '''
+    Reads what the advisor needs from a live cluster: table sizes and skew
+    from svv_table_info, the column definitions from pg_table_def, scan
+    statistics from stl_scan and ANALYZE COMPRESSION of every table
+
+    Returns:
+        dict that can be written as JSON and replayed with --snapshot
+    '''
+    snapshot = {"schema": schema, "tables": {}, "columns": {}, "compression": {}, "scans": {}}
+    cur.execute("set search_path to " + schema)
+
+    cur.execute(table_info_select, (schema,))
+    for table, rows, size, skew, diststyle, sortkey1, unsorted in cur.fetchall():
+        if table in tables:
+            snapshot["tables"][table] = {"rows": rows, "size_mb": size, "skew_rows": skew,
+                "diststyle": diststyle, "sortkey1": sortkey1, "unsorted": unsorted}
+
+    cur.execute(column_select, (schema,))
+    for table, column, columnType, notnull, encoding, distkey, sortkey in cur.fetchall():
+        if table in tables:
+            snapshot["columns"].setdefault(table, []).append({"column": column,
+                "type": columnType, "notnull": notnull, "encoding": encoding,
+                "distkey": distkey, "sortkey": sortkey})
+
+    cur.execute(scan_select)
+    for table, scans, rows, scanned, rangeRestricted in cur.fetchall():
+        if table in tables:
+            snapshot["scans"][table] = {"scans": scans, "rows": rows, "bytes": scanned,
+                "range_restricted": rangeRestricted}
+
+    for table in tables:
+        if table not in snapshot["tables"]:
+            continue
+        cur.execute(analyze_compression.format(table))
+        snapshot["compression"][table] = dict((column, {"encoding": encoding,
+            "reduction_pct": float(reduction)}) for _, column, encoding, reduction in cur.fetchall())
+    return snapshot
+
+
+def key_column(columns):
+    '''
+    Returns the column a table is looked up by: its leading sort key
+    column, or its first column
+    '''
+    for column in columns:
+        if column["sortkey"] == 1:
+            return column["column"]
+    return columns[0]["column"]
+
+
+def join_columns(snapshot, table):
+    '''
+    Returns the columns of a table that hold the key of another table, as
+    dict of column -> list of the tables it joins to
+    '''
+    keys = dict((t, key_column(columns)) for t, columns in snapshot["columns"].items())
+    joins = {}
+    for column in snapshot["columns"][table]:
+        for other, key in keys.items():
+            if other != table and column["column"] == key:
+                joins.setdefault(column["column"], []).append(other)
+    return joins
+
+
+def distribution(snapshot, allMaxRows):
+    '''
+    Picks the distribution of every table: small tables are copied to all
+    nodes; a large table is distributed on the join column to the largest
+    other large table, so that join is collocated, or on its own key when
+    a large table joins to it, and evenly otherwise
+
+    Returns:
+        dict of table -> ("all" | "even" | "key", distkey column or None, reason)
+    '''
+    tables = snapshot["tables"]
+    large = set(t for t, info in tables.items() if (info["rows"] or 0) > allMaxRows)
+    choices = {}
+    for table, info in tables.items():
+        if table not in large:
+            choices[table] = ("all", None,
+                "{} rows, small enough to copy to every node".format(info["rows"]))
+            continue
+        joins = join_columns(snapshot, table)
+        candidates = [(tables[other]["rows"], column, other)
+            for column, others in joins.items() for other in others if other in large]
+        if candidates:
+            _, column, other = max(candidates)
+            choices[table] = ("key", column, "collocates the join to {}, which is too large to copy "
+                "to every node".format(other))
+            continue
+        referencing = [t for t in large if t != table and key_column(snapshot["columns"][table])
+            in join_columns(snapshot, t)]
+        if referencing:
+            column = key_column(snapshot["columns"][table])
+            choices[table] = ("key", column, "{} joins to it on {}".format(
+                ", ".join(sorted(referencing)), column))
+        else:
+            choices[table] = ("even", None, "every table it joins to is copied to all nodes")
+    return choices
+
+
+def sort_columns(snapshot, table, distkey):
+    '''
+    Picks a compound sort key: timestamp columns first, since loads and
+    queries restrict on time, then the distribution key and the table key
+    '''
+    columns = snapshot["columns"][table]
+    names = [c["column"] for c in columns if c["type"].lower().startswith("timestamp")
+        and (c["column"] in join_columns(snapshot, table) or c["column"] == key_column(columns))]
+    for name in (distkey, key_column(columns)):
+        if name is not None and name not in names:
+            names.append(name)
+    return names
+
+
+def estimate_savings(snapshot, table, encodings):
+    '''
+    Estimates the storage the recommended encodings save, weighing each
+    column's ANALYZE COMPRESSION reduction by its share of the row width.
+    Columns already encoded are assumed to gain nothing, and scans are
+    assumed to read proportionally fewer bytes.
+
+    Returns:
+        dict with size_mb, recommended_size_mb, reduction_pct and
+        scanned_bytes_saved
+    '''
+    info = snapshot["tables"][table]
+    compression = snapshot["compression"].get(table, {})
+    total = 0.0
+    saved = 0.0
+    for column in snapshot["columns"][table]:
+        width = column_width(column["type"])
+        total += width
+        if column["encoding"] in ("none", "raw") and encodings[column["column"]] != "raw":
+            saved += width * compression.get(column["column"], {}).get("reduction_pct", 0.0) / 100.0
+    fraction = saved / total if total else 0.0
+    size = info["size_mb"] or 0
+    scanned = snapshot["scans"].get(table, {}).get("bytes") or 0
+    return {
+        "size_mb": size,
+        "recommended_size_mb": int(round(size * (1 - fraction))),
+        "reduction_pct": round(fraction * 100, 1),
+        "scanned_bytes_saved": int(scanned * fraction)
+    }
+
+
+def recommend(snapshot, allMaxRows=ALL_MAX_ROWS):
+    '''
+    Recommends the physical design of every table in a catalog snapshot
+
+    Returns:
+        list of dicts with the table, its encodings, distribution, sort
+        key, the reasons and the estimated savings
+    '''
+    recommendations = []
+    distributions = distribution(snapshot, allMaxRows)
+    for table in sorted(snapshot["tables"]):
+        style, distkey, reason = distributions[table]
+        sortkey = sort_columns(snapshot, table, distkey)
+        compression = snapshot["compression"].get(table, {})
+        encodings = {}
+        for column in snapshot["columns"][table]:
+            name = column["column"]
+            # the leading sort key column stays raw so range-restricted scans stay cheap
+            if sortkey and name == sortkey[0]:
+                encodings[name] = "raw"
+            else:
+                encodings[name] = compression.get(name, {}).get("encoding", column["encoding"])
+            # pg_table_def reports unencoded columns as none, which DDL spells raw
+            if encodings[name] == "none":
+                encodings[name] = "raw"
+        scans = snapshot["scans"].get(table, {})
+        recommendations.append({"table": table, "encodings": encodings, "diststyle": style,
+            "distkey": distkey, "sortkey": sortkey, "reasons": [reason], "scans": scans,
+            "savings": estimate_savings(snapshot, table, encodings)})
+        if scans.get("scans"):
+            recommendations[-1]["reasons"].append("{} of {} scans were range-restricted on the "
+                "current sort key".format(scans.get("range_restricted", 0), scans["scans"]))
+    return recommendations
+
+
+def render_ddl(snapshot, recommendation):
+    '''
+    Renders the CREATE TABLE statement of a recommendation
+    '''
+    table = recommendation["table"]
+    lines = []
+    for column in snapshot["columns"][table]:
+        name = column["column"]
+        lines.append("    {:<34} {}{} encode {}{}".format(name, column["type"],
+            " not null" if column["notnull"] else "", recommendation["encodings"][name],
+            " distkey" if name == recommendation["distkey"] else ""))
+    ddl = "create table if not exists {}(\n{}\n    ) diststyle {}".format(table,
+        ",\n".join(lines), recommendation["diststyle"])
+    if recommendation["sortkey"]:
+        ddl += "\n    compound sortkey({})".format(", ".join(recommendation["sortkey"]))
+    return ddl + ";"
+
+
+def print_recommendations(snapshot, recommendations, output=None):
+    statements = []
+    for r in recommendations:
+        info = snapshot["tables"][r["table"]]
+        savings = r["savings"]
+        header = ["-- {}: {} rows, {} MB, skew {}, currently diststyle {} sortkey {}".format(
+            r["table"], info["rows"], info["size_mb"], info["skew_rows"], info["diststyle"],
+            info["sortkey1"])]
+        header += ["--   " + reason for reason in r["reasons"]]
+        header.append("--   estimated size {} MB -> {} MB ({}% less), {} fewer bytes scanned".format(
+            savings["size_mb"], savings["recommended_size_mb"], savings["reduction_pct"],
+            savings["scanned_bytes_saved"]))
+        statements.append("\n".join(header) + "\n" + render_ddl(snapshot, r))
+    text = "\n\n".join(statements)
+    print(text)
+    if output is not None:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+
+
+def connect(config):
+    import psycopg2
+    conn = psycopg2.connect(host=config.get("DWH","dwh_endpoint"),
+        dbname=config.get("DWH","dwh_db"), user=config.get("DWH","dwh_db_user"),
+        password=config.get("DWH","dwh_db_password"), port=config.get("DWH","dwh_db_port"))
+    # ANALYZE COMPRESSION can't run inside a transaction block
+    conn.autocommit = True
+    return conn
+
+
+def usage(program_name):
+    print(('{} {} {} {} {} {}').format(program_name, '[-c <config file>]', '[-s <snapshot.json>]',
+        '[-r <snapshot.json>]', '[-t <table>,<table>...]', '[-a <rows>] [-o <ddl.sql>]'))
+    print("recommends column encodings, distribution and sort keys for the star schema tables")
+    print("use the -s flag to advise from a recorded catalog snapshot instead of a live cluster")
+    print("use the -r flag to record the catalog snapshot read from the cluster")
+    print("use the -a flag to set the most rows a table copied to every node may have (default {})".format(
+        ALL_MAX_ROWS))
+
+
+def main(argv):
+    config_file = "dwh.cfg"
+    snapshot_path = None
+    record_path = None
+    output = None
+    tables = DEFAULT_TABLES
+    allMaxRows = ALL_MAX_ROWS
+
+    try:
+        program_name = argv[0]
+        opts, _ = getopt.getopt(argv[1:], "c:s:r:t:a:o:")
+        for k, v in opts:
+            if k == '-c':
+                config_file = v
+            if k == '-s':
+                snapshot_path = v
+            if k == '-r':
+                record_path = v
+            if k == '-t':
+                tables = v.split(",")
+            if k == '-a':
+                allMaxRows = int(v)
+            if k == '-o':
+                output = v
+    except (getopt.GetoptError, ValueError) as e:
+        print(e)
+        usage(program_name)
+        return
+
+    try:
+        if snapshot_path is not None:
+            with open(snapshot_path) as f:
+                snapshot = json.load(f)
+        else:
+            config = configparser.ConfigParser()
+            config.read(config_file)
+            conn = connect(config)
+            try:
+                snapshot = take_snapshot(conn.cursor(), config.get("DWH","dwh_schema"), tables)
+            finally:
+                conn.close()
+            if record_path is not None:
+                with open(record_path, "w") as f:
+                    json.dump(snapshot, f, indent=2, default=str)
+
+        print_recommendations(snapshot, recommend(snapshot, allMaxRows), output)
+    except Exception as e:
+        print(e)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,113 +1,1087 @@
 import configparser
+import datetime
+import getopt
+import os
+import sys
+import time
+from collections import namedtuple
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries, copy_table_queries
-from sql_queries import insert_table_queries, drop_staging_queries, dwh_schema_create 
+from query_registry import QueryRegistry, pipeline_steps
+from s3_manifest import list_objects, build_manifest, write_manifest, s3_client, client_spec
+from s3_manifest import read_manifest
+from load_errors import db_time, load_errors, summarize_errors, quarantine, retry_manifest_url
+from load_errors import manifest_objects
+from preprocess import preprocess_events, PROJECTED_FIELDS
+from coalesce import coalesce_objects, print_report, COMPRESSION_OPTIONS
+from db_pool import ConnectionPool, connection_options, stage_settings
+from scheduler import run_steps
+from run_report import RunReport, InstrumentedCursor
+from publish import validate_shadows, swap_tables, rollback
+from run_state import RunState, listing_hash, input_hashes, resolve_stages, plan_steps
+from run_state import execute_query
+from partitions import parse_range, partition_prefix, copy_step_name, run_prefix
+from partitions import backfill_steps, BACKFILL_RUN_PREFIX
+from backends import BACKENDS, LOCAL_SOURCES, local_backend, local_listing
+from validation import check_quality, quality_thresholds, QualityError
+from export import export_options, s3_target, directory_target, fingerprints, exported_partitions
+from export import plan_export, export_steps, prepare_directories, write_directory_manifests
+from export import write_table_manifests, record_export, partition_path
 
+# S3 sources: watermark name, S3 prefix, manifest COPY, whether keys under
+# the prefix sort in arrival order and the full-load step that COPYs it.
+# Log files are named by date so incremental listing can start after the
+# last loaded key; song files are not, so they are filtered on their
+# modification time instead
+Source = namedtuple("Source", ["name", "prefix", "manifest_copy", "ordered_keys", "copy_step"])
 
-def create_schema(cur,conn):
-    cur.execute(dwh_schema_create)
+# Run ids of the runs forced steps get when no full load is unfinished, so
+# a full load never resumes one
+FORCED_RUN_PREFIX = "stages_"
+
+
+def sources(queries):
+    return [
+        Source("log_data", queries.value("log_data"),
+            queries.query("staging_events_manifest_copy"), True, "copy_staging_events"),
+        Source("song_data", queries.value("song_data"),
+            queries.query("staging_songs_manifest_copy"), False, "copy_staging_songs")
+    ]
+
+
+def create_schema(cur, conn, queries):
+    cur.execute(queries.query("dwh_schema_create"))
     conn.commit()
 
-def load_staging_tables(cur, conn):
-    for query in copy_table_queries:
+def drop_staging_tables(cur, conn, queries):
+    for query in queries.query("drop_staging_queries"):
         cur.execute(query)
+    conn.commit()
+
+def run_single_transaction(pool, pair, queries, thresholds, report):
+    '''
+    Full load on one session in a single transaction: temp staging tables,
+    COPYs without compression analysis or statistics updates, and one
+    commit at the end. On failure, including failed quality checks, everything
+    is rolled back and the warehouse is left as it was.
+    '''
+    conn, cur = pair
+    report.runId = time.strftime("%Y%m%dT%H%M%S")
+    try:
+        for stage, statements in queries.query("single_transaction_stages"):
+            print("Running the {} stage".format(stage))
+            pool.configure(pair, stage, commit=False)
+            for query in statements:
+                cur.execute(query)
+        if thresholds is not None:
+            check_quality(cur, thresholds, report)
+        print("Committing")
         conn.commit()
+    except Exception as e:
+        conn.rollback()
+        pool.forget(pair)
+        print(e)
+        print("Rolled back, the warehouse is unchanged")
 
+def create_control_tables(cur, conn, queries):
+    for query in queries.query("create_control_queries"):
+        cur.execute(query)
+    conn.commit()
 
-def insert_tables(cur, conn):
-    for query in insert_table_queries:
+def prepare_incremental(cur, conn, queries):
+    for query in queries.query("drop_staging_queries"):
         cur.execute(query)
-        conn.commit()
 
-def prepare_database(cur, conn):
-    for query in drop_table_queries:
+    for query in queries.query("staging_table_create_queries") + queries.query("final_table_create_queries"):
         cur.execute(query)
-        conn.commit()
+    conn.commit()
+
+def get_watermark(cur, queries, source):
+    cur.execute(queries.query("watermark_select"), (source,))
+    row = cur.fetchone()
+    if row is None:
+        return None, None, None
+    return row
+
+def set_watermark(cur, queries, source, last_key, last_modified, last_ts):
+    cur.execute(queries.query("watermark_delete"), (source,))
+    cur.execute(queries.query("watermark_insert"), (source, last_key, last_modified, last_ts))
+
+def get_slice_count(cur, config, queries):
+    slices = config.getint("ETL","slices", fallback=None)
+    if slices is None:
+        cur.execute(queries.query("slice_count_query"))
+        slices = cur.fetchone()[0]
+    return slices
+
+def staged_prefix(queries, run_id, source):
+    '''
+    Returns the S3 prefix the manifest and any chunks of a source's COPY
+    are written under
+    '''
+    return "{}/{}/{}".format(queries.value("manifest_prefix").rstrip("/"), run_id, source.name)
+
+def stage_manifest(s3, source, objects, run_id, load, report):
+    '''
+    Writes the COPY manifest for a source's objects. When event filtering
+    is on the event logs are first reduced to gzip CSV files of the
+    columns the star schema uses; when a compression is set the objects are first coalesced into
+    compressed chunks balanced over the cluster slices.
+
+    Args:
+        s3: boto3 S3 client
+        source: Source
+        objects: list of dicts as returned by s3_manifest.list_objects
+        run_id: str
+        load: dict with the slices, compression, chunk_bytes, filter_events,
+            workers and client_spec to use, the queries registry, its
+            sources and the chunks staged for each of them, which is
+            updated
+        report: run_report.RunReport
+            receives the coalescing report of the source
+    Returns:
+        the manifest COPY statement for the source
+    '''
+    queries = load["queries"]
+    base = staged_prefix(queries, run_id, source)
+    load["staged"].pop(source.name, None)
+    if load["filter_events"] and source.name == "log_data":
+        manifest_url, filtered = preprocess_events(load["client_spec"], objects, base,
+            load["slices"], load["workers"], load["chunk_bytes"])
+        load["staged"][source.name] = filtered.pop("chunks")
+        print("{}: {} events / {} bytes -> {} rows / {} bytes of gzip CSV".format(source.name,
+            filtered["rows_in"], filtered["bytes_in"], filtered["rows_out"], filtered["bytes_out"]))
+        report.addSection("preprocess", source.name, filtered)
+        return queries.query("staging_events_projected_copy").format(
+            ", ".join(PROJECTED_FIELDS), manifest_url)
+
+    if load["compression"] is None:
+        manifest_url = write_manifest(s3, base + ".manifest", build_manifest(objects))
+        return source.manifest_copy.format(manifest_url, "")
+
+    manifest_url, balance = coalesce_objects(s3, objects, base, load["slices"],
+        load["compression"], load["chunk_bytes"], splitLines=source.name == "log_data")
+    load["staged"][source.name] = balance.pop("chunks")
+    print_report(source.name, balance)
+    report.addSection("coalesce", source.name, balance)
+    return source.manifest_copy.format(manifest_url, COMPRESSION_OPTIONS[load["compression"]])
 
-    for query in create_table_queries:
+def coalesce_sources(s3, steps, listings, run_id, load, report):
+    '''
+    Pre-load stage of a full load: coalesces (or, for filtered event logs,
+    pre-processes) the listed files of each source whose COPY is about to
+    run and returns the steps with those COPYs pointed at the generated
+    manifests
+    '''
+    names = [step.name for step in steps]
+    copies = {}
+    for source in load["sources"]:
+        objects = listings[source.copy_step]
+        if source.copy_step not in names or len(objects) == 0:
+            continue
+        if load["compression"] is None and source.name != "log_data":
+            continue
+        copies[source.copy_step] = stage_manifest(s3, source, objects, run_id, load, report)
+
+    return [step._replace(query=copies[step.name]) if step.name in copies else step
+        for step in steps]
+
+def quarantine_copy(cur, s3, source, objects, since, run_id, load, report, quarantined=None):
+    '''
+    After a COPY of a source: summarizes the lines it rejected into the run
+    report and, when it failed on some of the listed objects, quarantines
+    those into a retry manifest. When the COPY read chunks coalesced or
+    projected from the objects, the errors are those of the chunks, and
+    every object of a failed chunk is quarantined.
+
+    Args:
+        quarantined: list
+            objects earlier attempts of the COPY quarantined, extended with
+            the new ones so the retry manifest lists all of them
+    Returns:
+        (COPY statement, objects) for the objects left, or None when there
+        is nothing to retry without the quarantined ones
+    '''
+    chunks = load["staged"].get(source.name)
+    prefix = source.prefix if chunks is None else staged_prefix(load["queries"], run_id, source)
+    files = summarize_errors(load_errors(cur, since, prefix))
+    for url, summary in files.items():
+        print("{}: {} rejected lines in {} (lines {})".format(source.name, summary["errors"],
+            url, ", ".join(str(line) for line in summary["lines"])))
+        report.addSection("load_errors", url, summary)
+    manifestPrefix = load["queries"].value("manifest_prefix")
+    if len(files) == 0 or manifestPrefix is None:
+        return None
+
+    if chunks is not None:
+        files = ["s3://{}/{}".format(o["Bucket"], o["Key"])
+            for url in files for o in chunks.get(url, [])]
+    if quarantined is None:
+        quarantined = []
+    retryUrl = retry_manifest_url(manifestPrefix, run_id, source.name)
+    remaining, failed = quarantine(s3, objects, files, retryUrl, quarantined)
+    quarantined += failed
+    if len(failed) == 0 or len(remaining) == 0:
+        return None
+    print("{}: {} files quarantined to {}, use --retry={} to load them once fixed".format(
+        source.name, len(quarantined), retryUrl, run_id))
+    report.addSection("quarantined", source.name, {"manifest": retryUrl,
+        "files": ["s3://{}/{}".format(o["Bucket"], o["Key"]) for o in quarantined]})
+    return stage_manifest(s3, source, remaining, run_id,
+        dict(load, compression=None, filter_events=False), report), remaining
+
+def copy_source(cur, conn, s3, source, objects, query, run_id, load, report):
+    '''
+    Runs and commits the COPY of a source. If it fails on some of its
+    files, those are quarantined and the rest are COPYed again, until a
+    COPY fails on no new file.
+    '''
+    quarantined = []
+    while True:
+        since = db_time(cur)
+        try:
+            cur.execute(query)
+            conn.commit()
+            break
+        except Exception as e:
+            conn.rollback()
+            retry = quarantine_copy(cur, s3, source, objects, since, run_id, load, report,
+                quarantined)
+            if retry is None:
+                raise
+            print("{}: {}".format(source.name, e))
+            query, objects = retry
+    if load["queries"].value("maxerror") > 0:
+        quarantine_copy(cur, s3, source, [], since, run_id, load, report)
+
+def quarantine_runner(run, s3, listings, run_id, load, report):
+    '''
+    Wraps a step runner so that the source COPYs of a full load quarantine
+    the files they fail on and load the rest, like copy_source
+    '''
+    copies = dict((source.copy_step, source) for source in load["sources"])
+
+    def pooled(pool, work):
+        pair = pool.acquire()
+        conn, cur = pair
+        try:
+            result = work(cur)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.release(pair)
+
+    def quarantining(step, pool):
+        source = copies.get(step.name)
+        if source is None:
+            return run(step, pool)
+        attempt, objects, quarantined = step, listings[step.name], []
+        while True:
+            since = pooled(pool, db_time)
+            try:
+                run(attempt, pool)
+                break
+            except Exception as e:
+                retry = pooled(pool, lambda cur: quarantine_copy(cur, s3, source,
+                    objects, since, run_id, load, report, quarantined))
+                if retry is None:
+                    raise
+                print("{}: {}".format(step.name, e))
+                attempt, objects = step._replace(query=retry[0]), retry[1]
+        if load["queries"].value("maxerror") > 0:
+            pooled(pool, lambda cur: quarantine_copy(cur, s3, source, [], since,
+                run_id, load, report))
+    return quarantining
+
+def load_new_objects(cur, conn, s3, run_id, load, report):
+    '''
+    COPYs only the S3 objects that arrived since the stored watermark of
+    each source, through a manifest generated for this run
+
+    Returns:
+        dict of source -> (last_key, last_modified, last_ts) to be stored
+        once the final tables have been updated
+    '''
+    watermarks = {}
+    for source in load["sources"]:
+        last_key, last_modified, last_ts = get_watermark(cur, load["queries"], source.name)
+        if source.ordered_keys:
+            objects = list_objects(s3, source.prefix, start_after=last_key)
+        else:
+            objects = list_objects(s3, source.prefix, modified_after=last_modified)
+
+        if len(objects) == 0:
+            print("{}: no new objects since the last load".format(source.name))
+            continue
+
+        print("{}: loading {} new objects".format(source.name, len(objects)))
+        copy_source(cur, conn, s3, source, objects,
+            stage_manifest(s3, source, objects, run_id, load, report), run_id, load, report)
+
+        last_key = objects[-1]["Key"]
+        last_modified = max(o["LastModified"] for o in objects)
+        if source.name == "log_data":
+            cur.execute(load["queries"].query("staging_events_max_ts"))
+            last_ts = cur.fetchone()[0] or last_ts
+        watermarks[source.name] = (last_key, last_modified, last_ts)
+    return watermarks
+
+def load_retry_manifests(cur, conn, s3, retry_run_id, run_id, load, report):
+    '''
+    COPYs the files an earlier run quarantined, from its retry manifests
+
+    Returns:
+        number of sources loaded
+    '''
+    loaded = 0
+    for source in load["sources"]:
+        url = retry_manifest_url(load["queries"].value("manifest_prefix"), retry_run_id, source.name)
+        try:
+            objects = manifest_objects(read_manifest(s3, url))
+        except Exception:
+            continue
+        print("{}: retrying {} quarantined files".format(source.name, len(objects)))
+        copy_source(cur, conn, s3, source, objects, source.manifest_copy.format(url, ""),
+            run_id, load, report)
+        loaded += 1
+    return loaded
+
+def insert_incremental(cur, conn, watermarks, queries, thresholds, report):
+    # final tables and watermarks move together in a single transaction,
+    # which only commits if the merged tables pass the quality checks
+    for query in queries.query("incremental_key_queries") + queries.query("incremental_insert_queries"):
         cur.execute(query)
-        conn.commit()
 
-def drop_staging_tables(cur,conn):
-    for query in drop_staging_queries:
+    for source, (last_key, last_modified, last_ts) in watermarks.items():
+        set_watermark(cur, queries, source, last_key, last_modified, last_ts)
+    if thresholds is not None:
+        check_quality(cur, thresholds, report)
+    conn.commit()
+
+def insert_retried(cur, conn, queries, thresholds, report):
+    for query in queries.query("incremental_key_queries") + queries.query("retry_insert_queries"):
         cur.execute(query)
-        conn.commit()
+    if thresholds is not None:
+        check_quality(cur, thresholds, report)
+    conn.commit()
 
-def connect_to_db(host,dbname,user,password,port,schema = None):
-    
-    conn = psycopg2.connect(("""host={} dbname={} 
-        user={} password={} port={}""").
-    format(
-        host,
-        dbname,
-        user,
-        password,
-        port))
-    cur = conn.cursor()
-    
-    if schema is not None:
-        cur.execute("SET search_path TO " + schema)
-        conn.commit()  
-    
+def validate_tables(pool, thresholds, report):
+    '''
+    Runs the quality checks on the live final tables after a load that
+    committed step by step. The tables are already live by then, so a
+    breach can only fail the run; --publish blocks it instead.
+    Raises QualityError when a threshold is breached.
+    '''
+    if thresholds is None:
+        return
+    pair = pool.acquire("validate")
+    conn, cur = pair
+    try:
+        print("Validating final tables")
+        try:
+            check_quality(cur, thresholds, report)
+        except QualityError as e:
+            raise QualityError("{}; the loaded tables are live, load with --publish to keep tables "
+                "that fail the checks from replacing them".format(e))
+    finally:
+        conn.rollback()
+        pool.release(pair)
+
+def connect_to_db(host,dbname,user,password,port,schema = None, report = None, options = None):
+    '''
+    Opens a session: connects with the extra libpq parameters in options
+    (see db_pool.connection_options) and sets the search_path once. Given
+    a report, the setup is timed and the cursor instrumented.
+    '''
+    started_at = datetime.datetime.utcnow()
+    started = time.perf_counter()
+    try:
+        conn = psycopg2.connect(host=host, dbname=dbname, user=user,
+            password=password, port=port, **(options or {}))
+        cur = conn.cursor()
+
+        if schema is not None:
+            cur.execute("SET search_path TO " + schema)
+            conn.commit()
+    except Exception as e:
+        if report is not None:
+            report.addConnection(started_at, time.perf_counter() - started, e)
+        raise
+
+    if report is not None:
+        report.addConnection(started_at, time.perf_counter() - started)
+        cur = InstrumentedCursor(cur, report)
     return conn, cur
 
 
-def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+def export_target(config, queries, backend=None):
+    '''
+    Returns where the export stage writes: the S3 prefix UNLOAD writes to
+    on Redshift, the local_dir a local backend writes to
+
+    Returns:
+        (export.ExportTarget, max file size in MB)
+    '''
+    options = export_options(config)
+    if backend is None:
+        if options["prefix"] is None:
+            raise ValueError("Exporting needs prefix in the EXPORT section of the config file")
+        return s3_target(s3_client(config), options["prefix"],
+            queries.query("export_unload")), options["max_file_mb"]
+    if backend.unload is None:
+        raise ValueError("The {} backend can't write Parquet, export with duckdb".format(backend.name))
+    if options["local_dir"] is None:
+        raise ValueError("Exporting locally needs local_dir in the EXPORT section of the config file")
+    return directory_target(options["local_dir"], backend.unload), options["max_file_mb"]
+
+def run_export(pool, target, maxFileMb, concurrency, report):
+    '''
+    Export stage: fingerprints the partitions of the final tables and
+    writes those that changed since the last export to Parquet,
+    concurrently, then rewrites the table manifests and records what was
+    exported. Runs once a load has committed.
+    '''
+    pair = pool.acquire("export")
+    conn, cur = pair
+    try:
+        current = fingerprints(cur)
+        changed, removed = plan_export(current, exported_partitions(cur))
+        conn.commit()
+    finally:
+        pool.release(pair)
+
+    print("Exporting {} of {} partitions to {}".format(len(changed), len(current), target.prefix))
+    if target.local:
+        prepare_directories(target, changed)
+    run_steps(export_steps(changed, target, maxFileMb), pool, concurrency)
+    if target.local:
+        write_directory_manifests(target, changed, current)
+    for table, year, month in removed:
+        print("{} {:04d}/{:02d} is no longer in the table, removing it".format(table, year, month))
+        target.remove(partition_path(target.prefix, table, year, month))
+    write_table_manifests(target, current, removed)
+
+    pair = pool.acquire("export")
+    conn, cur = pair
+    try:
+        record_export(cur, changed, removed, current)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.release(pair)
+    for table, year, month in changed:
+        report.addSection("export", partition_path(target.prefix, table, year, month),
+            {"rows": current[(table, year, month)][0], "status": "exported"})
+    for table, year, month in removed:
+        report.addSection("export", partition_path(target.prefix, table, year, month),
+            {"rows": 0, "status": "removed"})
+
+def run_incremental(config, pool, pair, load, report):
+    conn, cur = pair
+    if load["queries"].value("manifest_prefix") is None:
+        print("Incremental loads need MANIFEST_PREFIX in the S3 section of the config file")
+        return
+
+    run_id = time.strftime("%Y%m%dT%H%M%S")
+    report.runId = run_id
+    try:
+        print("Preparing database for incremental ETL")
+        pool.configure(pair, "prepare")
+        prepare_incremental(cur, conn, load["queries"])
+    except Exception as e:
+        print(e)
+        return
+
+    try:
+        print("Loading new objects into staging tables")
+        pool.configure(pair, "copy")
+        watermarks = load_new_objects(cur, conn, s3_client(config), run_id, load, report)
+    except Exception as e:
+        print(e)
+        return
+
+    try:
+        print("Merging into final tables")
+        pool.configure(pair, "insert")
+        insert_incremental(cur, conn, watermarks, load["queries"], quality_thresholds(config), report)
+    except Exception as e:
+        conn.rollback()
+        print(e)
+        return
+
+    try:
+        print("Dropping staging tables")
+        pool.configure(pair, "drop_staging")
+        drop_staging_tables(cur, conn, load["queries"])
+    except Exception as e:
+        print(e)
+        return
+    return True
+
+def run_retry(config, pool, pair, retry_run_id, load, report):
+    '''
+    Loads the files a failed COPY of an earlier run quarantined, on their
+    own, and merges them into the existing star schema
+    '''
+    if load["queries"].value("manifest_prefix") is None:
+        print("Retrying quarantined files needs MANIFEST_PREFIX in the S3 section of the config file")
+        return
+
+    conn, cur = pair
+    run_id = time.strftime("%Y%m%dT%H%M%S")
+    report.runId = run_id
+    try:
+        print("Preparing database for retrying run {}".format(retry_run_id))
+        pool.configure(pair, "prepare")
+        prepare_incremental(cur, conn, load["queries"])
+        pool.configure(pair, "copy")
+        if load_retry_manifests(cur, conn, s3_client(config), retry_run_id, run_id, load, report) == 0:
+            print("No quarantined files found for run {}".format(retry_run_id))
+            return
+        print("Merging into final tables")
+        pool.configure(pair, "insert")
+        insert_retried(cur, conn, load["queries"], quality_thresholds(config), report)
+        print("Dropping staging tables")
+        pool.configure(pair, "drop_staging")
+        drop_staging_tables(cur, conn, load["queries"])
+    except Exception as e:
+        conn.rollback()
+        print(e)
+
+def plan_run(state, pipeline, hashes, stages, prefix=None):
+    '''
+    Decides which run a full load or backfill belongs to and which of its
+    steps still have to execute: an unfinished run is resumed at its first
+    step that has not succeeded, unless its inputs changed in the meantime.
+    Steps forced by stage when no full load is unfinished get a run of
+    their own, which a full load never resumes; a later invocation forcing
+    steps resumes it instead, skipping the forced steps that already
+    succeeded. See finish_forced for when it is closed.
+
+    Args:
+        prefix: str
+            run id prefix of a backfill; None for a full load
+    Returns:
+        (run id, steps to run)
+    '''
+    forced = stages["from"] is not None or len(stages["only"]) > 0
+    if prefix is None:
+        run_id = state.openRun(exclude=(BACKFILL_RUN_PREFIX, FORCED_RUN_PREFIX))
+    else:
+        run_id = state.openRun(prefix=prefix)
+    if run_id is None and prefix is None and forced:
+        prefix = FORCED_RUN_PREFIX
+        run_id = state.openRun(prefix=prefix)
+        succeeded = state.succeeded(run_id) if run_id is not None else {}
+        steps, _ = plan_steps(pipeline, hashes, {}, stages["from"], stages["only"])
+        left = [step for step in steps if succeeded.get(step.name) != hashes[step.name]]
+        if run_id is None:
+            run_id = prefix + time.strftime("%Y%m%dT%H%M%S")
+            print("No unfinished run, running the forced steps as run {}".format(run_id))
+        elif len(left) < len(steps):
+            print("Resuming run {} with {} of {} forced steps left".format(run_id, len(left), len(steps)))
+        return run_id, left
+
+    succeeded = state.succeeded(run_id) if run_id is not None else {}
+    steps, stale = plan_steps(pipeline, hashes, succeeded,
+        stages["from"], stages["only"])
+
+    if run_id is None or stale:
+        if stale:
+            print("Inputs changed since run {} started, starting over".format(run_id))
+        run_id = (prefix or "") + time.strftime("%Y%m%dT%H%M%S")
+    elif len(steps) < len(pipeline):
+        print("Resuming run {} with {} of {} steps left".format(run_id,
+            len(steps), len(pipeline)))
+    return run_id, steps
+
+def finish_forced(state, run_id):
+    '''
+    Closes a run of forced steps once they all succeeded. One with a
+    failed step stays open, so forcing the steps again retries just those.
+    '''
+    if run_id.startswith(FORCED_RUN_PREFIX):
+        state.complete(run_id)
+
+def close_failed(state, run_id, validate):
+    '''
+    Runs the quality checks at the end of a run whose steps all succeeded.
+    A breach closes the run as failed: resuming it would find nothing left
+    to execute and fail the checks again, so the next invocation starts a
+    fresh load instead.
+    '''
+    try:
+        validate()
+    except QualityError:
+        state.fail(run_id)
+        print("Run {} failed the quality checks and is closed, the next run loads from the start".format(
+            run_id))
+        raise
+
+def publish_tables(pool, run_id, keep, thresholds, report):
+    pair = pool.acquire()
+    conn, cur = pair
+    try:
+        print("Validating shadow tables")
+        counts = validate_shadows(cur)
+        if thresholds is not None:
+            check_quality(cur, thresholds, report, shadow=True)
+        conn.commit()
+        print("Publishing {}".format(", ".join("{} ({} rows)".format(t, c)
+            for t, c in counts.items())))
+        swap_tables(cur, conn, run_id, keep)
+    finally:
+        pool.release(pair)
+
+def run_full_load(config, pool, options, load, report):
+    concurrency = options["concurrency"]
+    s3 = s3_client(config)
+    state = RunState(pool)
+    try:
+        pipeline = load["queries"].steps(publish=options["publish"])
+        listings = dict((source.copy_step, list_objects(s3, source.prefix))
+            for source in load["sources"])
+        hashes = input_hashes(pipeline, dict((step, listing_hash(objects))
+            for step, objects in listings.items()))
+
+        run_id, steps = plan_run(state, pipeline, hashes, options["stages"])
+        report.runId = run_id
+        if len(steps) > 0:
+            if load["compression"] is not None or load["filter_events"]:
+                print("Preparing source files for COPY")
+                steps = coalesce_sources(s3, steps, listings, run_id, load, report)
+
+            print("Running the ETL with up to {} concurrent steps".format(concurrency))
+            run_steps(steps, pool, concurrency, run=quarantine_runner(state.runner(run_id, hashes),
+                s3, listings, run_id, load, report))
+        finish_forced(state, run_id)
+
+        # a run whose tables fail the quality checks is closed as failed; the
+        # shadows of a publishing run are not swapped in
+        if set(step.name for step in pipeline) <= set(state.succeeded(run_id)):
+            if options["publish"]:
+                close_failed(state, run_id, lambda: publish_tables(pool, run_id,
+                    config.getint("ETL","keep_versions", fallback=2), quality_thresholds(config), report))
+            else:
+                close_failed(state, run_id, lambda: validate_tables(pool, quality_thresholds(config),
+                    report))
+            state.complete(run_id)
+            if options["export_to"] is not None:
+                run_export(pool, *options["export_to"], concurrency, report)
+    except Exception as e:
+        print(e)
+
+def run_backfill(config, queries, pool, options, report):
+    '''
+    Reloads a range of months of the event log: the month partitions are
+    COPYed concurrently over the connection pool and checkpointed one by
+    one, so running the same range again after a failure only retries
+    the partitions that did not load
+    '''
+    concurrency = options["concurrency"]
+    s3 = s3_client(config)
+    state = RunState(pool)
+    try:
+        listings = {}
+        months = []
+        for year, month in options["backfill"]:
+            prefix = partition_prefix(queries.value("log_data"), year, month)
+            objects = list_objects(s3, prefix)
+            if len(objects) == 0:
+                print("No event logs under {}, skipping".format(prefix))
+                continue
+            listings[copy_step_name(year, month)] = objects
+            months.append((year, month))
+        if len(months) == 0:
+            return
+        listings["copy_staging_songs"] = list_objects(s3, queries.value("song_data"))
+
+        pipeline = backfill_steps(queries, months)
+        hashes = input_hashes(pipeline, dict((step, listing_hash(objects))
+            for step, objects in listings.items()))
+        run_id, steps = plan_run(state, pipeline, hashes, {"from": None, "only": []},
+            prefix=run_prefix(months))
+        report.runId = run_id
+
+        try:
+            print("Backfilling {} partitions with up to {} concurrent steps".format(
+                len(months), concurrency))
+            run_steps(steps, pool, concurrency, run=state.runner(run_id, hashes))
+        finally:
+            succeeded = state.succeeded(run_id)
+            for year, month in months:
+                name = copy_step_name(year, month)
+                status = "succeeded" if name in succeeded else "not loaded"
+                print("{:04d}/{:02d}: {} files, {}".format(year, month, len(listings[name]), status))
+                report.addSection("partitions", "{:04d}/{:02d}".format(year, month),
+                    {"files": len(listings[name]), "status": status})
+
+        close_failed(state, run_id, lambda: validate_tables(pool, quality_thresholds(config), report))
+        state.complete(run_id)
+        if options["export_to"] is not None:
+            run_export(pool, *options["export_to"], concurrency, report)
+    except Exception as e:
+        print(e)
+
+def local_execute(loaders, report):
+    '''
+    Returns an execute(cur, step) for RunState.runner that bulk loads the
+    local source files in place of the S3 COPY steps and records each load
+    in the report
+    '''
+    def execute(cur, step):
+        if step.name not in loaders:
+            return execute_query(cur, step)
+        started_at = datetime.datetime.utcnow()
+        started = time.perf_counter()
+        rows, loaded = loaders[step.name](cur)
+        seconds = round(time.perf_counter() - started, 3)
+        record = {"step": step.name, "statement": "copy", "started_at": started_at.isoformat() + "Z",
+            "seconds": seconds, "status": "succeeded", "rows": rows, "bytes": loaded}
+        if seconds > 0:
+            record["rows_per_s"] = round(rows / seconds, 1)
+            record["mb_per_s"] = round(loaded / 1e6 / seconds, 2)
+        report.add(record)
+        return rows
+    return execute
+
+def run_local(config, queries, options, report):
+    '''
+    Runs a full load on a local engine (see backends.py) from the source
+    files under data_dir in the LOCAL section of the config file. Runs are
+    checkpointed and resumed like on Redshift.
+    '''
+    try:
+        backend = local_backend(config, options["backend"], queries.schema)
+        exportTo = export_target(config, queries, backend) if options["export"] else None
+    except Exception as e:
+        print(e)
+        return
+
+    # COPY statistics come from Redshift's system tables; locally the only
+    # COPYs are those the DuckDB export writes Parquet with
+    report.copyMetrics = False
+
+    def connect():
+        conn, cur = backend.connect()
+        return conn, InstrumentedCursor(cur, report)
+
+    concurrency = min(options["concurrency"], backend.maxConcurrency or options["concurrency"])
+    pool = ConnectionPool(connect, concurrency)
+    try:
+        pair = pool.acquire("prepare")
+        conn, cur = pair
+        create_control_tables(cur, conn, queries)
+        pool.release(pair)
+
+        dataDir = config.get("LOCAL","data_dir")
+        pipeline = queries.steps(replaced=backend.loaders)
+        state = RunState(pool)
+        hashes = input_hashes(pipeline, dict((step, listing_hash(local_listing(os.path.join(dataDir, directory))))
+            for step, directory in LOCAL_SOURCES.items()))
+        run_id, steps = plan_run(state, pipeline, hashes, options["stages"])
+        report.runId = run_id
+        if len(steps) > 0:
+            print("Running the ETL on {} with up to {} concurrent steps".format(backend.name, concurrency))
+            run_steps(steps, pool, concurrency,
+                run=state.runner(run_id, hashes, execute=local_execute(backend.loaders, report)))
+        finish_forced(state, run_id)
+
+        if set(step.name for step in pipeline) <= set(state.succeeded(run_id)):
+            close_failed(state, run_id, lambda: validate_tables(pool, quality_thresholds(config),
+                report))
+            state.complete(run_id)
+            if exportTo is not None:
+                run_export(pool, *exportTo, concurrency, report)
+    except Exception as e:
+        print(e)
+    finally:
+        pool.closeAll()
 
+def run_rollback(cur, conn):
+    try:
+        print("Rolling back the final tables")
+        restored = rollback(cur, conn)
+        for table, version in restored.items():
+            print("{} restored from {}".format(table, version))
+    except Exception as e:
+        print(e)
+
+def run_etl(config, queries, options, report):
     host        = config.get("DWH","dwh_endpoint")
     user        = config.get("DWH","dwh_db_user")
     password    = config.get("DWH","dwh_db_password")
     port        = config.get("DWH","dwh_db_port")
     dbname      = config.get("DWH","dwh_db")
-    schema      = config.get("DWH","dwh_schema")
-
-    # Initial connection
-    conn, cur = connect_to_db(host,dbname,user,password,port)
+    schema      = queries.schema
 
-    # Create and select schema
+    # Every stage of the run draws its sessions from one pool; each session
+    # sets its search_path once and is switched to the query group and
+    # statement timeout of the stage it is acquired for
+    pool = ConnectionPool(lambda: connect_to_db(host, dbname, user, password, port,
+        schema=schema, report=report, options=connection_options(config)),
+        options["concurrency"], lambda stage: stage_settings(config, stage))
     try:
-        print("Creating data warehouse schema")
-        create_schema(cur,conn)
-        conn.close()
+        run_stages(config, queries, pool, options, report)
+    finally:
+        pool.closeAll()
 
-        conn, cur = connect_to_db(host, dbname,user, password, port, schema=schema)
+def run_stages(config, queries, pool, options, report):
+    # Where the export stage writes, checked before anything is loaded
+    try:
+        options = dict(options, export_to=export_target(config, queries) if options["export"] else None)
     except Exception as e:
         print(e)
         return
-    
+
+    # Create the schema and the control tables; the search_path the session
+    # was opened with takes effect once the schema exists
     try:
-        print("Preparing database for ETL")
-        prepare_database(cur,conn)
+        pair = pool.acquire("prepare")
+        conn, cur = pair
+        print("Creating data warehouse schema")
+        create_schema(cur, conn, queries)
+        create_control_tables(cur, conn, queries)
     except Exception as e:
         print(e)
         return
     
+    if options["rollback"]:
+        run_rollback(cur, conn)
+        return
+
+    if options["backfill"] is not None:
+        pool.release(pair)
+        run_backfill(config, queries, pool, options, report)
+        return
+
+    compression = options["compression"]
     try:
-        print("Loading staging tables")
-        load_staging_tables(cur, conn)
+        copies = sources(queries)
     except Exception as e:
         print(e)
         return
-    
+    load = {"queries": queries, "sources": copies, "compression": compression, "slices": None,
+        "chunk_bytes": config.getint("ETL","chunk_mb", fallback=128) * 1024 * 1024,
+        "filter_events": options["filter_events"],
+        "workers": config.getint("ETL","preprocess_workers", fallback=None),
+        "client_spec": client_spec(config), "staged": {}}
+    if compression is not None or options["filter_events"]:
+        if queries.value("manifest_prefix") is None:
+            print("Coalescing and filtering need MANIFEST_PREFIX in the S3 section of the config file")
+            return
+        try:
+            load["slices"] = get_slice_count(cur, config, queries)
+        except Exception as e:
+            print(e)
+            return
+
+    if options["incremental"]:
+        loaded = run_incremental(config, pool, pair, load, report)
+        pool.release(pair)
+        if loaded and options["export_to"] is not None:
+            try:
+                run_export(pool, *options["export_to"], options["concurrency"], report)
+            except Exception as e:
+                print(e)
+        return
+
+    if options["retry"] is not None:
+        run_retry(config, pool, pair, options["retry"], load, report)
+        return
+
+    if options["single_transaction"]:
+        run_single_transaction(pool, pair, queries, quality_thresholds(config), report)
+        return
+
+    pool.release(pair)
+    run_full_load(config, pool, options, load, report)
+
+def schema_path(path, schema, schemas):
+    '''
+    Names the report of one schema when a run loads several, e.g.
+    report.json becomes report_<schema>.json
+    '''
+    if path is None or schemas == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return "{}_{}{}".format(root, schema, ext)
+
+def write_reports(report, report_path, prometheus_path):
     try:
-        print("Copying tables")
-        insert_tables(cur, conn)
+        if report_path is not None:
+            report.write(report_path)
+            print("Run report written to {}".format(report_path))
+        if prometheus_path is not None:
+            report.writePrometheus(prometheus_path)
     except Exception as e:
         print(e)
+
+def usage(program_name):
+    print(('{} {} {} {} {} {}').format(program_name,'[-i | --incremental]','[-p <n> | --parallel=<n>]',
+        '[-z gzip|zstd | --compress=gzip|zstd]','[--from-stage=<stage> | --only-stage=<stage> ...]',
+        '[--report=<file.json|file.ndjson>] [--prometheus=<file.prom>] [--publish | --rollback]'
+        ' [--filter-events] [--backfill=YYYY-MM[:YYYY-MM]] [--retry=<run id>]'
+        ' [-t | --single-transaction] [--backend=redshift|postgres|duckdb] [--schema=<schema> ...]'
+        ' [--export]'))
+    print("use the -i flag to load only the S3 objects that arrived since the last run")
+    print("use the -p flag to set how many steps may run at once (default: MAX_CONCURRENCY in the ETL section, or 4)")
+    print("use the -z flag to coalesce the source files into compressed, slice-balanced chunks before COPY")
+    print("use --from-stage to rerun a full load from a step or group of steps ({}) onwards".format(
+        ", ".join(sorted(pipeline_steps()[1]))))
+    print("use --only-stage, once per stage, to rerun just those steps or groups")
+    print("use --report and --prometheus to write per-statement timings and load metrics")
+    print("use --publish to build the final tables under shadow names and swap them in at once")
+    print("use --rollback to put back the previous version of the final tables")
+    print("use --filter-events to load only the event columns the star schema uses")
+    print("use --backfill to reload the event log of a month or range of months, partition by partition")
+    print("use --retry to load the files a failed COPY of that run quarantined")
+    print("use the -t flag to run a full load on one session with temp staging tables and a single commit")
+    print("use --backend=postgres or --backend=duckdb to run a full load locally from the files under data_dir")
+    print("use --export to write the partitions of the final tables that changed to Parquet after the load")
+    print("use --schema, once per schema, to run the same load into each of them in turn instead of dwh_schema")
+
+def main(argv):
+    incremental = False
+    concurrency = None
+    compression = None
+    from_stage = None
+    only_stages = []
+    report_path = None
+    prometheus_path = None
+    publish = False
+    restore = False
+    filter_events = False
+    backfill = None
+    retry = None
+    single_transaction = False
+    backend = "redshift"
+    schemas = []
+    export = False
+
+    try:
+        program_name = argv[0]
+        opts, _ = getopt.getopt(argv[1:],"ip:z:t",["incremental","parallel=","compress=",
+            "from-stage=","only-stage=","report=","prometheus=","publish","rollback",
+            "filter-events","backfill=","retry=","single-transaction","backend=","schema=","export"])
+        for k, v in opts:
+            if k in ('-i', '--incremental'):
+                incremental = True
+            if k in ('-p', '--parallel'):
+                concurrency = int(v)
+            if k in ('-z', '--compress'):
+                if v not in COMPRESSION_OPTIONS:
+                    raise ValueError(v)
+                compression = v
+            if k == '--from-stage':
+                from_stage = v
+            if k == '--only-stage':
+                only_stages.append(v)
+            if k == '--report':
+                report_path = v
+            if k == '--prometheus':
+                prometheus_path = v
+            if k == '--publish':
+                publish = True
+            if k == '--rollback':
+                restore = True
+            if k == '--filter-events':
+                filter_events = True
+            if k == '--backfill':
+                backfill = parse_range(v)
+            if k == '--retry':
+                retry = v
+            if k in ('-t', '--single-transaction'):
+                single_transaction = True
+            if k == '--backend':
+                if v not in BACKENDS:
+                    raise ValueError(v)
+                backend = v
+            if k == '--schema':
+                schemas.append(v)
+            if k == '--export':
+                export = True
+
+        pipeline, groups = pipeline_steps(publish)
+
+        stages = {"from": None, "only": resolve_stages(only_stages, pipeline, groups)}
+        if from_stage is not None:
+            stages["from"] = resolve_stages([from_stage], pipeline, groups)[0]
+        if (stages["from"] or stages["only"] or publish) and incremental:
+            raise ValueError("stages and --publish only apply to full loads")
+        if backfill is not None and (incremental or publish or stages["from"] or stages["only"]
+                or compression or filter_events):
+            raise ValueError("--backfill runs on its own")
+        if retry is not None and (incremental or publish or stages["from"] or stages["only"]
+                or backfill is not None):
+            raise ValueError("--retry runs on its own")
+        if single_transaction and (incremental or publish or stages["from"] or stages["only"]
+                or backfill is not None or retry is not None or compression or filter_events):
+            raise ValueError("-t runs on its own")
+        if backend != "redshift" and (incremental or publish or restore or backfill is not None
+                or retry is not None or single_transaction or compression or filter_events):
+            raise ValueError("local backends only run full loads")
+        if export and (single_transaction or retry is not None or restore):
+            raise ValueError("--export follows full loads, incremental loads and backfills")
+    except (getopt.GetoptError, ValueError) as e:
+        print(e)
+        usage(program_name)
         return
-    
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    if concurrency is None:
+        concurrency = config.getint("ETL","max_concurrency", fallback=4)
+    if concurrency < 1:
+        usage(program_name)
+        return
+
+    if report_path is None:
+        report_path = config.get("ETL","report", fallback=None)
+    if prometheus_path is None:
+        prometheus_path = config.get("ETL","prometheus_report", fallback=None)
+
+    options = {
+        "incremental": incremental,
+        "concurrency": concurrency,
+        "compression": compression,
+        "stages": stages,
+        "publish": publish,
+        "rollback": restore,
+        "filter_events": filter_events,
+        "backfill": backfill,
+        "retry": retry,
+        "single_transaction": single_transaction,
+        "backend": backend,
+        "export": export
+    }
+
+    # One registry per schema; the statements are rendered once per schema
+    # and environment however many runs the process makes
     try:
-        print("Dropping staging tables")
-        drop_staging_tables(cur, conn)
-    except Exception as e:
+        registries = [QueryRegistry(config, schema=schema) for schema in schemas or [None]]
+    except ValueError as e:
         print(e)
         return
-    
 
-    conn.close()
+    for queries in registries:
+        if len(registries) > 1:
+            print("Loading schema {}".format(queries.schema))
+        report = RunReport(copyMetrics=config.getboolean("ETL","copy_metrics", fallback=True))
+        try:
+            if backend == "redshift":
+                run_etl(config, queries, options, report)
+            else:
+                run_local(config, queries, options, report)
+        finally:
+            write_reports(report, schema_path(report_path, queries.schema, len(registries)),
+                schema_path(prometheus_path, queries.schema, len(registries)))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(sys.argv)
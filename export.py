@@ -0,0 +1,225 @@
+import json
+import os
+import shutil
+from collections import namedtuple
+from sql_queries import Step, export_tables, export_partition_columns, export_row_column
+from sql_queries import export_fingerprint, export_table_fingerprint, export_partition_select
+from sql_queries import export_table_select, export_state_select, export_state_delete
+from sql_queries import export_state_insert
+from partitions import next_month
+from query_registry import quote_literal
+from s3_manifest import read_manifest, write_manifest, delete_objects
+
+# Size the Parquet files are cut at, in MB; UNLOAD accepts 5 MB to 6.2 GB
+MAX_FILE_MB = 256
+FILE_MB_RANGE = (5, 6200)
+
+# Where an export goes: the S3 prefix or directory it writes under, how a
+# partition's query is written there (unload(select, path, maxFileMb)
+# returns the statement), how manifests are read and written, how the
+# files of a partition are removed, and whether the statement leaves the
+# partition manifest to be written afterwards, as the local engines do
+ExportTarget = namedtuple("ExportTarget", ["prefix", "unload", "readManifest", "writeManifest",
+    "remove", "local"])
+
+
+def export_options(config):
+    '''
+    Reads the EXPORT section of the config file: prefix, the
+    s3://bucket/prefix UNLOAD writes under, local_dir, the directory local
+    backends write under, and max_file_mb
+
+    Returns:
+        dict with prefix, local_dir and max_file_mb
+    '''
+    options = {
+        "prefix": config.get("EXPORT","prefix", fallback=None),
+        "local_dir": config.get("EXPORT","local_dir", fallback=None),
+        "max_file_mb": config.getint("EXPORT","max_file_mb", fallback=MAX_FILE_MB)
+    }
+    if not FILE_MB_RANGE[0] <= options["max_file_mb"] <= FILE_MB_RANGE[1]:
+        raise ValueError("max_file_mb in the EXPORT section has to be between {} and {}".format(
+            *FILE_MB_RANGE))
+    return options
+
+
+def s3_target(s3, prefix, unloadQuery):
+    '''
+    Returns the target of Redshift exports: UNLOADs to an S3 prefix
+
+    Args:
+        s3: boto3 S3 client
+        unloadQuery: str
+            sql_queries.export_unload rendered with the IAM role
+    '''
+    return ExportTarget(prefix,
+        lambda select, path, maxFileMb: unloadQuery.format(select=quote_literal(select),
+            path=quote_literal(path), max_file_mb=maxFileMb),
+        lambda url: read_manifest(s3, url),
+        lambda url, manifest: write_manifest(s3, url, manifest),
+        lambda url: delete_objects(s3, url),
+        False)
+
+
+def directory_target(directory, unload):
+    '''
+    Returns the target of local exports: the same layout under a directory
+
+    Args:
+        unload: callable
+            the backend's unload, see backends.Backend
+    '''
+    def readManifest(path):
+        with open(path) as f:
+            return json.load(f)
+
+    def writeManifest(path, manifest):
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        return path
+
+    return ExportTarget(os.path.abspath(directory), unload, readManifest, writeManifest,
+        lambda path: shutil.rmtree(path, ignore_errors=True), True)
+
+
+def partition_path(prefix, table, year, month):
+    '''
+    Returns the folder of a partition, <prefix>/<table>/year=YYYY/month=MM/,
+    or <prefix>/<table>/ for a table exported whole (year 0)
+    '''
+    if year == 0:
+        return "{}/{}/".format(prefix.rstrip("/"), table)
+    return "{}/{}/year={:04d}/month={:02d}/".format(prefix.rstrip("/"), table, year, month)
+
+
+def partition_name(table, year, month):
+    return table if year == 0 else "{}_{:04d}_{:02d}".format(table, year, month)
+
+
+def fingerprints(cur):
+    '''
+    Fingerprints every partition of the exported tables, with one
+    aggregating scan per table
+
+    Returns:
+        dict of (table, year, month) -> (row count, checksum); year and
+        month are 0 for tables exported whole
+    '''
+    current = {}
+    for table, column, columns in export_tables:
+        row = " || '|' || ".join(export_row_column.format(c) for c in columns)
+        if column is None:
+            cur.execute(export_table_fingerprint.format(table=table, row=row))
+        else:
+            cur.execute(export_fingerprint.format(table=table, column=column, row=row))
+        for year, month, rows, checksum in cur.fetchall():
+            if rows:
+                current[(table, int(year), int(month))] = (int(rows), int(checksum or 0))
+    return current
+
+
+def exported_partitions(cur):
+    '''
+    Returns the fingerprints recorded by earlier exports, keyed like fingerprints
+    '''
+    cur.execute(export_state_select)
+    return dict(((table, year, month), (rows, checksum))
+        for table, year, month, rows, checksum in cur.fetchall())
+
+
+def plan_export(current, previous):
+    '''
+    Compares the partitions of the tables with those last exported
+
+    Returns:
+        (partitions that are new or changed, partitions no longer in the tables)
+    '''
+    changed = sorted(key for key, fingerprint in current.items() if previous.get(key) != fingerprint)
+    removed = sorted(key for key in previous if key not in current)
+    return changed, removed
+
+
+def partition_query(table, year, month):
+    '''
+    Returns the query selecting the rows of a partition, without the
+    columns the partition folders stand for
+    '''
+    column, columns = dict((t, (c, cols)) for t, c, cols in export_tables)[table]
+    if column is None:
+        return export_table_select.format(columns=",".join(columns), table=table)
+    columns = [c for c in columns if c not in export_partition_columns]
+    return export_partition_select.format(columns=",".join(columns), table=table, column=column,
+        start="{:04d}-{:02d}-01".format(year, month),
+        end="{:04d}-{:02d}-01".format(*next_month(year, month)))
+
+
+def export_steps(partitions, target, maxFileMb):
+    '''
+    Builds one step per partition writing it to its folder; the steps only
+    read, so all of them may run at once
+
+    Returns:
+        list of sql_queries.Step of the "export" stage
+    '''
+    return [Step("export_" + partition_name(table, year, month),
+        target.unload(partition_query(table, year, month),
+            partition_path(target.prefix, table, year, month), maxFileMb),
+        (table,), ("export_" + partition_name(table, year, month),), "export")
+        for table, year, month in partitions]
+
+
+def prepare_directories(target, partitions):
+    '''
+    Local exports: empties the folders of the partitions about to be
+    written and creates their parents, like UNLOAD's cleanpath
+    '''
+    for table, year, month in partitions:
+        path = partition_path(target.prefix, table, year, month)
+        target.remove(path)
+        os.makedirs(os.path.dirname(path.rstrip("/")), exist_ok=True)
+
+
+def write_directory_manifests(target, partitions, current):
+    '''
+    Local exports: writes the manifest UNLOAD would have written into each
+    exported folder
+    '''
+    for table, year, month in partitions:
+        path = partition_path(target.prefix, table, year, month)
+        files = sorted(name for name in os.listdir(path) if name.endswith(".parquet"))
+        target.writeManifest(os.path.join(path, "manifest"), {
+            "entries": [{"url": os.path.join(path, name),
+                "meta": {"content_length": os.path.getsize(os.path.join(path, name))}}
+                for name in files],
+            "meta": {"content_length": sum(os.path.getsize(os.path.join(path, name)) for name in files),
+                "record_count": current[(table, year, month)][0]}})
+
+
+def write_table_manifests(target, current, removed):
+    '''
+    Writes <prefix>/<table>/manifest listing the files of every current
+    partition of each partitioned table, so readers get the whole table
+    from one file; a table whose last partition was removed gets an empty one
+    '''
+    tables = dict((table, []) for table, year, month in removed if year != 0)
+    for table, year, month in sorted(current):
+        if year != 0:
+            tables.setdefault(table, []).append((year, month))
+    for table, partitions in sorted(tables.items()):
+        entries = []
+        for year, month in partitions:
+            entries += target.readManifest(partition_path(target.prefix, table, year, month)
+                + "manifest")["entries"]
+        target.writeManifest(partition_path(target.prefix, table, 0, 0) + "manifest",
+            {"entries": entries})
+
+
+def record_export(cur, changed, removed, current):
+    '''
+    Stores the fingerprints of the exported partitions and forgets the
+    removed ones
+    '''
+    for key in changed + removed:
+        cur.execute(export_state_delete, key)
+    for key in changed:
+        cur.execute(export_state_insert, key + current[key])
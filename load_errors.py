@@ -0,0 +1,87 @@
+from sql_queries import load_errors_select, db_time_select
+from s3_manifest import build_manifest, write_manifest, split_s3_url
+
+# Line numbers kept per file in the report; the error count covers all
+MAX_LINES_PER_FILE = 20
+
+
+def db_time(cur):
+    '''
+    Returns the database clock, which stl_load_errors start times compare to
+    '''
+    cur.execute(db_time_select)
+    return cur.fetchone()[0]
+
+
+def load_errors(cur, since, prefix):
+    '''
+    Reads the lines rejected by COPYs of the files under an S3 prefix
+
+    Args:
+        since: datetime
+            database time before the COPYs started, see db_time
+        prefix: str
+            s3://bucket/prefix the COPYs read from
+    Returns:
+        list of (file, line, column, error code, reason)
+    '''
+    cur.execute(load_errors_select, (since, prefix.rstrip("/") + "/%"))
+    return cur.fetchall()
+
+
+def summarize_errors(rows):
+    '''
+    Groups rejected lines per file
+
+    Returns:
+        dict of file url -> errors, first line numbers, error count per
+        column and reason per error code
+    '''
+    files = {}
+    for filename, line, column, code, reason in rows:
+        summary = files.setdefault(filename, {"errors": 0, "lines": [], "columns": {}, "reasons": {}})
+        summary["errors"] += 1
+        if len(summary["lines"]) < MAX_LINES_PER_FILE:
+            summary["lines"].append(line)
+        summary["columns"][column] = summary["columns"].get(column, 0) + 1
+        summary["reasons"][str(code)] = reason
+    return files
+
+
+def retry_manifest_url(manifestPrefix, run_id, source):
+    return "{}/retry/{}/{}.manifest".format(manifestPrefix.rstrip("/"), run_id, source)
+
+
+def quarantine(s3, objects, files, manifestUrl, previous=()):
+    '''
+    Moves the objects that failed to load into a retry manifest
+
+    Args:
+        s3: boto3 S3 client
+        objects: list of dicts as returned by s3_manifest.list_objects
+        files: iterable of the file urls that failed
+        manifestUrl: str
+            s3://bucket/key of the retry manifest
+        previous: list of objects
+            quarantined by earlier attempts of the same COPY, kept in the manifest
+    Returns:
+        (objects left to load, quarantined objects)
+    '''
+    failed = set(files)
+    quarantined = [o for o in objects if "s3://{}/{}".format(o["Bucket"], o["Key"]) in failed]
+    remaining = [o for o in objects if "s3://{}/{}".format(o["Bucket"], o["Key"]) not in failed]
+    if len(quarantined) > 0:
+        write_manifest(s3, manifestUrl, build_manifest(list(previous) + quarantined))
+    return remaining, quarantined
+
+
+def manifest_objects(manifest):
+    '''
+    Turns the entries of a COPY manifest back into S3 object listings
+    '''
+    objects = []
+    for entry in manifest["entries"]:
+        bucket, key = split_s3_url(entry["url"])
+        objects.append({"Bucket": bucket, "Key": key,
+            "Size": entry.get("meta", {}).get("content_length", 0)})
+    return objects
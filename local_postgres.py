@@ -0,0 +1,140 @@
+import csv
+import datetime
+import io
+import json
+import os
+import re
+
+# Redshift-only clauses dropped, and functions rewritten, when running the
+# same SQL on PostgreSQL
+REDSHIFT_ONLY = [
+    (re.compile(r"\bdiststyle\s+(all|even|key|auto)\b", re.IGNORECASE), ""),
+    (re.compile(r"\b(compound\s+|interleaved\s+)?sortkey\s*\([^)]*\)", re.IGNORECASE), ""),
+    (re.compile(r"\bdistkey\s*\([^)]*\)", re.IGNORECASE), ""),
+    (re.compile(r"\b(sortkey|distkey)\b", re.IGNORECASE), ""),
+    (re.compile(r"\bencode\s+\w+", re.IGNORECASE), ""),
+    (re.compile(r"\bgetdate\(\)", re.IGNORECASE), "now()"),
+    (re.compile(r"\bstrtol\(substring\(md5\((.*?)\), 1, 7\), 16\)", re.IGNORECASE | re.DOTALL),
+        r"('x' || substring(md5(\1), 1, 7))::bit(28)::int")
+]
+
+STAGING_SONGS_COLUMNS = ["num_songs", "artist_id", "artist_name", "artist_longitude",
+    "artist_latitude", "artist_location", "song_id", "title", "duration", "year"]
+
+# staging_events columns COPY reads as epoch milliseconds
+EPOCH_MILLIS_COLUMNS = ("registration", "ts")
+
+
+def to_postgres(query):
+    '''
+    Rewrites a statement from sql_queries.py so it runs on PostgreSQL
+    '''
+    for pattern, replacement in REDSHIFT_ONLY:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def read_json_records(path):
+    '''
+    Yields the JSON objects of a file holding one or more of them, either
+    newline-delimited or simply concatenated, as COPY ... json accepts
+    '''
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        text = f.read()
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position >= len(text):
+            return
+        record, position = decoder.raw_decode(text, position)
+        yield record
+
+
+def json_files(directory):
+    '''
+    Lists the .json files under a directory, in key order
+    '''
+    found = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(".json"):
+                found.append(os.path.join(dirpath, filename))
+    return sorted(found)
+
+
+def jsonpaths_fields(path):
+    '''
+    Reads a jsonpaths file of $['field'] expressions into field names
+    '''
+    with open(path) as f:
+        return [re.match(r"\$\['(.+)'\]$", p).group(1) for p in json.load(f)["jsonpaths"]]
+
+
+def from_epoch_millis(value):
+    if value is None or value == "":
+        return None
+    return datetime.datetime.utcfromtimestamp(float(value) / 1000.0).isoformat()
+
+
+def event_rows(files, fields):
+    '''
+    Yields staging_events rows from event log files the way COPY with a
+    jsonpaths file and timeformat 'epochmillisecs' maps them
+    '''
+    for path in files:
+        for record in read_json_records(path):
+            row = []
+            for field in fields:
+                value = record.get(field)
+                if field in EPOCH_MILLIS_COLUMNS:
+                    value = from_epoch_millis(value)
+                row.append(value)
+            yield row
+
+
+def song_rows(files):
+    '''
+    Yields staging_songs rows from song files the way COPY json 'auto' maps
+    them, by column name
+    '''
+    for path in files:
+        for record in read_json_records(path):
+            yield [record.get(column) for column in STAGING_SONGS_COLUMNS]
+
+
+def copy_rows(cur, table, columns, rows):
+    '''
+    Bulk loads rows into a table through COPY ... FROM STDIN
+
+    Returns:
+        (rows loaded, bytes sent)
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    count = 0
+    for row in rows:
+        writer.writerow(["" if v is None or v == "" else v for v in row])
+        count += 1
+    size = buffer.tell()
+    buffer.seek(0)
+    cur.copy_expert("copy {} ({}) from stdin with csv".format(table, ",".join(columns)), buffer)
+    return count, size
+
+
+def local_loaders(dataDir):
+    '''
+    Returns the loaders replacing the two S3 COPY steps with bulk loads from
+    a local directory laid out like the S3 sources (see data_generator.py)
+
+    Returns:
+        dict of step name -> loader(cur) returning (rows, bytes)
+    '''
+    fields = jsonpaths_fields(os.path.join(dataDir, "log_json_path.json"))
+    return {
+        "copy_staging_events": lambda cur: copy_rows(cur, "staging_events", fields,
+            event_rows(json_files(os.path.join(dataDir, "log_data")), fields)),
+        "copy_staging_songs": lambda cur: copy_rows(cur, "staging_songs", STAGING_SONGS_COLUMNS,
+            song_rows(json_files(os.path.join(dataDir, "song_data"))))
+    }
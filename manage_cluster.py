@@ -0,0 +1,139 @@
+import configparser
+import getopt
+import subprocess
+import sys
+from redshift_cluster_generator import RedshiftClusterGenerator
+from cluster_sizing import source_volume, recommend_size, sizing_options
+from s3_manifest import s3_client
+
+COMMANDS = ["size", "resume", "pause", "resize", "window"]
+
+
+def recommend(config, budgetMinutes):
+    '''
+    Measures the configured S3 sources and recommends a cluster size for
+    loading them within the budget
+    '''
+    urls = [config.get("S3","LOG_DATA"), config.get("S3","SONG_DATA")]
+    volume = source_volume(s3_client(config), urls)
+    for url, source in volume["sources"].items():
+        print("{}: {} objects, {:.1f} MB".format(url, source["objects"], source["bytes"] / 1e6))
+    recommendation = recommend_size(volume, budgetMinutes * 60, **sizing_options(config))
+    print("Recommended {} {} nodes: COPY estimated at {} s{}, {} $/h, {} $ per load".format(
+        recommendation["nodes"], recommendation["node_type"], recommendation["load_seconds"],
+        "" if recommendation["meets_budget"] else " (over the {} minute budget)".format(budgetMinutes),
+        recommendation["hourly_price"], recommendation["load_cost"]))
+    return recommendation
+
+
+def run_window(cluster_gen, config, budgetMinutes, apply, keep, command):
+    '''
+    Runs a command, e.g. etl.py, with the cluster up: resumes the cluster,
+    optionally resizes it to the recommendation for the current data
+    volume, runs the command, then resizes it back and pauses it
+
+    Returns:
+        the exit code of the command
+    '''
+    previous = None
+    try:
+        cluster_gen.startCluster()
+        if apply:
+            recommendation = recommend(config, budgetMinutes)
+            previous = cluster_gen.resizeCluster(recommendation["node_type"], recommendation["nodes"])
+        print("Running {}".format(" ".join(command)))
+        return subprocess.call(command)
+    finally:
+        # the cluster is paused even when sizing it or resizing it back fails
+        try:
+            if previous is not None:
+                cluster_gen.resizeCluster(*previous)
+        finally:
+            if not keep:
+                cluster_gen.pauseCluster()
+
+
+def usage(program_name):
+    print(('{} {} {} {}').format(program_name, '-c <config file>', '[-b <minutes>] [-a] [-k]',
+        '[-t <node type> -n <nodes>] size|resume|pause|resize|window [<command>...]'))
+    print("size: list LOG_DATA and SONG_DATA and recommend the node type and count that COPY them")
+    print("      within the -b budget (default 30 minutes); -a resizes the cluster to it, or sets")
+    print("      DWH_NODE_TYPE, DWH_NUM_NODES and DWH_CLUSTER_TYPE in the config file when there is no cluster yet")
+    print("resume / pause: resume the cluster before a load, pause it afterwards")
+    print("resize: change the cluster to -n nodes of type -t")
+    print("window: resume, resize to the recommendation with -a, run the command, resize back and")
+    print("        pause unless -k is given, e.g. {} -c dwh.cfg -a window python etl.py".format(program_name))
+
+
+def main(argv):
+    config_file = "dwh.cfg"
+    budgetMinutes = 30.0
+    apply = False
+    keep = False
+    nodeType = None
+    numNodes = None
+
+    try:
+        program_name = argv[0]
+        opts, args = getopt.getopt(argv[1:], "c:b:akt:n:")
+        for k, v in opts:
+            if k == '-c':
+                config_file = v
+            if k == '-b':
+                budgetMinutes = float(v)
+            if k == '-a':
+                apply = True
+            if k == '-k':
+                keep = True
+            if k == '-t':
+                nodeType = v
+            if k == '-n':
+                numNodes = int(v)
+        if not args or args[0] not in COMMANDS:
+            raise ValueError("a command is required: {}".format(", ".join(COMMANDS)))
+        if args[0] == "resize" and (nodeType is None or numNodes is None):
+            raise ValueError("resize needs -t and -n")
+        if args[0] == "window" and len(args) < 2:
+            raise ValueError("window needs a command to run")
+    except (getopt.GetoptError, ValueError) as e:
+        print(e)
+        usage(program_name)
+        return 2
+
+    cluster_gen = RedshiftClusterGenerator(config_file, True, True)
+    if cluster_gen.configFileOK == False:
+        return 1
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    command = args[0]
+    try:
+        if command == "size":
+            recommendation = recommend(config, budgetMinutes)
+            if apply:
+                if cluster_gen.findCluster() is None:
+                    cluster_gen.saveDBConfigurations("DWH","DWH_NODE_TYPE",recommendation["node_type"],True)
+                    cluster_gen.saveDBConfigurations("DWH","DWH_NUM_NODES",str(recommendation["nodes"]),True)
+                    cluster_gen.saveDBConfigurations("DWH","DWH_CLUSTER_TYPE",
+                        "multi-node" if recommendation["nodes"] > 1 else "single-node",True)
+                    print("Config file updated for the next deploy")
+                else:
+                    cluster_gen.startCluster()
+                    cluster_gen.resizeCluster(recommendation["node_type"], recommendation["nodes"])
+        if command == "resume":
+            cluster_gen.startCluster()
+        if command == "pause":
+            cluster_gen.pauseCluster()
+        if command == "resize":
+            cluster_gen.startCluster()
+            cluster_gen.resizeCluster(nodeType, numNodes)
+        if command == "window":
+            return run_window(cluster_gen, config, budgetMinutes, apply, keep, args[1:])
+    except Exception as e:
+        print(e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,147 @@
+import datetime
+from sql_queries import Step
+
+# Run ids of backfills start with this, so a full load never resumes one
+BACKFILL_RUN_PREFIX = "backfill_"
+
+# Tables a backfill drops and rebuilds; the final tables are kept
+STAGING_TABLES = ("staging_events", "staging_songs", "staging_events_keyed", "staging_songs_keyed")
+
+
+def parse_month(value):
+    '''
+    Parses a YYYY-MM month into (year, month)
+    '''
+    try:
+        date = datetime.datetime.strptime(value, "%Y-%m")
+    except ValueError:
+        raise ValueError("Not a YYYY-MM month: {}".format(value))
+    return date.year, date.month
+
+
+def next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def parse_range(value):
+    '''
+    Expands a month range given on the command line, YYYY-MM or
+    YYYY-MM:YYYY-MM (both ends included), into its months
+
+    Returns:
+        list of (year, month)
+    '''
+    first, _, last = value.partition(":")
+    first = parse_month(first)
+    last = parse_month(last) if last else first
+    if last < first:
+        raise ValueError("Month range ends before it starts: {}".format(value))
+    months = [first]
+    while months[-1] < last:
+        months.append(next_month(*months[-1]))
+    return months
+
+
+def partition_name(year, month):
+    return "{:04d}_{:02d}".format(year, month)
+
+
+def partition_prefix(prefix, year, month):
+    '''
+    Returns the S3 prefix of one month of the event log, laid out as
+    <prefix>/YYYY/MM/
+    '''
+    return "{}/{:04d}/{:02d}/".format(prefix.rstrip("/"), year, month)
+
+
+def partition_table(year, month):
+    return "staging_events_{}".format(partition_name(year, month))
+
+
+def copy_step_name(year, month):
+    return "copy_staging_events_{}".format(partition_name(year, month))
+
+
+def run_prefix(months):
+    '''
+    Returns the run id prefix of a backfill, the same for every attempt at
+    the same range so a failed one is resumed
+    '''
+    return "{}{}_{}_".format(BACKFILL_RUN_PREFIX, partition_name(*months[0]),
+        partition_name(*months[-1]))
+
+
+def backfill_steps(queries, months):
+    '''
+    Builds the pipeline that reloads a range of months of the event log:
+    every partition is dropped, created and COPYed on its own, so the
+    COPYs run concurrently and each is checkpointed separately, then the
+    partitions are gathered into staging_events and the usual keying steps
+    run. The songplays of the range are deleted and inserted again in one
+    transaction, the dimensions merged and the time dimension appended to.
+    The aggregates are refreshed for the days of the range.
+
+    Args:
+        queries: query_registry.QueryRegistry
+            renders the steps; the event log is read from its LOG_DATA
+        months: list of (year, month)
+    Returns:
+        list of sql_queries.Step
+    '''
+    logPrefix = queries.value("log_data")
+    partitionCopy = queries.query("staging_events_partition_copy")
+    partitionDrop = queries.query("staging_events_partition_drop")
+    partitionCreate = queries.query("staging_events_partition_create")
+    partitionGather = queries.query("staging_events_partition_gather")
+    aggregateDaysDrop = queries.query("aggregate_days_drop")
+    prepare = [step for step in queries.steps("prepare") if set(step.writes) <= set(STAGING_TABLES)
+        or step.name.startswith("create_")]
+    partitions = []
+    copies = []
+    gathers = []
+    for year, month in months:
+        table = partition_table(year, month)
+        partitions += [
+            Step("drop_" + table, partitionDrop.format(table), (), (table,), "prepare"),
+            Step("create_" + table, partitionCreate.format(table),
+                ("staging_events",), (table,), "prepare")
+        ]
+        copies.append(Step(copy_step_name(year, month), partitionCopy.format(
+            table, partition_prefix(logPrefix, year, month)), (), (table,), "copy"))
+        gathers.append(Step("gather_" + table, partitionGather.format(table),
+            (table,), ("staging_events",), "copy"))
+
+    start = "{:04d}-{:02d}-01".format(*months[0])
+    end = "{:04d}-{:02d}-01".format(*next_month(*months[-1]))
+    merges = [Step("merge_" + table, ";\n".join(statements),
+        ("staging_events",) if table == "users" else ("staging_songs",), (table,), "insert")
+        for table, statements in queries.query("dimension_merges")]
+    replace = [
+        Step("replace_songplay", ";\n".join([
+            queries.query("songplay_range_delete").format(start, end),
+            queries.query("songplay_table_insert")
+            ]), ("staging_events_keyed", "staging_songs_keyed"), ("songplay",), "insert")
+    ] + merges + [
+        step for step in queries.steps("insert") if step.name == "extend_time_calendar"
+    ] + [
+        Step("append_time", queries.query("time_table_append"), ("staging_events", "time_calendar"),
+            ("time",), "insert"),
+        Step("collect_aggregate_days", ";\n".join([aggregateDaysDrop,
+            queries.query("aggregate_days_create")]), ("staging_events",), ("aggregate_days",),
+            "aggregate")
+    ] + [
+        Step("refresh_" + table, ";\n".join(statements), ("songplay", "aggregate_days"), (table,),
+            "aggregate")
+        for table, statements in queries.query("aggregate_refreshes").items()
+    ]
+
+    drops = list(queries.steps("drop_staging")) + [
+        Step("drop_aggregate_days", aggregateDaysDrop, (), ("aggregate_days",), "drop_staging")
+    ] + [
+        Step("drop_{}_after_load".format(partition_table(year, month)),
+            partitionDrop.format(partition_table(year, month)),
+            (), (partition_table(year, month),), "drop_staging")
+        for year, month in months]
+
+    songs = [step for step in queries.steps("copy") if step.name == "copy_staging_songs"]
+    return prepare + partitions + copies + songs + gathers + queries.steps("key") + replace + drops
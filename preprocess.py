@@ -0,0 +1,143 @@
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from s3_manifest import client_from_spec, split_s3_url, write_manifest
+from coalesce import assign_chunks, chunk_count, split_objects, piece_lines
+
+# The event fields the star schema uses, in the column order of the CSV
+# files; COPY loads them into the staging_events columns of the same name
+PROJECTED_FIELDS = ["artist", "firstName", "gender", "lastName", "length", "level",
+    "location", "sessionId", "song", "ts", "userAgent", "userId"]
+
+
+def iter_lines(body):
+    '''
+    Yields the lines of an S3 object body (or local file) one at a time
+    '''
+    if hasattr(body, "iter_lines"):
+        for line in body.iter_lines():
+            yield line
+    else:
+        for line in body:
+            yield line
+
+
+def read_objects(s3, objects, stats):
+    '''
+    Yields the lines of a list of S3 objects, or pieces of split ones, one
+    after the other
+    '''
+    for obj in objects:
+        stats["bytes_in"] += obj["Size"]
+        if "Range" in obj:
+            for line in piece_lines(s3, obj):
+                yield line
+            continue
+        body = s3.get_object(Bucket=obj["Bucket"], Key=obj["Key"])["Body"]
+        for line in iter_lines(body):
+            yield line
+        body.close()
+
+
+def parse_events(lines, stats):
+    '''
+    Yields the events of newline-delimited JSON log lines, skipping blanks
+    '''
+    for line in lines:
+        line = line.strip()
+        if line:
+            stats["rows_in"] += 1
+            yield json.loads(line)
+
+
+def project_events(events):
+    '''
+    Keeps the fields in PROJECTED_FIELDS of every event. Events of every
+    page are kept, as the inserts load them all into the star schema.
+    '''
+    for event in events:
+        yield [event.get(field) for field in PROJECTED_FIELDS]
+
+
+def csv_value(value):
+    if value is None or value == "":
+        return ""
+    return value
+
+
+def process_batch(spec, objects, destUrl):
+    '''
+    Worker: streams a batch of event log objects through parse and
+    projection into one gzip CSV object. Memory stays bounded by a line at
+    a time plus the spooled output.
+
+    Args:
+        spec: dict from s3_manifest.client_spec
+        objects: list of dicts as returned by s3_manifest.list_objects
+        destUrl: str
+            s3://bucket/key of the CSV object to write
+    Returns:
+        dict with rows read, rows written, bytes read and bytes written
+    '''
+    s3 = client_from_spec(spec)
+    stats = {"url": destUrl, "rows_in": 0, "rows_out": 0, "bytes_in": 0, "bytes_out": 0}
+    bucket, key = split_s3_url(destUrl)
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+        with gzip.GzipFile(fileobj=spool, mode="wb") as compressed:
+            text = io.TextIOWrapper(compressed, encoding="utf-8", newline="")
+            writer = csv.writer(text)
+            rows = project_events(parse_events(read_objects(s3, objects, stats), stats))
+            for row in rows:
+                writer.writerow([csv_value(v) for v in row])
+                stats["rows_out"] += 1
+            text.flush()
+            text.detach()
+        stats["bytes_out"] = spool.tell()
+        spool.seek(0)
+        s3.put_object(Bucket=bucket, Key=key, Body=spool)
+    return stats
+
+
+def preprocess_events(spec, objects, destUrl, slices, workers=None,
+        targetChunkBytes=128 * 1024 * 1024):
+    '''
+    Converts event log objects into compact gzip CSV chunks of the events
+    with only the columns the star schema needs, one chunk per worker task,
+    and writes a COPY manifest listing them. Objects larger than a chunk
+    are split at line boundaries.
+
+    Args:
+        spec: dict from s3_manifest.client_spec
+        objects: list of dicts as returned by s3_manifest.list_objects
+        destUrl: str
+            s3://bucket/prefix the chunks and manifest are written under
+        slices: int
+            number of slices in the cluster; the chunk count is a multiple
+        workers: int
+            size of the process pool, the number of CPUs by default
+    Returns:
+        (manifestUrl, report) with rows and bytes before and after, and
+        the objects projected into each chunk url ("chunks")
+    '''
+    destUrl = destUrl.rstrip("/")
+    pieces = split_objects(objects, targetChunkBytes)
+    batches = assign_chunks(pieces, chunk_count(sum(o["Size"] for o in objects),
+        len(pieces), slices, targetChunkBytes))
+    urls = ["{}/part-{:05d}.csv.gz".format(destUrl, i) for i in range(len(batches))]
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = list(executor.map(process_batch, [spec] * len(batches), batches, urls))
+
+    manifestUrl = write_manifest(client_from_spec(spec), destUrl + "/events.manifest",
+        {"entries": [{"url": r["url"], "mandatory": True,
+            "meta": {"content_length": r["bytes_out"]}} for r in results]})
+    report = dict((key, sum(r[key] for r in results))
+        for key in ("rows_in", "rows_out", "bytes_in", "bytes_out"))
+    report["files_in"] = len(objects)
+    report["files_out"] = len(results)
+    report["chunks"] = dict(zip(urls, batches))
+    return manifestUrl, report
@@ -0,0 +1,134 @@
+import re
+from sql_queries import final_tables, star_tables, shadow_table_name, version_table_name
+from sql_queries import table_list, table_count, table_rename, table_drop
+
+TARGET_PATTERN = re.compile(r"\b(insert into|create table if not exists|drop table if exists)\s+({})\b"
+    .format("|".join(final_tables)), re.IGNORECASE)
+
+SOURCE_PATTERN = re.compile(r"\b(from|join)\s+({})\b".format("|".join(final_tables)), re.IGNORECASE)
+
+
+def shadow_query(query):
+    '''
+    Points the target table of a drop, create or insert statement, and the
+    final tables it reads from (the aggregates read songplay), at their
+    shadow copies
+    '''
+    shadowed = lambda m: "{} {}".format(m.group(1), shadow_table_name.format(m.group(2).lower()))
+    return SOURCE_PATTERN.sub(shadowed, TARGET_PATTERN.sub(shadowed, query))
+
+
+def shadow_steps(steps):
+    '''
+    Rewrites pipeline steps to build the final tables under their shadow
+    names, leaving the live tables untouched until the swap
+    '''
+    renamed = dict((t, shadow_table_name.format(t)) for t in final_tables)
+    shadowed = []
+    for step in steps:
+        touchesFinal = any(t in renamed for t in step.reads + step.writes)
+        shadowed.append(step._replace(
+            name=shadow_table_name.format(step.name) if touchesFinal else step.name,
+            query=shadow_query(step.query),
+            reads=tuple(renamed.get(t, t) for t in step.reads),
+            writes=tuple(renamed.get(t, t) for t in step.writes)))
+    return shadowed
+
+
+def existing_tables(cur):
+    cur.execute(table_list)
+    return set(row[0] for row in cur.fetchall())
+
+
+def list_versions(tables, table):
+    '''
+    Returns the retained versions of a final table, newest first
+    '''
+    pattern = re.compile(r"^{}_v\d{{8}}t\d{{6}}$".format(table))
+    return sorted((t for t in tables if pattern.match(t)), reverse=True)
+
+
+def validate_shadows(cur):
+    '''
+    Checks the shadow tables before they are published: each has to exist
+    and those of the star schema have to hold rows. An aggregate may be
+    empty, e.g. when no event of the load matched a song.
+
+    Returns:
+        dict of table -> row count
+    Raises:
+        Exception naming the tables that can't be published
+    '''
+    tables = existing_tables(cur)
+    counts = {}
+    problems = []
+    for table in final_tables:
+        shadow = shadow_table_name.format(table)
+        if shadow not in tables:
+            problems.append("{} does not exist".format(shadow))
+            continue
+        cur.execute(table_count.format(shadow))
+        counts[table] = cur.fetchone()[0]
+        if counts[table] == 0 and table in star_tables:
+            problems.append("{} is empty".format(shadow))
+    if problems:
+        raise Exception("Not publishing: " + ", ".join(problems))
+    return counts
+
+
+def swap_tables(cur, conn, run_id, keep):
+    '''
+    Publishes the shadow tables: in a single transaction every live final
+    table is renamed to a version named after the run and its shadow takes
+    its name, so readers see either the old or the new star schema. Only
+    the newest keep versions of each table are retained.
+
+    Args:
+        cur, conn: cursor and connection to run the swap on
+        run_id: str
+            names the versions the current tables are kept as
+        keep: int
+            number of previous versions to keep for rollbacks
+    '''
+    tables = existing_tables(cur)
+    try:
+        for table in final_tables:
+            if table in tables:
+                cur.execute(table_rename.format(table,
+                    version_table_name.format(table, run_id.lower())))
+            cur.execute(table_rename.format(shadow_table_name.format(table), table))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    tables = existing_tables(cur)
+    for table in final_tables:
+        for version in list_versions(tables, table)[keep:]:
+            cur.execute(table_drop.format(version))
+    conn.commit()
+
+
+def rollback(cur, conn):
+    '''
+    Puts the newest retained version of every final table back in place in
+    a single transaction. The rolled back tables become the shadow tables,
+    which the next publishing run replaces.
+    '''
+    tables = existing_tables(cur)
+    versions = dict((table, list_versions(tables, table)) for table in final_tables)
+    missing = [table for table in final_tables if not versions[table]]
+    if missing:
+        raise Exception("No version to roll back to for: " + ", ".join(missing))
+
+    try:
+        for table in final_tables:
+            cur.execute(table_drop.format(shadow_table_name.format(table)))
+            if table in tables:
+                cur.execute(table_rename.format(table, shadow_table_name.format(table)))
+            cur.execute(table_rename.format(versions[table][0], table))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return dict((table, versions[table][0]) for table in final_tables)
@@ -0,0 +1,194 @@
+import re
+from collections import namedtuple
+import sql_queries
+from publish import shadow_steps
+
+# Values the statements of sql_queries.py are rendered with: the
+# placeholder, where it is read from in the config file, how it is checked
+# and written into the SQL, and its default (required when None and not
+# optional). S3 urls and the IAM role become quoted literals, the schema a
+# checked identifier and the counts plain numbers.
+Setting = namedtuple("Setting", ["name", "section", "option", "kind", "default", "optional"],
+    defaults=(None, False))
+
+SETTINGS = [
+    Setting("log_data", "S3", "LOG_DATA", "s3_url"),
+    Setting("log_jsonpath", "S3", "LOG_JSONPATH", "jsonpath"),
+    Setting("song_data", "S3", "SONG_DATA", "s3_url"),
+    Setting("manifest_prefix", "S3", "MANIFEST_PREFIX", "s3_url", optional=True),
+    Setting("arn", "DWH", "dwh_s3_iam_arn", "iam_role"),
+    Setting("schema", "DWH", "dwh_schema", "identifier"),
+    Setting("maxerror", "ETL", "MAXERROR", "maxerror", 0),
+    Setting("match_key_decimals", "ETL", "MATCH_KEY_DECIMALS", "decimals", 2)
+]
+
+PATTERNS = {
+    "s3_url": re.compile(r"^s3://[a-z0-9][a-z0-9.\-]{1,61}[a-z0-9](/[^'\"\\{}\s]*)?$"),
+    "jsonpath": re.compile(r"^(auto|s3://[a-z0-9][a-z0-9.\-]{1,61}[a-z0-9]/[^'\"\\{}\s]+)$"),
+    "iam_role": re.compile(r"^arn:aws[a-z\-]*:iam::\d{12}:role/[\w+=,.@\-/]+$"),
+    "identifier": re.compile(r"^[A-Za-z_][A-Za-z0-9_$]{0,126}$")
+}
+
+# Inclusive bounds of the numeric settings: Redshift caps MAXERROR at
+# 100000, and the match key rounds into a numeric(12, decimals)
+BOUNDS = {"maxerror": (0, 100000), "decimals": (0, 6)}
+
+# Settings written into the SQL as quoted string literals
+LITERALS = ("s3_url", "jsonpath", "iam_role")
+
+PLACEHOLDER = re.compile(r"\{(" + "|".join(setting.name for setting in SETTINGS) + r")\}")
+
+
+def quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def check_setting(setting, value):
+    '''
+    Validates a value read for a setting
+
+    Returns:
+        the value, converted to int for the numeric settings
+    Raises:
+        ValueError naming the option and the value
+    '''
+    invalid = ValueError("Invalid {} in the {} section of the config file: {!r}".format(
+        setting.option, setting.section, value))
+    if setting.kind in BOUNDS:
+        try:
+            value = int(value)
+        except ValueError:
+            raise invalid
+        low, high = BOUNDS[setting.kind]
+        if not low <= value <= high:
+            raise invalid
+        return value
+    if not PATTERNS[setting.kind].match(value):
+        raise invalid
+    return value
+
+
+def pipeline_steps(publish=False):
+    '''
+    Returns the unrendered steps of the full load and its stage groups,
+    under their shadow names when publishing, to resolve the step names
+    given on the command line before a config file is read
+    '''
+    steps, groups = sql_queries.full_load_steps, sql_queries.stage_groups
+    if publish:
+        return shadow_steps(steps), dict((name, shadow_steps(group)) for name, group in groups.items())
+    return steps, groups
+
+
+class QueryRegistry():
+    # Statements and steps rendered by every registry in the process, by
+    # environment and the values of the settings, so a long-running worker
+    # renders them once per schema it serves and two config files never
+    # share statements
+    rendered = {}
+
+    def __init__(self, config, environment=None, schema=None):
+        '''
+        Renders the statements and pipeline steps of sql_queries.py from a
+        parsed config file, each the first time it is asked for. Values are
+        read from the config file and checked on first use too, so a local
+        run doesn't need the S3 settings its COPYs would use.
+
+        Args:
+            config: configparser.ConfigParser
+            environment: str
+                names the config file the statements are rendered from;
+                ENVIRONMENT in the ETL section, or "default"
+            schema: str
+                replaces dwh_schema from the DWH section
+        '''
+        self.config = config
+        self.environment = environment or config.get("ETL","environment", fallback="default")
+        self.settings = dict((setting.name, setting) for setting in SETTINGS)
+        self.values = {}
+        if schema is not None:
+            self.values["schema"] = check_setting(self.settings["schema"], schema)
+        self.schema = self.value("schema")
+        self.key = (self.environment,) + tuple(self.values[setting.name]
+            if setting.name in self.values else self.config.get(setting.section, setting.option,
+            fallback=None) for setting in SETTINGS)
+
+    def value(self, name):
+        '''
+        Returns the checked value of a setting, None for a missing optional one
+
+        Raises:
+            ValueError when the value is invalid or a required one is missing
+        '''
+        if name not in self.values:
+            setting = self.settings[name]
+            value = self.config.get(setting.section, setting.option, fallback=None)
+            if value is None and (setting.default is not None or setting.optional):
+                self.values[name] = setting.default
+            elif value is None:
+                raise ValueError("{} is missing from the {} section of the config file".format(
+                    setting.option, setting.section))
+            else:
+                self.values[name] = check_setting(setting, value)
+        return self.values[name]
+
+    def sql(self, name):
+        '''
+        Returns a setting as it is written into a statement
+        '''
+        value = self.value(name)
+        if value is None:
+            setting = self.settings[name]
+            raise ValueError("{} is missing from the {} section of the config file".format(
+                setting.option, setting.section))
+        if self.settings[name].kind in LITERALS:
+            return quote_literal(value)
+        return str(value)
+
+    def render(self, query):
+        '''
+        Fills the settings into a statement, or into every statement of a
+        list, a tuple, a dict or a Step. Other placeholders, like the
+        manifest url filled in per run, are left in place.
+        '''
+        if isinstance(query, sql_queries.Step):
+            return query._replace(query=self.render(query.query))
+        if isinstance(query, dict):
+            return dict((key, self.render(q)) for key, q in query.items())
+        if isinstance(query, list):
+            return [self.render(q) for q in query]
+        if isinstance(query, tuple):
+            return tuple(self.render(q) for q in query)
+        return PLACEHOLDER.sub(lambda m: self.sql(m.group(1)), query)
+
+    def _memoized(self, key, build):
+        cache = QueryRegistry.rendered.setdefault(self.key, {})
+        if key not in cache:
+            cache[key] = build()
+        return cache[key]
+
+    def query(self, name):
+        '''
+        Returns a statement, or list of statements, of sql_queries.py by name
+        '''
+        return self._memoized(name, lambda: self.render(getattr(sql_queries, name)))
+
+    def steps(self, stage=None, publish=False, replaced=()):
+        '''
+        Returns the rendered steps of a stage group, or of the whole full
+        load when stage is None
+
+        Args:
+            publish: boolean
+                build the final tables under their shadow names
+            replaced: iterable of step names
+                steps run some other way, e.g. the COPYs a local backend
+                replaces with its loaders, which are left unrendered
+        '''
+        replaced = tuple(sorted(replaced))
+
+        def build():
+            steps = sql_queries.full_load_steps if stage is None else sql_queries.stage_groups[stage]
+            steps = [step if step.name in replaced else self.render(step) for step in steps]
+            return shadow_steps(steps) if publish else steps
+        return self._memoized(("steps", stage, publish, replaced), build)
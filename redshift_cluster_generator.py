@@ -1,8 +1,20 @@
 import boto3 as aws
 import configparser
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 
+S3_READ_ONLY_POLICY = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+
+# States of an existing cluster with the configured identifier that a new
+# invocation picks up instead of creating the cluster again
+ADOPTABLE_STATES = ["creating", "available", "paused", "resuming", "modifying", "rebooting"]
+
+# States a cluster being waited for won't recover from
+FAILED_STATES = ["deleting", "final-snapshot", "hardware-failure", "incompatible-hsm",
+    "incompatible-network", "incompatible-parameters", "incompatible-restore", "storage-full"]
+
 class RedshiftClusterGenerator():
     def __init__(self,configFileAddr,useExistingRole,useExistingVpcSettings):
         '''
@@ -41,6 +53,9 @@ class RedshiftClusterGenerator():
             self.db['Password']         = config.get("DWH","DWH_DB_PASSWORD")
             self.db['Port']             = int(config.get("DWH","DWH_DB_PORT"))
             self.db['S3Role']           = config.get("DWH","DWH_IAM_ROLE_NAME")
+            self.pollSeconds            = config.getint("DWH","DWH_POLL_SECONDS", fallback=15)
+            self.timeoutSeconds         = config.getint("DWH","DWH_TIMEOUT_MINUTES", fallback=45) * 60
+            self.phaseTimings           = {}
             self.awsClusterProperties        = None
             self.outIP                  = config.get("LOCAL","OUT_IP")
             self.useExistingS3Role      = useExistingRole
@@ -67,8 +82,8 @@ class RedshiftClusterGenerator():
 
     def createS3AccessRole(self):
         '''
-        Creates a redshift role and attaches the 
-        S3 read only access
+        Creates a redshift role for S3 access; the S3 read only policy is
+        attached separately by attachS3ReadOnlyPolicy
         
         Args:
             self:
@@ -96,11 +111,6 @@ class RedshiftClusterGenerator():
                     'Version': '2012-10-17'
             }))
 
-            print('Access to S3: Attaching Policy')
-            self.iamClient.attach_role_policy(RoleName = self.db['S3Role'],
-                    PolicyArn = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
-                    )['ResponseMetadata']['HTTPStatusCode']
-
             roleArn = S3AccessRole['Role']['Arn']
 
         except self.iamClient.exceptions.EntityAlreadyExistsException:
@@ -109,81 +119,256 @@ class RedshiftClusterGenerator():
                 roleArn = S3AccessRole['Role']['Arn']
         return roleArn
 
+    def attachS3ReadOnlyPolicy(self):
+        '''
+        Attaches the S3 read only policy to the redshift role. Attaching a
+        policy that is already attached changes nothing.
+        '''
+        print('Access to S3: Attaching Policy')
+        self.iamClient.attach_role_policy(RoleName = self.db['S3Role'],
+                PolicyArn = S3_READ_ONLY_POLICY)
+
+    def timed(self, phase, work, *args):
+        '''
+        Runs one phase of the provisioning and records its wall time in
+        phaseTimings
+        '''
+        started = time.perf_counter()
+        try:
+            return work(*args)
+        finally:
+            self.phaseTimings[phase] = round(time.perf_counter() - started, 1)
+            print("{} took {} s".format(phase, self.phaseTimings[phase]))
+
+    def findCluster(self):
+        '''
+        Returns the properties of the cluster with the configured identifier,
+        or None if there is no such cluster
+        '''
+        try:
+            return self.redshiftClient.describe_clusters(ClusterIdentifier=self.db['ClusterID'])['Clusters'][0]
+        except self.redshiftClient.exceptions.ClusterNotFoundFault:
+            return None
+
+    def createCluster(self, roleArn):
+        '''
+        Requests the cluster; it boots while the other phases run
+        '''
+        self.redshiftClient.create_cluster(
+            ClusterType = self.db['ClusterType'],
+            NodeType = self.db['NodeType'],
+            NumberOfNodes = self.db['NumNodes'],
+            DBName =self.db['Name'],
+            ClusterIdentifier = self.db['ClusterID'],
+            MasterUsername = self.db['AdminUsername'],
+            MasterUserPassword = self.db['Password'],
+            IamRoles = [roleArn]
+        )
+
+    def resumeCluster(self):
+        '''
+        Resumes the paused cluster
+        '''
+        self.redshiftClient.resume_cluster(ClusterIdentifier=self.db['ClusterID'])
+
+    def existingCluster(self):
+        '''
+        Returns the properties of the configured cluster, which must exist
+        '''
+        cluster = self.findCluster()
+        if cluster is None:
+            raise Exception("Cluster {} does not exist, run deploy_redshift_iac.py first".format(
+                self.db['ClusterID']))
+        return cluster
+
+    def startCluster(self):
+        '''
+        Resumes the cluster if it is paused and waits until it is available
+
+        Returns:
+            the properties of the available cluster
+        '''
+        if self.existingCluster()['ClusterStatus'] == 'paused':
+            print("Resuming cluster {}".format(self.db['ClusterID']))
+            self.timed("resume_cluster", self.resumeCluster)
+        return self.timed("cluster_available", self.waitForCluster)
+
+    def pauseCluster(self):
+        '''
+        Pauses the cluster, which stops the node billing, and waits until
+        it is paused
+        '''
+        if self.existingCluster()['ClusterStatus'] == 'paused':
+            print("Cluster {} is already paused".format(self.db['ClusterID']))
+            return
+        print("Pausing cluster {}".format(self.db['ClusterID']))
+        self.redshiftClient.pause_cluster(ClusterIdentifier=self.db['ClusterID'])
+        self.timed("cluster_paused", self.waitForCluster, None, 'paused')
+
+    def resizeCluster(self, nodeType, numNodes):
+        '''
+        Changes the node type and count of the available cluster and waits
+        until it is available again. An elastic resize is tried first; the
+        sizes it can't reach get a classic resize, which takes far longer.
+
+        Returns:
+            (node type, node count) before the resize
+        '''
+        cluster = self.existingCluster()
+        previous = (cluster['NodeType'], cluster['NumberOfNodes'])
+        if previous == (nodeType, numNodes):
+            print("Cluster {} already has {} {} nodes".format(self.db['ClusterID'], numNodes, nodeType))
+            return previous
+        print("Resizing cluster {} from {} {} to {} {} nodes".format(self.db['ClusterID'],
+            previous[1], previous[0], numNodes, nodeType))
+        clusterType = 'multi-node' if numNodes > 1 else 'single-node'
+        try:
+            self.redshiftClient.resize_cluster(ClusterIdentifier=self.db['ClusterID'],
+                ClusterType=clusterType, NodeType=nodeType, NumberOfNodes=numNodes, Classic=False)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('UnsupportedOperation', 'UnsupportedOperationFault'):
+                raise
+            print("Elastic resize not possible ({}), falling back to a classic resize".format(
+                e.response['Error']['Message']))
+            self.redshiftClient.modify_cluster(ClusterIdentifier=self.db['ClusterID'],
+                ClusterType=clusterType, NodeType=nodeType, NumberOfNodes=numNodes)
+        self.timed("resize", self.waitForCluster)
+        return previous
+
+    def waitForCluster(self, onVpc=None, until='available'):
+        '''
+        Polls the cluster until it reaches a status, available by default,
+        printing every change of its status. Unlike the boto3 waiter this
+        hands the cluster's VPC to onVpc as soon as it is known, so the
+        network can be set up while the nodes boot.
+
+        Args:
+            onVpc: callable
+                onVpc(vpcId) is called once, when the cluster has a VPC
+            until: str
+                the status to wait for
+        Returns:
+            the properties of the cluster
+        '''
+        deadline = time.time() + self.timeoutSeconds
+        status = None
+        while True:
+            cluster = self.findCluster()
+            if cluster is None:
+                raise Exception("Cluster {} disappeared".format(self.db['ClusterID']))
+            if cluster['ClusterStatus'] != status:
+                status = cluster['ClusterStatus']
+                print("Cluster status: {}".format(status))
+            if onVpc is not None and cluster.get('VpcId'):
+                onVpc(cluster['VpcId'])
+                onVpc = None
+            if status == until and (until != 'available' or cluster.get('Endpoint')):
+                return cluster
+            if status in FAILED_STATES:
+                raise Exception("Cluster {} is {}".format(self.db['ClusterID'], status))
+            if time.time() > deadline:
+                raise Exception("Cluster {} is still {} after {} minutes, rerun to keep waiting".format(
+                    self.db['ClusterID'], status, self.timeoutSeconds // 60))
+            time.sleep(self.pollSeconds)
+
     def generateRedshiftCluster(self):
         '''
-        Creates a Redshift cluster using the properties of this class
+        Creates a Redshift cluster using the properties of this class. The
+        policy attachment and the network access are set up while the
+        cluster boots. A cluster that already exists under the configured
+        identifier (e.g. from an invocation that timed out) is picked up
+        where it was left: waited for while creating, resumed when paused.
 
         Parameters:
             None
         Returns:
             void
         '''
-        
+        self.phaseTimings = {}
         try:
-            # create the role in AWS for Redshift and
-            # assign the policy to the new role
-            print("Creating the access role for Redshift")
-            S3ReadOnlyArn = self.createS3AccessRole()
+            cluster = self.findCluster()
         except ClientError as e:
             print(e)
             return
 
-        print("Initiating request to AWS for Redshift Cluster")
-        try:   
-            # create the cluster
-            self.redshiftClient.create_cluster(        
-                ClusterType = self.db['ClusterType'],
-                NodeType = self.db['NodeType'],
-                NumberOfNodes = self.db['NumNodes'],
-                DBName =self.db['Name'],
-                ClusterIdentifier = self.db['ClusterID'],
-                MasterUsername = self.db['AdminUsername'],
-                MasterUserPassword = self.db['Password'],
-                IamRoles = [S3ReadOnlyArn]
-            )
-        except Exception as e:
-            print(e)
-            return
+        adopted = cluster is not None
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            background = []
+            if not adopted:
+                try:
+                    # create the role in AWS for Redshift; the policy is
+                    # attached while the cluster boots
+                    print("Creating the access role for Redshift")
+                    S3ReadOnlyArn = self.timed("create_role", self.createS3AccessRole)
+                except ClientError as e:
+                    print(e)
+                    return
+                if S3ReadOnlyArn is None:
+                    print("The role {} already exists, use the -r flag to use it".format(self.db['S3Role']))
+                    return
+                background.append(executor.submit(self.timed, "attach_policy", self.attachS3ReadOnlyPolicy))
 
-        cluster_available_waiter = self.redshiftClient.get_waiter('cluster_available')
-        
+                print("Initiating request to AWS for Redshift Cluster")
+                try:
+                    self.timed("create_cluster", self.createCluster, S3ReadOnlyArn)
+                except Exception as e:
+                    print(e)
+                    return
+            else:
+                status = cluster['ClusterStatus']
+                print("Cluster {} already exists and is {}, picking it up".format(self.db['ClusterID'], status))
+                if status not in ADOPTABLE_STATES:
+                    print("A {} cluster cannot be picked up. Cannot proceed further".format(status))
+                    return
+                if status == 'paused':
+                    try:
+                        self.timed("resume_cluster", self.resumeCluster)
+                    except ClientError as e:
+                        print(e)
+                        return
+
+            print("Waiting for AWS to complete Redshift setup. Go drink some coffee or disturb a co-worker")
+            try:
+                self.awsClusterProperties = self.timed("cluster_available", self.waitForCluster,
+                    lambda vpcId: background.append(executor.submit(self.timed, "network",
+                        self.setupVPCConnectivity, vpcId, adopted)))
+                if self.awsClusterProperties.get('VpcId') is None:
+                    print("The cluster is not in a VPC, skipping the network settings")
+                for future in background:
+                    future.result()
+                print("Cluster ready")
 
-        print("Waiting for AWS to complete Redshift setup. Go drink some coffee or disturb a co-worker")
-        
-        try:
-            cluster_available_waiter.wait(ClusterIdentifier = self.db['ClusterID'])
-            print("Cluster ready")
-            
-            self.awsClusterProperties = self.redshiftClient.describe_clusters(ClusterIdentifier=self.db['ClusterID'])['Clusters'][0]
-            if(self.awsClusterProperties is not None):
-                self.setupVPCConnectivity()
-                
                 self.dwHost       = self.awsClusterProperties['Endpoint']['Address']
                 self.dwRoleArn    = self.awsClusterProperties['IamRoles'][0]['IamRoleArn']
 
                 self.saveDBConfigurations("DWH","DWH_ENDPOINT",self.dwHost )
                 self.saveDBConfigurations("DWH","DWH_S3_IAM_ARN",self.dwRoleArn)
-            else:
-                print("\nRedshift cluster was not created. Cannot proceed further")
-                print(".........................................................")
-        except Exception as e:
-            print(e)
-            return
-
-        
+            except Exception as e:
+                print(e)
+                return
+            finally:
+                print("Phase timings: {}".format(", ".join("{} {} s".format(phase, seconds)
+                    for phase, seconds in self.phaseTimings.items())))
 
 
-    def setupVPCConnectivity(self):
+    def setupVPCConnectivity(self, vpcId=None, resumed=False):
         '''
         Allows access between the Redshift cluster and a specified ip address
         in the configuration file
+
+        Args:
+            vpcId: str
+                the VPC of the cluster, by default that of awsClusterProperties
+            resumed: boolean
+                the cluster was picked up from an earlier invocation, which
+                may have added the same rule already
         
         Returns: void
         '''
         try:
             print("Setting up your network access to the cluster.......")
             
-            vpc = self.ec2Client.Vpc(id=self.awsClusterProperties['VpcId'])
+            vpc = self.ec2Client.Vpc(id=vpcId or self.awsClusterProperties['VpcId'])
             defaultSecurityGroup = list(vpc.security_groups.all())[0]
             
             defaultSecurityGroup.authorize_ingress(
@@ -196,7 +381,7 @@ class RedshiftClusterGenerator():
             print("Network settings complete")
         except ClientError as error :
             if 'InvalidPermission.Duplicate' in str(error):
-                if(self.useExistingVpcSettings==False):
+                if(self.useExistingVpcSettings==False and resumed==False):
                     raise Exception("Alert: A duplicate network connection exists and\
                          you can use it to connect to your database")
         except Exception as e:
@@ -204,7 +389,7 @@ class RedshiftClusterGenerator():
         return
 
 
-    def saveDBConfigurations(self,section,option,value):
+    def saveDBConfigurations(self,section,option,value,overwrite=False):
         '''
         Saves the endpoint address and Iam role arn into the config
         file after the database has been created for later use
@@ -216,6 +401,8 @@ class RedshiftClusterGenerator():
                 The option being saved to
             value: str
                 The value of the option
+            overwrite: boolean
+                replace a different value the option already has
         Returns:
             void
         '''
@@ -223,9 +410,9 @@ class RedshiftClusterGenerator():
         config.read_file(open(self.configFile))
 
         def add_option():
-            if config.has_option(section,option)==False:
+            if config.has_option(section,option)==False or overwrite:
                 config.set(section,option,value)
-            else:
+            elif config.get(section,option) != value:
                 print("An option with the same values exist. Please consider entering the values manually")
                 print("Enter these values into your config file:....")
                 print(("Section: {} ").format(section))
@@ -0,0 +1,247 @@
+import datetime
+import json
+import re
+import threading
+import time
+
+# COPY statistics on Redshift: rows of the last COPY in the session, and
+# the files and bytes it scanned
+copy_row_count = "select pg_last_copy_count()"
+
+copy_file_stats = ("""
+    select count(distinct trim(name)), sum(bytes)
+    from stl_file_scan
+    where query = pg_last_copy_id()
+""")
+
+copy_commit_count = ("""
+    select count(distinct trim(filename))
+    from stl_load_commits
+    where query = pg_last_copy_id()
+""")
+
+STATEMENT_PATTERN = re.compile(
+    r"^\s*(create table if not exists|create table|drop table if exists|drop table"
+    r"|insert into|delete from|copy|alter table|unload|select)\s+([\w.]+)?", re.IGNORECASE)
+
+
+def statement_kind(query):
+    '''
+    Returns the leading keyword of a statement, e.g. "copy" or "insert"
+    '''
+    words = query.split()
+    return words[0].lower() if words else ""
+
+
+def statement_label(query):
+    '''
+    Labels a statement that doesn't belong to a named step by its verb and
+    target table, e.g. "insert into songs"
+    '''
+    match = STATEMENT_PATTERN.match(query)
+    if match is None:
+        return " ".join(query.split()[:3]).lower()
+    if match.group(1).lower() == "select":
+        return "select"
+    return " ".join(g for g in match.groups() if g).lower()
+
+
+class RunReport():
+    def __init__(self, copyMetrics=True):
+        '''
+        Collects one record per executed statement (wall time, rows and, for
+        COPYs, files and bytes loaded) plus named sections such as the
+        coalescing report, and writes them out as JSON, NDJSON or a
+        Prometheus text file.
+
+        Args:
+            copyMetrics: boolean
+                query pg_last_copy_count() and the stl_* system tables after
+                each COPY. Only Redshift has them.
+        '''
+        self.copyMetrics = copyMetrics
+        self.runId      = None
+        self.startedAt  = datetime.datetime.utcnow()
+        self.started    = time.perf_counter()
+        self.records    = []
+        self.sections   = {}
+        self.lock       = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            record["run_id"] = self.runId
+            self.records.append(record)
+
+    def addConnection(self, startedAt, seconds, error=None):
+        '''
+        Records the setup of a database session (connect and search_path)
+        under the "connect" step
+        '''
+        record = {"step": "connect", "statement": "connect",
+            "started_at": startedAt.isoformat() + "Z", "seconds": round(seconds, 3),
+            "status": "succeeded" if error is None else "failed"}
+        if error is not None:
+            record["error"] = str(error).strip()
+        self.add(record)
+
+    def addSection(self, name, key, value):
+        '''
+        Stores value under sections[name][key], e.g. the coalescing report
+        of one source
+        '''
+        with self.lock:
+            self.sections.setdefault(name, {})[key] = value
+
+    def summary(self):
+        '''
+        Returns the whole report as a dict: run timings, per-step totals and
+        the individual statement records
+        '''
+        with self.lock:
+            records = list(self.records)
+        steps = {}
+        for record in records:
+            step = steps.setdefault(record["step"], {"statements": 0, "seconds": 0.0,
+                "rows": 0, "bytes": 0, "files": 0, "status": "succeeded"})
+            step["statements"] += 1
+            step["seconds"] = round(step["seconds"] + record["seconds"], 3)
+            for key in ("rows", "bytes", "files"):
+                step[key] += record.get(key) or 0
+            if record["status"] != "succeeded":
+                step["status"] = record["status"]
+        return {
+            "run_id": self.runId,
+            "started_at": self.startedAt.isoformat() + "Z",
+            "seconds": round(time.perf_counter() - self.started, 3),
+            "steps": steps,
+            "sections": self.sections,
+            "statements": records
+        }
+
+    def write(self, path):
+        '''
+        Writes the report to path: one JSON record per statement when path
+        ends in .ndjson, a single JSON document otherwise
+        '''
+        summary = self.summary()
+        with open(path, "w") as f:
+            if path.endswith(".ndjson"):
+                for record in summary["statements"]:
+                    f.write(json.dumps(record, default=str) + "\n")
+            else:
+                json.dump(summary, f, default=str, indent=2)
+
+    def writePrometheus(self, path):
+        '''
+        Writes per-step gauges in the Prometheus text exposition format, for
+        the node exporter's textfile collector
+        '''
+        summary = self.summary()
+        lines = [
+            "# HELP etl_run_seconds Wall time of the ETL run",
+            "# TYPE etl_run_seconds gauge",
+            "etl_run_seconds {}".format(summary["seconds"])
+        ]
+        metrics = [
+            ("etl_step_seconds", "seconds", "Wall time of the statements of a step"),
+            ("etl_step_rows", "rows", "Rows affected or loaded by a step"),
+            ("etl_step_bytes", "bytes", "Bytes scanned by the COPYs of a step"),
+            ("etl_step_files", "files", "Files loaded by the COPYs of a step")
+        ]
+        for metric, key, description in metrics:
+            lines.append("# HELP {} {}".format(metric, description))
+            lines.append("# TYPE {} gauge".format(metric))
+            for name, step in sorted(summary["steps"].items()):
+                lines.append('{}{{step="{}",status="{}"}} {}'.format(metric,
+                    name.replace('"', "'"), step["status"], step[key]))
+        validation = dict(summary["sections"].get("validation", {}))
+        if validation:
+            breaches = validation.pop("breaches", [])
+            lines += [
+                "# HELP etl_validation_metric Data quality metrics of the loaded tables",
+                "# TYPE etl_validation_metric gauge"
+            ]
+            for table, values in sorted(validation.items()):
+                for name, value in sorted(values.items()):
+                    lines.append('etl_validation_metric{{table="{}",metric="{}"}} {}'.format(
+                        table, name, value))
+            lines += [
+                "# HELP etl_validation_breaches Data quality thresholds breached by the load",
+                "# TYPE etl_validation_breaches gauge",
+                "etl_validation_breaches {}".format(len(breaches))
+            ]
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+class InstrumentedCursor():
+    def __init__(self, cursor, report):
+        '''
+        Wraps a DB-API cursor so every statement run through it is timed
+        and recorded in a RunReport. Other attributes are passed through.
+
+        Args:
+            cursor: the DB-API cursor to wrap
+            report: RunReport
+        '''
+        self.cursor = cursor
+        self.report = report
+        self.label  = None
+        self.lastRowcount = -1
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    @property
+    def rowcount(self):
+        '''
+        Rows of the last recorded statement; for a COPY this is the loaded
+        row count rather than that of the statistics queries run after it
+        '''
+        return self.lastRowcount
+
+    def execute(self, query, params=None):
+        '''
+        Executes a statement and records it under the cursor's label (the
+        running step) or, if unset, a label derived from the statement
+        '''
+        record = {
+            "step": self.label or statement_label(query),
+            "statement": statement_kind(query),
+            "started_at": datetime.datetime.utcnow().isoformat() + "Z"
+        }
+        started = time.perf_counter()
+        self.lastRowcount = -1
+        try:
+            if params is None:
+                self.cursor.execute(query)
+            else:
+                self.cursor.execute(query, params)
+        except Exception as e:
+            record["seconds"] = round(time.perf_counter() - started, 3)
+            record["status"] = "failed"
+            record["error"] = str(e).strip()
+            self.report.add(record)
+            raise
+
+        record["seconds"] = round(time.perf_counter() - started, 3)
+        record["status"] = "succeeded"
+        record["rows"] = self.cursor.rowcount if self.cursor.rowcount >= 0 else None
+        if record["statement"] == "copy" and self.report.copyMetrics:
+            self._copyMetrics(record)
+        self.lastRowcount = record["rows"] if record["rows"] is not None else -1
+
+        if record["seconds"] > 0:
+            if record.get("rows"):
+                record["rows_per_s"] = round(record["rows"] / record["seconds"], 1)
+            if record.get("bytes"):
+                record["mb_per_s"] = round(record["bytes"] / 1e6 / record["seconds"], 2)
+        self.report.add(record)
+
+    def _copyMetrics(self, record):
+        self.cursor.execute(copy_row_count)
+        record["rows"] = self.cursor.fetchone()[0]
+        self.cursor.execute(copy_file_stats)
+        scanned, record["bytes"] = self.cursor.fetchone()
+        self.cursor.execute(copy_commit_count)
+        record["files"] = self.cursor.fetchone()[0] or scanned
@@ -0,0 +1,195 @@
+import hashlib
+from sql_queries import run_state_open_run, run_state_exclude, run_state_succeeded, run_state_insert
+from scheduler import build_dependencies, label
+
+
+def execute_query(cur, step):
+    '''
+    Executes the statement of a step
+
+    Returns:
+        the rows it affected, or None if the driver doesn't tell
+    '''
+    cur.execute(step.query)
+    return cur.rowcount if cur.rowcount >= 0 else None
+
+
+def listing_hash(objects):
+    '''
+    Hashes an S3 listing (keys, sizes and modification times) so a COPY can
+    tell whether its input changed since it last succeeded
+    '''
+    digest = hashlib.sha256()
+    for o in objects:
+        digest.update("{}\t{}\t{}\n".format(o["Key"], o["Size"], o["LastModified"]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def input_hashes(steps, seeds):
+    '''
+    Computes an input hash per step from its SQL, an optional seed (e.g. the
+    listing hash of the files a COPY reads) and the hashes of the steps it
+    depends on, so a changed input invalidates everything downstream of it
+
+    Args:
+        steps: list of sql_queries.Step
+        seeds: dict of step name -> str
+    Returns:
+        dict of step name -> hex digest
+    '''
+    dependencies = build_dependencies(steps)
+    hashes = {}
+    for step in steps:
+        digest = hashlib.sha256(step.query.encode("utf-8"))
+        digest.update(seeds.get(step.name, "").encode("utf-8"))
+        for dep in sorted(dependencies[step.name]):
+            digest.update(hashes[dep].encode("utf-8"))
+        hashes[step.name] = digest.hexdigest()
+    return hashes
+
+
+def resolve_stages(names, steps, groups):
+    '''
+    Expands stage names given on the command line, each either a step name
+    or a group name from sql_queries.stage_groups, into step names in
+    declared order
+    '''
+    selected = set()
+    for name in names:
+        if name in groups:
+            selected |= set(step.name for step in groups[name])
+        elif name in [step.name for step in steps]:
+            selected.add(name)
+        else:
+            raise ValueError("Unknown stage: {}".format(name))
+    return [step.name for step in steps if step.name in selected]
+
+
+def plan_steps(steps, hashes, succeeded, fromStage=None, onlyStages=None):
+    '''
+    Picks the steps a run still has to execute
+
+    Args:
+        steps: list of sql_queries.Step in declared order
+        hashes: dict of step name -> input hash for this run
+        succeeded: dict of step name -> input hash recorded as succeeded
+        fromStage: str
+            step name: skip every step before it and force it and the rest
+        onlyStages: list of str
+            step names: force exactly these steps
+    Returns:
+        (steps to run, stale) where stale tells that a recorded step
+        succeeded against different inputs, so the run can't be resumed
+    '''
+    if onlyStages:
+        return [step for step in steps if step.name in onlyStages], False
+
+    if fromStage is not None:
+        names = [step.name for step in steps]
+        return steps[names.index(fromStage):], False
+
+    stale = any(succeeded[step.name] != hashes[step.name]
+        for step in steps if step.name in succeeded)
+    if stale:
+        return list(steps), True
+    return [step for step in steps if step.name not in succeeded], False
+
+
+class RunState():
+    def __init__(self, pool):
+        '''
+        Reads and writes the etl_run_state table, where every completed step
+        of a run is recorded with its input hash and row count
+
+        Args:
+            pool: db_pool.ConnectionPool
+        '''
+        self.pool = pool
+
+    def _query(self, query, params=(), fetch=False):
+        pair = self.pool.acquire()
+        conn, cur = pair
+        try:
+            cur.execute(query, params)
+            rows = cur.fetchall() if fetch else None
+            conn.commit()
+            return rows
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.release(pair)
+
+    def openRun(self, prefix="", exclude=()):
+        '''
+        Returns the id of the latest run that did not complete, or None
+
+        Args:
+            prefix: str
+                only consider run ids starting with it
+            exclude: iterable of str
+                skip run ids starting with any of them
+        '''
+        exclude = tuple(exclude)
+        params = [len(prefix), prefix]
+        for skipped in exclude:
+            params += [len(skipped), skipped]
+        rows = self._query(run_state_open_run.format(run_state_exclude * len(exclude)),
+            tuple(params), fetch=True)
+        return rows[0][0] if rows else None
+
+    def succeeded(self, runId):
+        '''
+        Returns a dict of step name -> input hash of the steps of a run
+        that succeeded
+        '''
+        return dict(self._query(run_state_succeeded, (runId,), fetch=True))
+
+    def complete(self, runId):
+        '''
+        Marks a run as complete so the next invocation starts a new one
+        '''
+        self._query(run_state_insert, (runId, "run", None, None, "completed"))
+
+    def fail(self, runId):
+        '''
+        Closes a run that can't be finished by resuming it, e.g. one whose
+        tables failed the quality checks, so the next invocation starts over
+        '''
+        self._query(run_state_insert, (runId, "run", None, None, "failed"))
+
+    def runner(self, runId, hashes, execute=execute_query):
+        '''
+        Returns a run(step, pool) callable for scheduler.run_steps that
+        executes a step and records its completion in the same transaction,
+        so a step is checkpointed exactly when its effects are committed.
+        Failures are recorded in a transaction of their own.
+
+        Args:
+            execute: callable
+                execute(cur, step) runs a step and returns its row count
+        '''
+        def run(step, pool):
+            pair = pool.acquire(step.stage)
+            conn, cur = pair
+            try:
+                label(cur, step.name)
+                rows = execute(cur, step)
+                label(cur, None)
+                cur.execute(run_state_insert,
+                    (runId, step.name, hashes.get(step.name), rows, "succeeded"))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                try:
+                    cur.execute(run_state_insert,
+                        (runId, step.name, hashes.get(step.name), None, "failed"))
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    print(e)
+                raise
+            finally:
+                label(cur, None)
+                pool.release(pair)
+        return run
@@ -0,0 +1,222 @@
+import datetime
+import json
+import os
+import shutil
+
+
+def split_s3_url(url):
+    '''
+    Splits an s3://bucket/prefix url into its bucket and key prefix
+
+    Args:
+        url: str
+            the S3 url
+    Returns:
+        (bucket, prefix): tuple of str
+    '''
+    if not url.startswith("s3://"):
+        raise ValueError("Not an S3 url: {}".format(url))
+    bucket, _, prefix = url[len("s3://"):].partition("/")
+    return bucket, prefix
+
+
+def list_objects(s3Client, url, start_after=None, modified_after=None):
+    '''
+    Lists the objects under an S3 prefix, optionally only those after a key
+    (lexicographically) or modified after a timestamp
+
+    Args:
+        s3Client: boto3 S3 client
+        url: str
+            s3://bucket/prefix to list
+        start_after: str
+            only keys that sort after this key are returned
+        modified_after: datetime
+            only objects modified after this time are returned
+    Returns:
+        list of dicts with Key, Size and LastModified, sorted by key
+    '''
+    bucket, prefix = split_s3_url(url)
+    params = {"Bucket": bucket, "Prefix": prefix}
+    if start_after:
+        params["StartAfter"] = start_after
+
+    objects = []
+    paginator = s3Client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(**params):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith("/"):
+                continue
+            if modified_after is not None and \
+                    obj["LastModified"].replace(tzinfo=None) <= modified_after:
+                continue
+            objects.append({
+                "Bucket": bucket,
+                "Key": obj["Key"],
+                "Size": obj["Size"],
+                "LastModified": obj["LastModified"].replace(tzinfo=None)
+            })
+    return sorted(objects, key=lambda o: o["Key"])
+
+
+def delete_objects(s3Client, url):
+    '''
+    Deletes the objects under an S3 prefix
+
+    Returns:
+        number of objects deleted
+    '''
+    objects = list_objects(s3Client, url)
+    for start in range(0, len(objects), 1000):
+        s3Client.delete_objects(Bucket=objects[start]["Bucket"], Delete={"Objects": [
+            {"Key": o["Key"]} for o in objects[start:start + 1000]]})
+    return len(objects)
+
+
+def build_manifest(objects):
+    '''
+    Builds a Redshift COPY manifest for a list of S3 objects
+
+    Args:
+        objects: list of dicts as returned by list_objects
+    Returns:
+        dict: the manifest document
+    '''
+    return {"entries": [
+        {
+            "url": "s3://{}/{}".format(o["Bucket"], o["Key"]),
+            "mandatory": True,
+            "meta": {"content_length": o["Size"]}
+        } for o in objects]}
+
+
+def write_manifest(s3Client, manifest_url, manifest):
+    '''
+    Uploads a COPY manifest to S3
+
+    Args:
+        s3Client: boto3 S3 client
+        manifest_url: str
+            s3://bucket/key to write the manifest to
+        manifest: dict
+            the manifest document
+    Returns:
+        manifest_url: str
+    '''
+    bucket, key = split_s3_url(manifest_url)
+    s3Client.put_object(Bucket=bucket, Key=key,
+        Body=json.dumps(manifest).encode("utf-8"))
+    return manifest_url
+
+
+def read_manifest(s3Client, manifest_url):
+    '''
+    Downloads a COPY manifest from S3
+
+    Returns:
+        dict: the manifest document
+    '''
+    bucket, key = split_s3_url(manifest_url)
+    body = s3Client.get_object(Bucket=bucket, Key=key)["Body"]
+    try:
+        return json.loads(body.read().decode("utf-8"))
+    finally:
+        body.close()
+
+
+def client_spec(config):
+    '''
+    Returns the settings needed to create an S3 client as a plain dict, which
+    unlike a client can be handed to worker processes
+    '''
+    return {
+        "key": config.get("AWS","KEY", fallback=None),
+        "secret": config.get("AWS","SECRET", fallback=None),
+        "region": config.get("AWS","REGION", fallback=None),
+        "root": config.get("S3","LOCAL_ROOT", fallback=None)
+    }
+
+
+def client_from_spec(spec):
+    '''
+    Creates an S3 client from a client_spec: a DirectoryS3Client when a
+    local root directory is set, a boto3 client otherwise
+    '''
+    if spec.get("root"):
+        return DirectoryS3Client(spec["root"])
+    import boto3 as aws
+    return aws.client('s3',
+        aws_access_key_id = spec["key"],
+        aws_secret_access_key = spec["secret"],
+        region_name = spec["region"])
+
+
+def s3_client(config):
+    '''
+    Creates an S3 client from the AWS section of the config file
+    '''
+    return client_from_spec(client_spec(config))
+
+
+class DirectoryS3Client():
+    def __init__(self, root):
+        '''
+        A stand-in for the subset of the boto3 S3 client used by the ETL,
+        backed by a local directory: s3://bucket/key maps to root/bucket/key.
+        Lets manifests and coalesced files be produced without AWS.
+
+        Args:
+            root: str
+                the directory holding one sub-directory per bucket
+        '''
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def get_paginator(self, operation):
+        if operation != "list_objects_v2":
+            raise ValueError("Unsupported operation: {}".format(operation))
+        return self
+
+    def paginate(self, Bucket, Prefix="", StartAfter=None):
+        bucketDir = os.path.join(self.root, Bucket)
+        contents = []
+        for dirpath, _, filenames in os.walk(bucketDir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, bucketDir).replace(os.sep, "/")
+                if not key.startswith(Prefix):
+                    continue
+                if StartAfter is not None and key <= StartAfter:
+                    continue
+                stat = os.stat(path)
+                contents.append({
+                    "Key": key,
+                    "Size": stat.st_size,
+                    "LastModified": datetime.datetime.fromtimestamp(
+                        stat.st_mtime, datetime.timezone.utc)
+                })
+        yield {"Contents": sorted(contents, key=lambda c: c["Key"])}
+
+    def get_object(self, Bucket, Key, Range=None):
+        body = open(self._path(Bucket, Key), "rb")
+        if Range is not None:
+            # only the open-ended bytes=<start>- ranges piece_lines asks for
+            body.seek(int(Range[len("bytes="):].split("-")[0]))
+        return {"Body": body}
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            os.remove(self._path(Bucket, obj["Key"]))
+        return {}
+
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            if isinstance(Body, bytes):
+                f.write(Body)
+            else:
+                shutil.copyfileobj(Body, f)
+        return {}
@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def conflicts(earlier, later):
+    '''
+    Tells whether a step has to wait for an earlier one: they touch a
+    common table and at least one of them writes it
+    '''
+    earlierTouches = set(earlier.reads) | set(earlier.writes)
+    laterTouches = set(later.reads) | set(later.writes)
+    return bool(set(earlier.writes) & laterTouches) or \
+        bool(set(later.writes) & earlierTouches)
+
+
+def build_dependencies(steps):
+    '''
+    Derives the dependency graph of a list of steps from the tables they
+    read and write. The list order is the serial order, so a step only ever
+    depends on steps listed before it and the graph can't have cycles.
+
+    Args:
+        steps: list of sql_queries.Step
+    Returns:
+        dict of step name -> set of names of the steps it waits for
+    '''
+    names = [step.name for step in steps]
+    if len(set(names)) != len(names):
+        raise ValueError("Step names must be unique")
+
+    dependencies = {}
+    for i, step in enumerate(steps):
+        dependencies[step.name] = set(
+            earlier.name for earlier in steps[:i] if conflicts(earlier, step))
+    return dependencies
+
+
+def critical_path(steps, durations):
+    '''
+    Computes the longest chain of dependent steps given each step's duration,
+    i.e. the shortest wall time any amount of concurrency can reach
+
+    Args:
+        steps: list of sql_queries.Step
+        durations: dict of step name -> seconds
+    Returns:
+        (seconds, [step names])
+    '''
+    dependencies = build_dependencies(steps)
+    finish = {}
+    previous = {}
+    for step in steps:
+        start, before = 0.0, None
+        for dep in dependencies[step.name]:
+            if finish[dep] > start:
+                start, before = finish[dep], dep
+        finish[step.name] = start + durations.get(step.name, 0.0)
+        previous[step.name] = before
+
+    if not finish:
+        return 0.0, []
+    last = max(finish, key=finish.get)
+    path = []
+    while last is not None:
+        path.append(last)
+        last = previous[last]
+    return finish[path[0]], list(reversed(path))
+
+
+def label(cur, name):
+    '''
+    Tags the statements run on an instrumented cursor with a step name
+    '''
+    if hasattr(cur, "label"):
+        cur.label = name
+
+
+def execute_step(step, pool):
+    '''
+    Runs a single step on a pooled connection and commits it
+    '''
+    pair = pool.acquire(step.stage)
+    conn, cur = pair
+    try:
+        label(cur, step.name)
+        cur.execute(step.query)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        label(cur, None)
+        pool.release(pair)
+
+
+def run_steps(steps, pool, maxConcurrency, run=execute_step):
+    '''
+    Runs steps as soon as everything they depend on has finished, with at
+    most maxConcurrency of them in flight. On the first failure no further
+    steps are started; the ones already running are allowed to finish and
+    the error is raised.
+
+    Args:
+        steps: list of sql_queries.Step
+        pool: db_pool.ConnectionPool
+            should hold at least maxConcurrency connections
+        maxConcurrency: int
+            the largest number of steps running at once
+        run: callable
+            run(step, pool) executes one step
+    Returns:
+        list of step names in completion order
+    '''
+    dependencies = build_dependencies(steps)
+    pending = list(steps)
+    running = {}
+    completed = []
+    done = set()
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=maxConcurrency) as executor:
+        while (pending and failure is None) or running:
+            if failure is None:
+                for step in [s for s in pending if dependencies[s.name] <= done]:
+                    if len(running) >= maxConcurrency:
+                        break
+                    print("Starting {}".format(step.name))
+                    running[executor.submit(run, step, pool)] = step
+                    pending.remove(step)
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                try:
+                    future.result()
+                    done.add(step.name)
+                    completed.append(step.name)
+                except Exception as e:
+                    print("{} failed: {}".format(step.name, e))
+                    if failure is None:
+                        failure = e
+
+    if failure is not None:
+        raise failure
+    return completed
@@ -1,32 +1,32 @@
-import configparser
+from collections import namedtuple
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
-    
-LOG_DATA                           = config.get("S3","LOG_DATA") 
-LOG_JSONPATH                       = config.get("S3","LOG_JSONPATH")
-SONG_DATA                          = config.get("S3", "SONG_DATA")
-ARN                                = config.get("DWH","dwh_s3_iam_arn")
-SCHEMA                             = config.get("DWH","dwh_schema")
+# Statements are templates: {log_data}, {song_data}, {log_jsonpath},
+# {arn}, {schema}, {maxerror} and {match_key_decimals} are filled in from
+# the config file by query_registry.QueryRegistry when a run renders them.
+# Empty {} placeholders, like the manifest url of a run, are filled in
+# after that.
 
 # CREATE SCHEMA
-dwh_schema_create                   = "create schema if not exists {}".format(SCHEMA)
+dwh_schema_create                   = "create schema if not exists {schema}"
 
 # DROP TABLES
 
 staging_events_table_drop            = "drop table if exists staging_events"
 staging_songs_table_drop             = "drop table if exists staging_songs"
+staging_events_keyed_drop            = "drop table if exists staging_events_keyed"
+staging_songs_keyed_drop             = "drop table if exists staging_songs_keyed"
 songplay_table_drop                  = "drop table if exists songplay"
 user_table_drop                      = "drop table if exists users"
 song_table_drop                      = "drop table if exists songs"
 artist_table_drop                    = "drop table if exists artists"
 time_table_drop                      = "drop table if exists time"
+watermark_table_drop                 = "drop table if exists etl_watermark"
 
 # CREATE TABLES
 
 staging_events_table_create= ("""
-    create table staging_events(
+    create table if not exists staging_events(
         artist                           varchar,
         auth                             varchar,
         firstName                        varchar,
@@ -49,7 +49,7 @@ staging_events_table_create= ("""
 """)
 
 staging_songs_table_create = ("""
-    create table staging_songs(
+    create table if not exists staging_songs(
         num_songs                       int,
         artist_id                       varchar,
         artist_name                     varchar,
@@ -64,7 +64,7 @@ staging_songs_table_create = ("""
 """)
 
 songplay_table_create = ("""
-    create table songplay(
+    create table if not exists songplay(
     start_time                         timestamp not null sortkey,
     user_id                            int null,
     level                              varchar,
@@ -77,7 +77,7 @@ songplay_table_create = ("""
 """)
 
 user_table_create = ("""
-    create table users(
+    create table if not exists users(
     user_id                            int not null             sortkey,
     first_name                         varchar not null,
     last_name                          varchar not null,
@@ -86,7 +86,7 @@ user_table_create = ("""
 """)
 
 song_table_create = (""" 
-    create table songs(
+    create table if not exists songs(
     song_id                           varchar not null          sortkey,
     song_title                        varchar not null,
     artist_id                         varchar not null,
@@ -96,7 +96,7 @@ song_table_create = ("""
 """)
 
 artist_table_create = ("""
-    create table artists(
+    create table if not exists artists(
     artist_id                        varchar not null           sortkey,
     artist_name                      varchar not null,
     artist_location                  varchar,
@@ -106,7 +106,7 @@ artist_table_create = ("""
 """)
 
 time_table_create = ("""
-    create table time(
+    create table if not exists time(
     start_time                      timestamp not null          sortkey,
     hour                            int not null,
     day                             int not null,
@@ -116,16 +116,200 @@ time_table_create = ("""
     ) diststyle all;
 """)
 
+# CALENDAR
+# Attributes of every hour the event logs have covered. It is kept across
+# runs and only extended with the hours of newly staged events, so the
+# time dimension derives its columns with a join instead of extracting
+# them from every event
+
+calendar_table_create = ("""
+    create table if not exists time_calendar(
+    hour_start                      timestamp not null          sortkey,
+    hour                            int not null,
+    day                             int not null,
+    week                            int not null,
+    month                           int not null,
+    year                            int not null
+    ) diststyle all;
+""")
+
+# CONTROL TABLES
+
+watermark_table_create = ("""
+    create table if not exists etl_watermark(
+    source                          varchar not null         sortkey,
+    last_key                        varchar,
+    last_modified                   timestamp,
+    last_ts                         timestamp,
+    updated_at                      timestamp not null
+    ) diststyle all;
+""")
+
+run_state_table_create = ("""
+    create table if not exists etl_run_state(
+    run_id                          varchar not null         sortkey,
+    step                            varchar not null,
+    input_hash                      varchar(64),
+    row_count                       bigint,
+    status                          varchar(10) not null,
+    completed_at                    timestamp not null
+    ) diststyle all;
+""")
+
+# one row per exported partition of a final table, see EXPORT
+export_state_table_create = ("""
+    create table if not exists etl_export_state(
+    table_name                      varchar not null         sortkey,
+    year                            int not null,
+    month                           int not null,
+    row_count                       bigint not null,
+    checksum                        bigint not null,
+    exported_at                     timestamp not null
+    ) diststyle all;
+""")
+
+# the latest run that has no 'run' completion row yet, filled in with a
+# run_state_exclude per run id prefix to skip; run ids are compared by
+# prefix with left() since their _ is a like wildcard
+run_state_open_run = ("""
+    select run_id
+    from etl_run_state
+    where left(run_id, %s) = %s{}
+    group by run_id
+    having max(case when step = 'run' then 1 else 0 end) = 0
+    order by max(completed_at) desc
+    limit 1
+""")
+
+run_state_exclude = " and left(run_id, %s) <> %s"
+
+run_state_succeeded = ("""
+    select step, input_hash
+    from etl_run_state
+    where run_id = %s and status = 'succeeded'
+""")
+
+run_state_insert = ("""
+    insert into etl_run_state
+    (run_id,step,input_hash,row_count,status,completed_at)
+    values (%s, %s, %s, %s, %s, getdate())
+""")
+
+watermark_select = ("""
+    select last_key, last_modified, last_ts
+    from etl_watermark
+    where source = %s
+""")
+
+watermark_delete = "delete from etl_watermark where source = %s"
+
+watermark_insert = ("""
+    insert into etl_watermark
+    (source,last_key,last_modified,last_ts,updated_at)
+    values (%s, %s, %s, %s, getdate())
+""")
+
+staging_events_max_ts = "select max(ts) from staging_events"
+
 # STAGING TABLES
+# Every COPY skips up to MAXERROR bad lines; what it skipped or failed on
+# is read back from stl_load_errors
 
 staging_events_copy = ("""
-    copy staging_events from '{}' iam_role '{}'
-    json '{}' timeformat as 'epochmillisecs'
-    """).format(LOG_DATA,ARN,LOG_JSONPATH)
+    copy staging_events from {log_data} iam_role {arn}
+    json {log_jsonpath} timeformat as 'epochmillisecs'
+    maxerror {maxerror}
+    """)
 
 staging_songs_copy = ("""
+    copy staging_songs from {song_data} 
+    iam_role {arn} json 'auto'
+    maxerror {maxerror}""")
+
+# Manifest variants of the COPYs: the manifest url is filled in per run,
+# followed by any compression option of the files it lists
+
+staging_events_manifest_copy = ("""
+    copy staging_events from '{}' iam_role {arn}
+    json {log_jsonpath} timeformat as 'epochmillisecs'
+    maxerror {maxerror}
+    manifest {}
+    """)
+
+staging_songs_manifest_copy = ("""
     copy staging_songs from '{}' 
-    iam_role '{}' json 'auto'""").format(SONG_DATA,ARN)
+    iam_role {arn} json 'auto'
+    maxerror {maxerror}
+    manifest {}""")
+
+# COPY of the pre-processed event logs: gzip CSV files holding a subset of
+# the columns, named in the column list filled in with the manifest url
+staging_events_projected_copy = ("""
+    copy staging_events ({}) from '{}' iam_role {arn}
+    csv gzip emptyasnull blanksasnull timeformat as 'epochmillisecs'
+    maxerror {maxerror}
+    manifest
+    """)
+
+slice_count_query = "select count(*) from stv_slices"
+
+# LOAD ERRORS
+# Errors of the COPYs that read files under a prefix since a point in
+# time, one row per rejected line
+
+db_time_select = "select getdate()"
+
+load_errors_select = ("""
+    select trim(filename), line_number, trim(colname), err_code, trim(err_reason)
+    from stl_load_errors
+    where starttime >= %s and trim(filename) like %s
+    order by trim(filename), line_number
+""")
+
+# KEYED STAGING TABLES
+# Songplays are matched to songs on a key computed once per staging row:
+# an md5 of the trimmed, lowercased artist and title and of the duration
+# rounded to MATCH_KEY_DECIMALS. Event lengths are loaded with 4 decimals
+# and song durations with 6, so comparing the raw numbers misses most
+# matches. Both projections are distributed and sorted on the key, which
+# collocates the songplay join on every slice
+
+match_key = ("""md5(lower(trim({artist})) || '|' || lower(trim({title})) || '|' ||
+            cast(cast(round({duration}, {decimals}) as numeric(12,{decimals})) as varchar))""")
+
+staging_events_keyed_create = ("""
+    create table staging_events_keyed
+    distkey(match_key) sortkey(match_key) as
+        select
+        ts, userId, level, sessionId, location, userAgent,
+        {} as match_key
+        from staging_events
+""").format(match_key.format(artist="artist", title="song", duration="length",
+    decimals="{match_key_decimals}"))
+
+staging_songs_keyed_create = ("""
+    create table staging_songs_keyed
+    distkey(match_key) sortkey(match_key) as
+        select
+        song_id, artist_id,
+        {} as match_key
+        from staging_songs
+        where song_id is not null
+""").format(match_key.format(artist="artist_name", title="title", duration="duration",
+    decimals="{match_key_decimals}"))
+
+# The songs incremental loads and retries match events against: every song
+# of the merged dimensions rather than only the song files of the run, as
+# new events mostly play songs an earlier run loaded
+known_songs_keyed_create = ("""
+    create table staging_songs_keyed
+    distkey(match_key) sortkey(match_key) as
+        select
+        s.song_id, s.artist_id,
+        {} as match_key
+        from songs s join artists a on a.artist_id = s.artist_id
+""").format(match_key.format(artist="a.artist_name", title="s.song_title", duration="s.duration",
+    decimals="{match_key_decimals}"))
 
 # FINAL TABLES
 
@@ -142,51 +326,453 @@ songplay_table_insert = ("""
         e.location,
         e.userAgent as user_agent
         from
-        staging_events e left outer join
-        staging_songs s on
-        (
-            s.artist_name = e.artist and
-            s.title       = e.song and 
-            s.duration    = e.length
-        )
-""")
-
-user_table_insert = ("""
-    insert into users
-    (user_id,first_name,last_name,gender)
-        select distinct userId,firstName,lastName,gender
-        from staging_events
-        where userId is not null
+        staging_events_keyed e left outer join
+        staging_songs_keyed s on
+        s.match_key = e.match_key
 """)
 
-song_table_insert = ("""
-    insert into songs
-    (song_id,song_title,artist_id,year,duration)
-        select distinct song_id,title, artist_id,year,duration
-        from staging_songs
-        where song_id is not null
+# DIMENSION ROWS
+# One row per business key out of the staging tables: the user as of their
+# latest event, and for songs and artists, which carry no event time, the
+# most complete record
+
+user_table_latest = ("""
+        select user_id, first_name, last_name, gender
+        from (
+            select
+            userId as user_id,
+            firstName as first_name,
+            lastName as last_name,
+            gender,
+            row_number() over (partition by userId order by ts desc) as recency
+            from staging_events
+            where userId is not null
+        ) ranked
+        where recency = 1
 """)
 
-artist_table_insert = ("""
-    insert into artists
-    (artist_id,artist_name,artist_location,artist_latitude, artist_longitude)
-        select distinct artist_id, artist_name,artist_location, 
-            artist_latitude, artist_longitude
-        from staging_songs
-        where artist_id is not null        
+song_table_latest = ("""
+        select song_id, song_title, artist_id, year, duration
+        from (
+            select
+            song_id,
+            title as song_title,
+            artist_id,
+            year,
+            duration,
+            row_number() over (partition by song_id order by year desc, duration desc) as recency
+            from staging_songs
+            where song_id is not null
+        ) ranked
+        where recency = 1
+""")
+
+artist_table_latest = ("""
+        select artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+        from (
+            select
+            artist_id,
+            artist_name,
+            artist_location,
+            cast(artist_latitude as numeric(11,8)) as artist_latitude,
+            cast(artist_longitude as numeric(11,8)) as artist_longitude,
+            row_number() over (partition by artist_id order by
+                case when artist_latitude is null then 1 else 0 end,
+                case when coalesce(artist_location, '') = '' then 1 else 0 end,
+                artist_name) as recency
+            from staging_songs
+            where artist_id is not null
+        ) ranked
+        where recency = 1
+""")
+
+# table, business key, columns and latest rows of each dimension
+dimensions = [
+    ("users", "user_id", ["user_id", "first_name", "last_name", "gender"], user_table_latest),
+    ("songs", "song_id", ["song_id", "song_title", "artist_id", "year", "duration"], song_table_latest),
+    ("artists", "artist_id", ["artist_id", "artist_name", "artist_location", "artist_latitude",
+        "artist_longitude"], artist_table_latest)
+]
+
+dimension_insert = ("""
+    insert into {table}
+    ({columns})
+        {latest}
+""")
+
+user_table_insert = dimension_insert.format(table="users",
+    columns=",".join(dimensions[0][2]), latest=user_table_latest.strip())
+song_table_insert = dimension_insert.format(table="songs",
+    columns=",".join(dimensions[1][2]), latest=song_table_latest.strip())
+artist_table_insert = dimension_insert.format(table="artists",
+    columns=",".join(dimensions[2][2]), latest=artist_table_latest.strip())
+
+calendar_table_extend = ("""
+insert into time_calendar
+(hour_start, hour, day, week, month, year)
+select
+    b.hour_start,
+    extract (hour from b.hour_start) as hour,
+    extract (day from b.hour_start) as day,
+    extract (week from b.hour_start) as week,
+    extract (month from b.hour_start) as month,
+    extract (year from b.hour_start) as year
+  from (
+    select distinct date_trunc('hour', ts) as hour_start
+    from staging_events
+    where ts is not null
+  ) b
+  where not exists (select 1 from time_calendar c where c.hour_start = b.hour_start)
 """)
 
+# distinct timestamps first, then one calendar lookup per timestamp
 time_table_insert = ("""
 insert into time
 (day, hour, month, start_time, week, year)
-select distinct 	
-    extract (day from ts) as day,
-    extract (hour from ts) as hour,
-    extract (month from ts) as month,
-    ts as start_time,
-    extract (week from ts) as week,
-    extract (year from ts) as year
-  from staging_events
+select
+    c.day, c.hour, c.month, t.start_time, c.week, c.year
+  from (
+    select distinct ts as start_time
+    from staging_events
+    where ts is not null
+  ) t
+  join time_calendar c on c.hour_start = date_trunc('hour', t.start_time)
+""")
+
+# INCREMENTAL FINAL TABLES
+# Append/merge into the existing star schema instead of reloading it.
+# songplay is guarded by the event watermark so a replayed log file is
+# not appended twice; time only receives timestamps it doesn't have yet,
+# and the other dimensions are merged (see DIMENSION MERGE)
+
+songplay_table_append = songplay_table_insert + ("""
+        where e.ts > coalesce(
+            (select last_ts from etl_watermark where source = 'log_data'),
+            '1970-01-01'::timestamp)
+""")
+
+time_table_append = time_table_insert + ("""
+  where not exists (select 1 from time x where x.start_time = t.start_time)
+""")
+
+# BACKFILL
+# A date range of the event log is loaded one year/month partition at a
+# time, each into a table of its own so the partition COPYs can run side
+# by side, then gathered into staging_events. The songplays of the range
+# are replaced and the dimensions merged.
+
+staging_events_partition_drop = "drop table if exists {}"
+staging_events_partition_create = "create table if not exists {} (like staging_events)"
+
+staging_events_partition_copy = ("""
+    copy {} from '{}' iam_role {arn}
+    json {log_jsonpath} timeformat as 'epochmillisecs'
+    maxerror {maxerror}
+    """)
+
+staging_events_partition_gather = "insert into staging_events select * from {}"
+
+songplay_range_delete = ("""
+    delete from songplay
+    where start_time >= '{}' and start_time < '{}'
+""")
+
+# DIMENSION MERGE
+# The latest staging row of each key is compared with the stored one and
+# only new or changed keys are staged in <table>_changes, then replaced
+# with a delete + insert. The work scales with the changed keys, not with
+# the size of the dimension. Nulls compare equal to each other.
+
+column_changed = "not coalesce(stored.{0} = latest.{0}, stored.{0} is null and latest.{0} is null)"
+
+dimension_changes_create = ("""
+    create temp table {table}_changes as
+        select latest.*
+        from ({latest}) latest
+        left outer join {table} stored on stored.{key} = latest.{key}
+        where stored.{key} is null or
+        {changed}
+""")
+
+dimension_merge_delete = ("""
+    delete from {table}
+    using {table}_changes
+    where {table}.{key} = {table}_changes.{key}
+""")
+
+dimension_merge_insert = ("""
+    insert into {table}
+    ({columns})
+        select {columns}
+        from {table}_changes
+""")
+
+dimension_changes_drop = "drop table if exists {table}_changes"
+
+dimension_merges = []
+for table, key, columns, latest in dimensions:
+    dimension_merges.append((table, [
+        dimension_changes_drop.format(table=table),
+        dimension_changes_create.format(table=table, key=key, latest=latest,
+            changed=" or\n        ".join(column_changed.format(c) for c in columns if c != key)),
+        dimension_merge_delete.format(table=table, key=key),
+        dimension_merge_insert.format(table=table, columns=",".join(columns)),
+        dimension_changes_drop.format(table=table)
+    ]))
+
+# SINGLE TRANSACTION LOAD
+# A full load on one session that commits once: the staging tables are
+# session-scoped temp tables, which shadow the permanent ones of the same
+# name, and the COPYs skip automatic compression analysis and statistics
+
+staging_events_temp_create = staging_events_table_create.replace("create table if not exists", "create temp table")
+staging_songs_temp_create = staging_songs_table_create.replace("create table if not exists", "create temp table")
+staging_events_keyed_temp_create = staging_events_keyed_create.replace("create table", "create temp table")
+staging_songs_keyed_temp_create = staging_songs_keyed_create.replace("create table", "create temp table")
+
+staging_events_temp_copy = staging_events_copy.rstrip() + "\n    compupdate off statupdate off"
+staging_songs_temp_copy = staging_songs_copy.rstrip() + "\n    compupdate off statupdate off"
+
+# AGGREGATES
+# Songplays pre-aggregated for dashboards: plays per hour, plays of each
+# song and artist per day, and active users per day and level. A full load
+# rebuilds them from songplay. Incremental loads, retries and backfills
+# only recompute the days of the staged events, listed in aggregate_days:
+# their rows are deleted and aggregated again, so the work follows the
+# size of the load rather than that of the fact table.
+
+songplay_hourly_create = ("""
+    create table if not exists songplay_hourly(
+    hour_start                      timestamp not null          sortkey,
+    level                           varchar,
+    plays                           bigint not null,
+    users                           bigint not null,
+    matched_plays                   bigint not null
+    ) diststyle all;
+""")
+
+song_plays_daily_create = ("""
+    create table if not exists song_plays_daily(
+    day                             timestamp not null          sortkey,
+    song_id                         varchar not null,
+    artist_id                       varchar,
+    plays                           bigint not null,
+    listeners                       bigint not null
+    ) diststyle even;
+""")
+
+artist_plays_daily_create = ("""
+    create table if not exists artist_plays_daily(
+    day                             timestamp not null          sortkey,
+    artist_id                       varchar not null,
+    plays                           bigint not null,
+    listeners                       bigint not null
+    ) diststyle even;
+""")
+
+active_users_daily_create = ("""
+    create table if not exists active_users_daily(
+    day                             timestamp not null          sortkey,
+    level                           varchar,
+    users                           bigint not null,
+    plays                           bigint not null
+    ) diststyle all;
+""")
+
+# {days} is empty for a rebuild, aggregate_days_filter for a refresh
+songplay_hourly_select = ("""
+        select date_trunc('hour', f.start_time), f.level, count(*), count(distinct f.user_id),
+        count(f.song_id)
+        from songplay f
+        where f.start_time is not null{days}
+        group by 1, 2
+""")
+
+song_plays_daily_select = ("""
+        select date_trunc('day', f.start_time), f.song_id, f.artist_id, count(*),
+        count(distinct f.user_id)
+        from songplay f
+        where f.song_id is not null{days}
+        group by 1, 2, 3
+""")
+
+artist_plays_daily_select = ("""
+        select date_trunc('day', f.start_time), f.artist_id, count(*), count(distinct f.user_id)
+        from songplay f
+        where f.artist_id is not null{days}
+        group by 1, 2
+""")
+
+active_users_daily_select = ("""
+        select date_trunc('day', f.start_time), f.level, count(distinct f.user_id), count(*)
+        from songplay f
+        where f.user_id is not null{days}
+        group by 1, 2
+""")
+
+aggregate_days_drop = "drop table if exists aggregate_days"
+
+aggregate_days_create = ("""
+    create table aggregate_days as
+        select distinct date_trunc('day', ts) as day
+        from staging_events
+        where ts is not null
+""")
+
+# the range lets the scan skip blocks by their zone maps, the list skips
+# the days in between that were not loaded
+aggregate_days_filter = ("""
+        and f.start_time >= (select min(day) from aggregate_days)
+        and f.start_time < (select max(day) from aggregate_days) + interval '1 day'
+        and date_trunc('day', f.start_time) in (select day from aggregate_days)""")
+
+aggregate_days_delete = ("""
+    delete from {table}
+    where {column} >= (select min(day) from aggregate_days)
+    and {column} < (select max(day) from aggregate_days) + interval '1 day'
+    and date_trunc('day', {column}) in (select day from aggregate_days)
+""")
+
+aggregate_insert = ("""
+    insert into {table}
+    ({columns})
+        {select}
+""")
+
+# table, time column, columns, create and select of each aggregate
+aggregates = [
+    ("songplay_hourly", "hour_start", ["hour_start", "level", "plays", "users", "matched_plays"],
+        songplay_hourly_create, songplay_hourly_select),
+    ("song_plays_daily", "day", ["day", "song_id", "artist_id", "plays", "listeners"],
+        song_plays_daily_create, song_plays_daily_select),
+    ("artist_plays_daily", "day", ["day", "artist_id", "plays", "listeners"],
+        artist_plays_daily_create, artist_plays_daily_select),
+    ("active_users_daily", "day", ["day", "level", "users", "plays"],
+        active_users_daily_create, active_users_daily_select)
+]
+
+aggregate_table_drops = dict((table, "drop table if exists {}".format(table)) for table, *_ in aggregates)
+
+aggregate_rebuilds = dict((table, aggregate_insert.format(table=table, columns=",".join(columns),
+    select=select.format(days="").strip())) for table, _, columns, _, select in aggregates)
+
+aggregate_refreshes = dict((table, [
+    aggregate_days_delete.format(table=table, column=column),
+    aggregate_insert.format(table=table, columns=",".join(columns),
+        select=select.format(days=aggregate_days_filter).strip())
+    ]) for table, column, columns, _, select in aggregates)
+
+# DATA QUALITY
+# One aggregating scan per final table after a load. Table names are
+# placeholders so the shadow tables can be checked before a publish.
+# songplay is joined to every dimension on its key; the dimensions hold
+# one row per key, so the joins don't multiply the fact rows.
+
+# row count, non-null keys and distinct keys
+dimension_quality = ("""
+    select count(*), count({key}), count(distinct {key})
+    from {table}
+""")
+
+# row count, non-null start times, matched songs and the references
+# without a dimension row, per dimension
+songplay_quality = ("""
+    select
+    count(*),
+    count(f.start_time),
+    count(f.song_id),
+    sum(case when f.user_id is not null and u.user_id is null then 1 else 0 end),
+    sum(case when f.song_id is not null and s.song_id is null then 1 else 0 end),
+    sum(case when f.artist_id is not null and a.artist_id is null then 1 else 0 end),
+    sum(case when f.start_time is not null and t.start_time is null then 1 else 0 end)
+    from {songplay} f
+    left outer join {users} u on u.user_id = f.user_id
+    left outer join {songs} s on s.song_id = f.song_id
+    left outer join {artists} a on a.artist_id = f.artist_id
+    left outer join {time} t on t.start_time = f.start_time
+""")
+
+# dimensions and their business keys, which songplay references by the same name
+quality_dimensions = [("users", "user_id"), ("songs", "song_id"), ("artists", "artist_id"),
+    ("time", "start_time")]
+
+# PUBLISH
+# Final tables can be built under shadow names and swapped in with renames
+
+star_tables = ["songplay", "users", "songs", "artists", "time"]
+final_tables = star_tables + [table for table, *_ in aggregates]
+
+shadow_table_name = "{}_shadow"
+version_table_name = "{}_v{}"
+
+table_list = "select tablename from pg_tables where schemaname = current_schema()"
+table_count = "select count(*) from {}"
+table_rename = "alter table {} rename to {}"
+table_drop = "drop table if exists {}"
+
+# EXPORT
+# The final tables are UNLOADed to Parquet for Spark and ML jobs, one
+# year/month of their time column at a time, to
+# <prefix>/<table>/year=YYYY/month=MM/ so readers discover the partitions
+# from the paths; the partition columns are left out of the files. Tables
+# without a time column are exported whole to <prefix>/<table>/. Every
+# partition is fingerprinted by its row count and a checksum of its rows,
+# and only exported again when that changed since the export recorded in
+# etl_export_state.
+
+# tables, their time column (None to export them whole) and columns
+export_tables = [
+    ("songplay", "start_time", ["start_time", "user_id", "level", "song_id", "artist_id",
+        "session_id", "location", "user_agent"]),
+    ("users", None, ["user_id", "first_name", "last_name", "gender"]),
+    ("songs", None, ["song_id", "song_title", "artist_id", "year", "duration"]),
+    ("artists", None, ["artist_id", "artist_name", "artist_location", "artist_longitude",
+        "artist_latitude"]),
+    ("time", "start_time", ["start_time", "hour", "day", "week", "month", "year"])
+] + [(table, column, columns) for table, column, columns, _, _ in aggregates]
+
+export_partition_columns = ("year", "month")
+
+# one column of the text a row is checksummed on
+export_row_column = "coalesce(cast({} as varchar), '')"
+
+export_fingerprint = ("""
+    select cast(extract(year from {column}) as int), cast(extract(month from {column}) as int),
+    count(*), sum(strtol(substring(md5({row}), 1, 7), 16))
+    from {table}
+    where {column} is not null
+    group by 1, 2
+""")
+
+export_table_fingerprint = ("""
+    select 0, 0, count(*), sum(strtol(substring(md5({row}), 1, 7), 16))
+    from {table}
+""")
+
+export_partition_select = ("""select {columns} from {table}
+    where {column} >= '{start}' and {column} < '{end}'""")
+
+export_table_select = "select {columns} from {table}"
+
+# {select} and {path} are quoted literals; cleanpath replaces the files of
+# an earlier export of the partition
+export_unload = ("""
+    unload ({select})
+    to {path} iam_role {arn}
+    format as parquet
+    manifest verbose
+    maxfilesize {max_file_mb} mb
+    cleanpath
+""")
+
+export_state_select = "select table_name, year, month, row_count, checksum from etl_export_state"
+
+export_state_delete = "delete from etl_export_state where table_name = %s and year = %s and month = %s"
+
+export_state_insert = ("""
+    insert into etl_export_state
+    (table_name,year,month,row_count,checksum,exported_at)
+    values (%s, %s, %s, %s, %s, getdate())
 """)
 
 # QUERY LISTS
@@ -194,5 +780,104 @@ select distinct
 create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
 drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
-drop_staging_queries = [staging_events_table_drop, staging_songs_table_drop]
\ No newline at end of file
+insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, calendar_table_extend, time_table_insert]
+drop_staging_queries = [staging_events_table_drop, staging_songs_table_drop, staging_events_keyed_drop, staging_songs_keyed_drop]
+key_staging_queries = [staging_events_keyed_create, staging_songs_keyed_create]
+create_control_queries = [watermark_table_create, run_state_table_create, calendar_table_create, export_state_table_create]
+staging_table_create_queries = [staging_events_table_create, staging_songs_table_create]
+final_table_create_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create] + [create for _, _, _, create, _ in aggregates]
+aggregate_refresh_queries = [aggregate_days_drop, aggregate_days_create] + [query for table, *_ in aggregates for query in aggregate_refreshes[table]] + [aggregate_days_drop]
+# the dimensions are merged first, so songplays are keyed against every known song
+incremental_key_queries = [staging_events_keyed_create]
+incremental_insert_queries = [query for _, queries in dimension_merges for query in queries] + [staging_songs_keyed_drop, known_songs_keyed_create, songplay_table_append] + [calendar_table_extend, time_table_append] + aggregate_refresh_queries
+# quarantined files were never loaded, so their songplays skip the watermark guard
+final_table_drop_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop] + list(aggregate_table_drops.values())
+retry_insert_queries = [query for _, queries in dimension_merges for query in queries] + [staging_songs_keyed_drop, known_songs_keyed_create, songplay_table_insert] + [calendar_table_extend, time_table_append] + aggregate_refresh_queries
+# (stage, queries) of the single transaction load, in order
+single_transaction_stages = [
+    ("prepare", final_table_drop_queries + final_table_create_queries + [staging_events_temp_create, staging_songs_temp_create]),
+    ("copy", [staging_events_temp_copy, staging_songs_temp_copy]),
+    ("key", [staging_events_keyed_temp_create, staging_songs_keyed_temp_create]),
+    ("insert", insert_table_queries),
+    ("aggregate", list(aggregate_rebuilds.values()))
+]
+
+# PIPELINE STEPS
+# Each step declares the tables it reads and writes. Steps are listed in
+# the order the serial pipeline runs them; the scheduler only orders two
+# steps when they touch a common table and one of them writes it, so
+# everything else may run concurrently. Each step is tagged with its
+# stage, which picks the WLM query group and statement timeout it runs with
+
+Step = namedtuple("Step", ["name", "query", "reads", "writes", "stage"], defaults=(None,))
+
+
+def staged(stage, steps):
+    '''
+    Tags a list of steps with the stage they belong to
+    '''
+    return [step._replace(stage=stage) for step in steps]
+
+
+prepare_steps = staged("prepare", [
+    Step("drop_staging_events", staging_events_table_drop, (), ("staging_events",)),
+    Step("drop_staging_songs", staging_songs_table_drop, (), ("staging_songs",)),
+    Step("drop_staging_events_keyed", staging_events_keyed_drop, (), ("staging_events_keyed",)),
+    Step("drop_staging_songs_keyed", staging_songs_keyed_drop, (), ("staging_songs_keyed",)),
+    Step("drop_songplay", songplay_table_drop, (), ("songplay",)),
+    Step("drop_users", user_table_drop, (), ("users",)),
+    Step("drop_songs", song_table_drop, (), ("songs",)),
+    Step("drop_artists", artist_table_drop, (), ("artists",)),
+    Step("drop_time", time_table_drop, (), ("time",)),
+    Step("create_staging_events", staging_events_table_create, (), ("staging_events",)),
+    Step("create_staging_songs", staging_songs_table_create, (), ("staging_songs",)),
+    Step("create_songplay", songplay_table_create, (), ("songplay",)),
+    Step("create_users", user_table_create, (), ("users",)),
+    Step("create_songs", song_table_create, (), ("songs",)),
+    Step("create_artists", artist_table_create, (), ("artists",)),
+    Step("create_time", time_table_create, (), ("time",)),
+    Step("create_time_calendar", calendar_table_create, (), ("time_calendar",))
+] + [Step("drop_" + table, aggregate_table_drops[table], (), (table,)) for table, *_ in aggregates]
+  + [Step("create_" + table, create, (), (table,)) for table, _, _, create, _ in aggregates])
+
+copy_steps = staged("copy", [
+    Step("copy_staging_events", staging_events_copy, (), ("staging_events",)),
+    Step("copy_staging_songs", staging_songs_copy, (), ("staging_songs",))
+])
+
+key_steps = staged("key", [
+    Step("key_staging_events", staging_events_keyed_create, ("staging_events",), ("staging_events_keyed",)),
+    Step("key_staging_songs", staging_songs_keyed_create, ("staging_songs",), ("staging_songs_keyed",))
+])
+
+insert_steps = staged("insert", [
+    Step("insert_songplay", songplay_table_insert, ("staging_events_keyed", "staging_songs_keyed"), ("songplay",)),
+    Step("insert_users", user_table_insert, ("staging_events",), ("users",)),
+    Step("insert_songs", song_table_insert, ("staging_songs",), ("songs",)),
+    Step("insert_artists", artist_table_insert, ("staging_songs",), ("artists",)),
+    Step("extend_time_calendar", calendar_table_extend, ("staging_events",), ("time_calendar",)),
+    Step("insert_time", time_table_insert, ("staging_events", "time_calendar"), ("time",))
+])
+
+aggregate_steps = staged("aggregate", [
+    Step("aggregate_" + table, aggregate_rebuilds[table], ("songplay",), (table,)) for table, *_ in aggregates
+])
+
+drop_staging_steps = staged("drop_staging", [
+    Step("drop_staging_events_after_load", staging_events_table_drop, (), ("staging_events",)),
+    Step("drop_staging_songs_after_load", staging_songs_table_drop, (), ("staging_songs",)),
+    Step("drop_staging_events_keyed_after_load", staging_events_keyed_drop, (), ("staging_events_keyed",)),
+    Step("drop_staging_songs_keyed_after_load", staging_songs_keyed_drop, (), ("staging_songs_keyed",))
+])
+
+full_load_steps = prepare_steps + copy_steps + key_steps + insert_steps + aggregate_steps + drop_staging_steps
+
+# Named groups of steps operators can select stages by
+stage_groups = {
+    "prepare": prepare_steps,
+    "copy": copy_steps,
+    "key": key_steps,
+    "insert": insert_steps,
+    "aggregate": aggregate_steps,
+    "drop_staging": drop_staging_steps
+}
@@ -0,0 +1,117 @@
+import configparser
+import json
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Credentials and region the AWS checks run with; moto intercepts every call
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+os.environ.setdefault("MOTO_IAM_LOAD_MANAGED_POLICIES", "true")
+
+
+def write_config(path, sections):
+    '''
+    Writes a dwh.cfg made of the given sections, dicts of option -> value
+    '''
+    config = configparser.ConfigParser()
+    for section, options in sections.items():
+        config[section] = options
+    with open(path, "w") as f:
+        config.write(f)
+    return str(path)
+
+
+def read_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+DWH = {
+    "DWH_CLUSTER_TYPE": "single-node",
+    "DWH_NUM_NODES": "1",
+    "DWH_NODE_TYPE": "dc2.large",
+    "DWH_CLUSTER_IDENTIFIER": "dwhcluster",
+    "DWH_DB": "dwh",
+    "DWH_DB_USER": "dwhuser",
+    "DWH_DB_PASSWORD": "Passw0rd1",
+    "DWH_DB_PORT": "5439",
+    "DWH_IAM_ROLE_NAME": "dwhRole",
+    "DWH_POLL_SECONDS": "0",
+    "DWH_SCHEMA": "songsdwh",
+    "DWH_S3_IAM_ARN": "arn:aws:iam::123456789012:role/dwhRole"
+}
+
+AWS = {"KEY": "testing", "SECRET": "testing", "REGION": "us-west-2"}
+
+LOG_DATA = "s3://udacity-dend/log_data"
+SONG_DATA = "s3://udacity-dend/song_data"
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    '''
+    A dwh.cfg for a single-node cluster loading the udacity-dend sources
+    '''
+    return write_config(tmp_path / "dwh.cfg", {"AWS": AWS, "DWH": DWH,
+        "S3": {"LOG_DATA": LOG_DATA, "SONG_DATA": SONG_DATA},
+        "LOCAL": {"OUT_IP": "10.0.0.1/32"}})
+
+
+@pytest.fixture
+def aws():
+    '''
+    Mocks the AWS APIs with moto, with a udacity-dend bucket holding three
+    event log files of 1000 bytes and one song file of 500 bytes
+    '''
+    moto = pytest.importorskip("moto")
+    import boto3
+    with moto.mock_aws():
+        s3 = boto3.client("s3", region_name="us-west-2")
+        s3.create_bucket(Bucket="udacity-dend",
+            CreateBucketConfiguration={"LocationConstraint": "us-west-2"})
+        for i in range(3):
+            s3.put_object(Bucket="udacity-dend", Key="log_data/{}.json".format(i), Body=b"x" * 1000)
+        s3.put_object(Bucket="udacity-dend", Key="song_data/a.json", Body=b"x" * 500)
+        yield
+
+
+def registry_config(**sections):
+    '''
+    A parsed config holding the DWH settings the query registry needs,
+    plus the given sections
+    '''
+    config = configparser.ConfigParser()
+    config["DWH"] = {"dwh_schema": DWH["DWH_SCHEMA"], "dwh_s3_iam_arn": DWH["DWH_S3_IAM_ARN"]}
+    for section, options in sections.items():
+        config[section] = options
+    return config
+
+
+@pytest.fixture
+def local_dwh(tmp_path):
+    '''
+    A DuckDB warehouse with the control and final tables created, as
+    (config, queries registry, backend, pool of one session)
+    '''
+    pytest.importorskip("duckdb")
+    from backends import local_backend
+    from db_pool import ConnectionPool
+    from query_registry import QueryRegistry
+
+    config = registry_config(LOCAL={"data_dir": str(tmp_path), "duckdb_path": str(tmp_path / "dwh.duckdb")})
+    queries = QueryRegistry(config)
+    with open(str(tmp_path / "log_json_path.json"), "w") as f:
+        json.dump({"jsonpaths": ["$['ts']"]}, f)
+    backend = local_backend(config, "duckdb", queries.schema)
+    conn, cur = backend.connect()
+    for query in queries.query("create_control_queries") + queries.query("final_table_create_queries"):
+        cur.execute(query)
+    conn.commit()
+    pool = ConnectionPool(backend.connect, 1)
+    yield config, queries, backend, pool
+    pool.closeAll()
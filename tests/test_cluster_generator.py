@@ -0,0 +1,54 @@
+import boto3
+import pytest
+
+pytest.importorskip("moto")
+
+from conftest import read_config
+from redshift_cluster_generator import RedshiftClusterGenerator, S3_READ_ONLY_POLICY
+
+
+def test_creates_the_cluster_role_and_policy(aws, config_file):
+    generator = RedshiftClusterGenerator(config_file, False, False)
+    generator.generateRedshiftCluster()
+
+    redshift = boto3.client("redshift", region_name="us-west-2")
+    cluster = redshift.describe_clusters(ClusterIdentifier="dwhcluster")["Clusters"][0]
+    assert cluster["ClusterStatus"] == "available"
+    assert cluster["NodeType"] == "dc2.large"
+
+    iam = boto3.client("iam", region_name="us-west-2")
+    policies = iam.list_attached_role_policies(RoleName="dwhRole")["AttachedPolicies"]
+    assert [p["PolicyArn"] for p in policies] == [S3_READ_ONLY_POLICY]
+
+    config = read_config(config_file)
+    assert config.get("DWH", "DWH_ENDPOINT") == cluster["Endpoint"]["Address"]
+    assert config.get("DWH", "DWH_S3_IAM_ARN").endswith(":role/dwhRole")
+    # the policy is attached while the cluster boots, and every phase is timed
+    assert {"create_role", "attach_policy", "create_cluster", "cluster_available"} \
+        <= set(generator.phaseTimings)
+
+
+def test_picks_up_a_paused_cluster(aws, config_file):
+    RedshiftClusterGenerator(config_file, False, False).generateRedshiftCluster()
+    redshift = boto3.client("redshift", region_name="us-west-2")
+    redshift.pause_cluster(ClusterIdentifier="dwhcluster")
+
+    generator = RedshiftClusterGenerator(config_file, False, False)
+    generator.generateRedshiftCluster()
+
+    clusters = redshift.describe_clusters()["Clusters"]
+    assert [c["ClusterStatus"] for c in clusters] == ["available"]
+    assert "resume_cluster" in generator.phaseTimings
+    assert "create_cluster" not in generator.phaseTimings
+
+
+def test_an_existing_role_needs_the_flag(aws, config_file):
+    boto3.client("iam", region_name="us-west-2").create_role(RoleName="dwhRole",
+        AssumeRolePolicyDocument="{}")
+
+    RedshiftClusterGenerator(config_file, False, False).generateRedshiftCluster()
+    redshift = boto3.client("redshift", region_name="us-west-2")
+    assert redshift.describe_clusters()["Clusters"] == []
+
+    RedshiftClusterGenerator(config_file, True, False).generateRedshiftCluster()
+    assert len(redshift.describe_clusters()["Clusters"]) == 1
@@ -0,0 +1,146 @@
+import boto3
+import pytest
+
+pytest.importorskip("moto")
+
+from botocore.exceptions import ClientError
+from conftest import read_config, LOG_DATA, SONG_DATA
+from cluster_sizing import recommend_size, source_volume, load_seconds, NODE_TYPES
+from redshift_cluster_generator import RedshiftClusterGenerator
+import manage_cluster
+
+
+def test_source_volume(aws):
+    volume = source_volume(boto3.client("s3", region_name="us-west-2"), [LOG_DATA, SONG_DATA])
+    assert (volume["objects"], volume["bytes"]) == (4, 3500)
+    assert volume["sources"][LOG_DATA] == {"objects": 3, "bytes": 3000}
+
+
+def test_small_volumes_get_a_single_node():
+    recommendation = recommend_size({"objects": 100, "bytes": 10 ** 8}, 600)
+    assert (recommendation["node_type"], recommendation["nodes"]) == ("dc2.large", 1)
+    assert recommendation["meets_budget"]
+
+
+def test_the_cheapest_cluster_within_the_budget():
+    volume = {"objects": 200000, "bytes": 500 * 10 ** 9}
+    recommendation = recommend_size(volume, 1800)
+    assert recommendation["meets_budget"]
+    assert recommendation["load_seconds"] <= 1800
+    nodeType = dict((t.name, t) for t in NODE_TYPES)[recommendation["node_type"]]
+    if recommendation["nodes"] > nodeType.minNodes:
+        # one node fewer would miss the budget
+        assert load_seconds(volume, nodeType, recommendation["nodes"] - 1) > 1800
+
+
+def test_the_fastest_cluster_when_none_meets_the_budget():
+    recommendation = recommend_size({"objects": 10 ** 7, "bytes": 10 ** 12}, 1)
+    assert not recommendation["meets_budget"]
+    assert recommendation["nodes"] == 128
+
+
+def test_volumes_no_cluster_holds():
+    with pytest.raises(ValueError):
+        recommend_size({"objects": 1, "bytes": 10 ** 17}, 1800)
+
+
+def test_size_apply_sets_the_deploy_settings(aws, config_file):
+    assert manage_cluster.main(["manage_cluster.py", "-c", config_file, "-a", "size"]) == 0
+    config = read_config(config_file)
+    assert config.get("DWH", "DWH_NODE_TYPE") == "dc2.large"
+    assert config.get("DWH", "DWH_NUM_NODES") == "1"
+    assert config.get("DWH", "DWH_CLUSTER_TYPE") == "single-node"
+
+
+def test_size_apply_switches_to_multi_node(aws, config_file, monkeypatch):
+    monkeypatch.setattr(manage_cluster, "recommend_size",
+        lambda volume, budget, **options: {"node_type": "ra3.4xlarge", "nodes": 4, "load_seconds": 1,
+            "meets_budget": True, "hourly_price": 1, "load_cost": 1})
+    assert manage_cluster.main(["manage_cluster.py", "-c", config_file, "-a", "size"]) == 0
+    config = read_config(config_file)
+    assert (config.get("DWH", "DWH_NUM_NODES"), config.get("DWH", "DWH_CLUSTER_TYPE")) \
+        == ("4", "multi-node")
+
+
+def cluster_status():
+    cluster = boto3.client("redshift", region_name="us-west-2").describe_clusters(
+        ClusterIdentifier="dwhcluster")["Clusters"][0]
+    return cluster["ClusterStatus"], cluster["NodeType"], cluster["NumberOfNodes"]
+
+
+def elastic_resize_unsupported(generator):
+    # moto has no resize_cluster, which exercises the classic resize fallback
+    def resize_cluster(**kwargs):
+        raise ClientError({"Error": {"Code": "UnsupportedOperation", "Message": "not elastic"}},
+            "ResizeCluster")
+    generator.redshiftClient.resize_cluster = resize_cluster
+    return generator
+
+
+def test_window_resizes_runs_and_pauses(aws, config_file, monkeypatch):
+    RedshiftClusterGenerator(config_file, False, False).generateRedshiftCluster()
+    generator = elastic_resize_unsupported(RedshiftClusterGenerator(config_file, True, True))
+    monkeypatch.setattr(manage_cluster, "recommend", lambda config, budget: {
+        "node_type": "dc2.large", "nodes": 3})
+    seen = []
+    monkeypatch.setattr(manage_cluster.subprocess, "call",
+        lambda command: seen.append(cluster_status()) or 0)
+
+    assert manage_cluster.run_window(generator, None, 30, True, False, ["etl"]) == 0
+    assert seen == [("available", "dc2.large", 3)]
+    assert cluster_status() == ("paused", "dc2.large", 1)
+
+
+def test_window_pauses_when_resizing_back_fails(aws, config_file, monkeypatch):
+    RedshiftClusterGenerator(config_file, False, False).generateRedshiftCluster()
+    generator = RedshiftClusterGenerator(config_file, True, True)
+    monkeypatch.setattr(manage_cluster, "recommend", lambda config, budget: {
+        "node_type": "dc2.large", "nodes": 3})
+    resizes = []
+
+    def resizeCluster(nodeType, numNodes):
+        resizes.append(numNodes)
+        if len(resizes) == 2:
+            raise Exception("resize failed")
+        return ("dc2.large", 1)
+    generator.resizeCluster = resizeCluster
+    monkeypatch.setattr(manage_cluster.subprocess, "call", lambda command: 0)
+
+    with pytest.raises(Exception, match="resize failed"):
+        manage_cluster.run_window(generator, None, 30, True, False, ["etl"])
+    assert resizes == [3, 1]
+    assert cluster_status()[0] == "paused"
+
+
+def test_window_pauses_when_resizing_to_the_recommendation_fails(aws, config_file, monkeypatch):
+    RedshiftClusterGenerator(config_file, False, False).generateRedshiftCluster()
+    generator = RedshiftClusterGenerator(config_file, True, True)
+    monkeypatch.setattr(manage_cluster, "recommend", lambda config, budget: {
+        "node_type": "dc2.large", "nodes": 3})
+    resizes = []
+
+    def resizeCluster(nodeType, numNodes):
+        resizes.append(numNodes)
+        raise Exception("resize failed")
+    generator.resizeCluster = resizeCluster
+    commands = []
+    monkeypatch.setattr(manage_cluster.subprocess, "call", lambda command: commands.append(command))
+
+    with pytest.raises(Exception, match="resize failed"):
+        manage_cluster.run_window(generator, None, 30, True, False, ["etl"])
+    # nothing ran and there was no size to go back to
+    assert (resizes, commands) == ([3], [])
+    assert cluster_status()[0] == "paused"
+
+
+def test_window_pauses_when_the_recommendation_fails(aws, config_file, monkeypatch):
+    RedshiftClusterGenerator(config_file, False, False).generateRedshiftCluster()
+    generator = RedshiftClusterGenerator(config_file, True, True)
+
+    def recommend(config, budget):
+        raise ValueError("no node type holds the data")
+    monkeypatch.setattr(manage_cluster, "recommend", recommend)
+
+    with pytest.raises(ValueError):
+        manage_cluster.run_window(generator, None, 30, True, False, ["etl"])
+    assert cluster_status() == ("paused", "dc2.large", 1)
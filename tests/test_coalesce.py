@@ -0,0 +1,80 @@
+import gzip
+import os
+
+from s3_manifest import DirectoryS3Client, list_objects, read_manifest
+from coalesce import chunk_count, assign_chunks, split_objects, piece_lines, coalesce_objects
+
+MB = 1024 * 1024
+
+
+def listing(sizes):
+    return [{"Bucket": "b", "Key": "k{:02d}".format(i), "Size": size} for i, size in enumerate(sizes)]
+
+
+def write_lines(root, key, lines):
+    path = os.path.join(str(root), "logs", key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"".join(lines))
+
+
+def test_chunk_count():
+    # fewer files than slices: one chunk per file rather than one for all
+    assert chunk_count(3 * MB, 3, 4, 128 * MB) == 3
+    # small input: one chunk per slice
+    assert chunk_count(10 * MB, 100, 4, 128 * MB) == 4
+    # large input: enough multiples of the slice count to keep chunks near the target
+    assert chunk_count(1000 * MB, 100, 4, 128 * MB) == 8
+    # never more chunks than files
+    assert chunk_count(1000 * MB, 9, 4, 1 * MB) == 8
+
+
+def test_assign_chunks_balances_the_sizes():
+    chunks = assign_chunks(listing([90, 10, 50, 50, 40, 60]), 3)
+    assert sorted(sum(o["Size"] for o in chunk) for chunk in chunks) == [100, 100, 100]
+    assert all([o["Key"] for o in chunk] == sorted(o["Key"] for o in chunk) for chunk in chunks)
+
+
+def test_large_objects_are_split_into_pieces():
+    pieces = split_objects(listing([250, 40]), 100)
+    assert [(o["Key"], o.get("Range")) for o in pieces] == [
+        ("k00", (0, 83)), ("k00", (83, 166)), ("k00", (166, 250)), ("k01", None)]
+
+
+def test_pieces_hold_every_line_once(tmp_path):
+    lines = [("{\"n\": %d, \"pad\": \"%s\"}\n" % (i, "x" * (i % 7))).encode("utf-8") for i in range(50)]
+    write_lines(tmp_path, "log_data/big.json", lines)
+    s3 = DirectoryS3Client(str(tmp_path))
+    pieces = split_objects(list_objects(s3, "s3://logs/log_data"), 97)
+    assert len(pieces) > 10
+
+    read = [line for piece in pieces for line in piece_lines(s3, piece)]
+    assert read == lines
+
+
+def test_coalescing_splits_a_large_file_over_the_slices(tmp_path):
+    lines = [("{\"n\": %d}\n" % i).encode("utf-8") for i in range(400)]
+    write_lines(tmp_path, "log_data/big.json", lines)
+    write_lines(tmp_path, "log_data/small.json", [b"{\"n\": -1}\n"])
+    s3 = DirectoryS3Client(str(tmp_path))
+    objects = list_objects(s3, "s3://logs/log_data")
+
+    manifestUrl, report = coalesce_objects(s3, objects, "s3://logs/chunks", 4, "gzip",
+        targetChunkBytes=1024, splitLines=True)
+
+    entries = read_manifest(s3, manifestUrl)["entries"]
+    assert len(entries) % 4 == 0
+    assert report["after"]["min_files_per_slice"] == report["after"]["max_files_per_slice"]
+    loaded = []
+    for entry in entries:
+        with open(os.path.join(str(tmp_path), "logs", entry["url"][len("s3://logs/"):]), "rb") as f:
+            loaded += gzip.decompress(f.read()).splitlines(True)
+    assert sorted(loaded) == sorted(lines + [b"{\"n\": -1}\n"])
+
+
+def test_only_newline_delimited_files_are_split(tmp_path):
+    write_lines(tmp_path, "song_data/a.json", [b"{\n", b"\"song_id\": \"S1\"\n", b"}\n"] * 100)
+    s3 = DirectoryS3Client(str(tmp_path))
+    manifestUrl, report = coalesce_objects(s3, list_objects(s3, "s3://logs/song_data"),
+        "s3://logs/chunks", 4, "gzip", targetChunkBytes=100)
+    assert len(read_manifest(s3, manifestUrl)["entries"]) == 1
@@ -0,0 +1,131 @@
+import json
+import os
+import pytest
+
+duckdb = pytest.importorskip("duckdb")
+
+from conftest import DWH, registry_config
+from query_registry import QueryRegistry
+from run_report import RunReport
+from export import export_options, s3_target, export_steps, partition_path, plan_export
+import etl
+
+SONGPLAYS = [
+    ("2018-11-01 10:00:00", "1", "free", "S1", "A1"),
+    ("2018-11-02 11:30:00", "2", "paid", None, None),
+    ("2018-12-05 08:15:00", "1", "free", "S1", "A1")
+]
+
+EXPORT = {"prefix": "s3://bucket/export"}
+
+
+@pytest.fixture
+def warehouse(local_dwh, tmp_path):
+    '''
+    The local warehouse with songplays in two months and one row per
+    dimension, exporting to a directory
+    '''
+    config, queries, backend, pool = local_dwh
+    config["EXPORT"] = dict(EXPORT, local_dir=str(tmp_path / "export"))
+    conn, cur = pair = pool.acquire()
+    for ts, user, level, song, artist in SONGPLAYS:
+        cur.execute("insert into songplay (start_time,user_id,level,song_id,artist_id,session_id,"
+            "location,user_agent) values (%s, %s, %s, %s, %s, 1, 'here', 'agent')",
+            (ts, user, level, song, artist))
+        cur.execute("insert into time (start_time,hour,day,week,month,year) values (%s, 1, 1, 1, %s, %s)",
+            (ts, int(ts[5:7]), int(ts[:4])))
+    cur.execute("insert into users values ('1', 'Ann', 'Lee', 'F')")
+    cur.execute("insert into songs values ('S1', 'Song', 'A1', 2000, 200.5)")
+    cur.execute("insert into artists values ('A1', 'Artist', 'There', null, null)")
+    conn.commit()
+    pool.release(pair)
+    return config, queries, backend, pool, str(tmp_path / "export")
+
+
+def export(warehouse):
+    config, queries, backend, pool, _ = warehouse
+    report = RunReport(copyMetrics=False)
+    etl.run_export(pool, *etl.export_target(config, queries, backend), 1, report)
+    return report.sections.get("export", {})
+
+
+def execute(warehouse, query):
+    pair = warehouse[3].acquire()
+    try:
+        pair[1].execute(query)
+        pair[0].commit()
+    finally:
+        warehouse[3].release(pair)
+
+
+def test_exports_partitioned_parquet_with_manifests(warehouse):
+    directory = warehouse[4]
+    exported = export(warehouse)
+    assert set(exported) == set([
+        partition_path(directory, "songplay", 2018, 11), partition_path(directory, "songplay", 2018, 12),
+        partition_path(directory, "time", 2018, 11), partition_path(directory, "time", 2018, 12),
+        partition_path(directory, "users", 0, 0), partition_path(directory, "songs", 0, 0),
+        partition_path(directory, "artists", 0, 0)])
+
+    rows = duckdb.sql("select year, month, count(*) from read_parquet('{}/songplay/*/*/*.parquet', "
+        "hive_partitioning=true) group by all order by all".format(directory)).fetchall()
+    assert rows == [(2018, 11, 2), (2018, 12, 1)]
+    assert duckdb.sql("select count(*) from read_parquet('{}/users/*.parquet')".format(
+        directory)).fetchall() == [(1,)]
+
+    with open(os.path.join(directory, "songplay", "manifest")) as f:
+        entries = json.load(f)["entries"]
+    assert len(entries) == 2 and all(os.path.exists(e["url"]) for e in entries)
+    with open(partition_path(directory, "songplay", 2018, 11) + "manifest") as f:
+        assert json.load(f)["meta"]["record_count"] == 2
+
+
+def test_only_changed_partitions_are_exported_again(warehouse):
+    export(warehouse)
+    assert export(warehouse) == {}
+
+    execute(warehouse, "update songplay set level = 'paid' where start_time < '2018-12-01'")
+    execute(warehouse, "update users set first_name = 'Anne'")
+    assert set(export(warehouse)) == set([partition_path(warehouse[4], "songplay", 2018, 11),
+        partition_path(warehouse[4], "users", 0, 0)])
+
+
+def test_partitions_that_left_the_table_are_removed(warehouse):
+    directory = warehouse[4]
+    export(warehouse)
+    execute(warehouse, "delete from songplay where start_time >= '2018-12-01'")
+
+    exported = export(warehouse)
+    path = partition_path(directory, "songplay", 2018, 12)
+    assert exported == {path: {"rows": 0, "status": "removed"}}
+    assert not os.path.exists(path)
+    with open(os.path.join(directory, "songplay", "manifest")) as f:
+        assert len(json.load(f)["entries"]) == 1
+
+
+def test_redshift_unloads_one_partition_per_step():
+    config = registry_config(EXPORT=EXPORT)
+    queries = QueryRegistry(config)
+    target = s3_target(None, export_options(config)["prefix"], queries.query("export_unload"))
+    steps = export_steps([("songplay", 2018, 11), ("users", 0, 0)], target, 64)
+
+    assert [step.name for step in steps] == ["export_songplay_2018_11", "export_users"]
+    assert all(step.stage == "export" for step in steps)
+    unload = " ".join(steps[0].query.split())
+    assert "to 's3://bucket/export/songplay/year=2018/month=11/'" in unload
+    assert "''2018-11-01''" in unload and "''2018-12-01''" in unload
+    assert "iam_role '{}'".format(DWH["DWH_S3_IAM_ARN"]) in unload
+    assert "format as parquet manifest verbose maxfilesize 64 mb cleanpath" in unload
+    assert "to 's3://bucket/export/users/'" in steps[1].query
+
+
+def test_plan_export():
+    current = {("songplay", 2018, 11): (2, 10), ("users", 0, 0): (1, 5)}
+    previous = {("songplay", 2018, 11): (2, 10), ("users", 0, 0): (1, 4), ("songplay", 2018, 10): (3, 1)}
+    assert plan_export(current, previous) == ([("users", 0, 0)], [("songplay", 2018, 10)])
+
+
+def test_file_size_bounds():
+    config = registry_config(EXPORT=dict(EXPORT, max_file_mb="1"))
+    with pytest.raises(ValueError):
+        export_options(config)
@@ -0,0 +1,52 @@
+import datetime
+
+import etl
+
+EVENT_COLUMNS = "artist, firstName, gender, lastName, length, level, location, page, sessionId, song, ts, userAgent, userId"
+SONG_COLUMNS = "num_songs, artist_id, artist_name, song_id, title, duration, year"
+
+
+def stage(cur, events, songs):
+    for artist, song, length, ts in events:
+        cur.execute("insert into staging_events ({}) values (%s, 'Ann', 'F', 'Lee', %s, 'free', "
+            "'here', 'NextSong', 7, %s, %s, 'agent', 1)".format(EVENT_COLUMNS), (artist, length, song, ts))
+    for artistId, artist, songId, title, duration in songs:
+        cur.execute("insert into staging_songs ({}) values (1, %s, %s, %s, %s, %s, 2000)".format(SONG_COLUMNS),
+            (artistId, artist, songId, title, duration))
+
+
+def load(conn, cur, queries, events, songs, lastKey):
+    '''
+    One incremental run: the staged events and song files of the run are
+    merged into the final tables together with the watermark
+    '''
+    etl.prepare_incremental(cur, conn, queries)
+    stage(cur, events, songs)
+    etl.insert_incremental(cur, conn, {"log_data": (lastKey, datetime.datetime(2018, 11, 2), events[-1][3])},
+        queries, None, None)
+
+
+def songplays(cur):
+    cur.execute("select start_time, song_id, artist_id from songplay order by start_time")
+    return [(str(ts), song, artist) for ts, song, artist in cur.fetchall()]
+
+
+def test_plays_match_songs_loaded_by_an_earlier_run(local_dwh):
+    _, queries, _, pool = local_dwh
+    conn, cur = pair = pool.acquire()
+    try:
+        load(conn, cur, queries, [("The Artist", "The Song", 200.5, "2018-11-01 10:00:00")],
+            [("A1", "The Artist", "S1", "The Song", 200.5)], "log_data/1.json")
+        # no song files arrive with the second run's events
+        load(conn, cur, queries, [("the artist ", "The Song", 200.5, "2018-11-02 10:00:00"),
+            ("Unknown", "Unknown", 100.0, "2018-11-02 11:00:00")], [], "log_data/2.json")
+
+        assert songplays(cur) == [
+            ("2018-11-01 10:00:00", "S1", "A1"),
+            ("2018-11-02 10:00:00", "S1", "A1"),
+            ("2018-11-02 11:00:00", None, None)
+        ]
+        # unmatched plays are kept without a song, the watermark moves past them
+        assert etl.get_watermark(cur, queries, "log_data")[0] == "log_data/2.json"
+    finally:
+        pool.release(pair)
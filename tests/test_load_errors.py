@@ -0,0 +1,88 @@
+import json
+import os
+
+from conftest import registry_config, LOG_DATA, SONG_DATA
+from s3_manifest import DirectoryS3Client, list_objects, read_manifest
+from query_registry import QueryRegistry
+from load_errors import manifest_objects, retry_manifest_url
+from run_report import RunReport
+import etl
+
+MANIFEST_PREFIX = "s3://staging/manifests"
+
+
+class LoadErrorsCursor():
+    '''
+    Answers the load errors query with the rows whose file is under the
+    prefix it is asked for, like stl_load_errors
+    '''
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, params=None):
+        self.prefix = params[1].rstrip("%")
+
+    def fetchall(self):
+        return [row for row in self.rows if row[0].startswith(self.prefix)]
+
+
+def event_logs(root, count):
+    s3 = DirectoryS3Client(str(root))
+    for i in range(count):
+        path = os.path.join(str(root), "udacity-dend", "log_data", "{}.json".format(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(json.dumps({"page": "NextSong", "ts": i, "artist": "a" * (i + 1)}) + "\n")
+    return s3, list_objects(s3, LOG_DATA)
+
+
+def full_load(**options):
+    queries = QueryRegistry(registry_config(S3={"LOG_DATA": LOG_DATA, "SONG_DATA": SONG_DATA,
+        "LOG_JSONPATH": "auto", "MANIFEST_PREFIX": MANIFEST_PREFIX}))
+    load = {"queries": queries, "sources": etl.sources(queries), "compression": None, "slices": 2,
+        "chunk_bytes": 1024 * 1024, "filter_events": False, "workers": 1, "client_spec": {}, "staged": {}}
+    load.update(options)
+    return load
+
+
+def url(obj):
+    return "s3://{}/{}".format(obj["Bucket"], obj["Key"])
+
+
+def test_quarantines_the_failing_files(tmp_path):
+    s3, objects = event_logs(tmp_path, 3)
+    load = full_load()
+    source = load["sources"][0]
+    etl.stage_manifest(s3, source, objects, "run1", load, RunReport())
+    cur = LoadErrorsCursor([(url(objects[1]), 1, "ts", 1206, "Invalid timestamp")])
+
+    report = RunReport()
+    query, remaining = etl.quarantine_copy(cur, s3, source, objects, None, "run1", load, report)
+    assert remaining == [objects[0], objects[2]]
+    assert "manifest" in query
+    retried = manifest_objects(read_manifest(s3, retry_manifest_url(MANIFEST_PREFIX, "run1", "log_data")))
+    assert [o["Key"] for o in retried] == [objects[1]["Key"]]
+    assert report.sections["load_errors"][url(objects[1])]["errors"] == 1
+
+
+def test_quarantines_the_files_of_a_failing_chunk(tmp_path):
+    s3, objects = event_logs(tmp_path, 4)
+    load = full_load(compression="gzip")
+    source = load["sources"][0]
+    etl.stage_manifest(s3, source, objects, "run1", load, RunReport())
+    chunks = load["staged"]["log_data"]
+    assert len(chunks) == 2
+
+    # stl_load_errors names the chunk the COPY read, not the source file
+    chunk = sorted(chunks)[0]
+    cur = LoadErrorsCursor([(chunk, 1, "ts", 1206, "Invalid timestamp"),
+        (url(objects[0]), 1, "ts", 1206, "an earlier load")])
+    query, remaining = etl.quarantine_copy(cur, s3, source, objects, None, "run1", load, RunReport())
+
+    failed = [url(o) for o in chunks[chunk]]
+    assert sorted(url(o) for o in remaining) == sorted(url(o) for o in objects if url(o) not in failed)
+    retried = manifest_objects(read_manifest(s3, retry_manifest_url(MANIFEST_PREFIX, "run1", "log_data")))
+    assert [url(o) for o in retried] == failed
+    # the rest is COPYed again from its own files, whose errors are matched next
+    assert "log_data" not in load["staged"]
+    assert "gzip" not in query
@@ -0,0 +1,43 @@
+import csv
+import gzip
+import io
+import json
+import os
+
+from s3_manifest import DirectoryS3Client, list_objects, read_manifest
+from preprocess import preprocess_events, PROJECTED_FIELDS
+
+EVENTS = [
+    {"page": "NextSong", "artist": "A", "song": "S", "length": 200.5, "ts": 1541105830796,
+        "userId": "1", "firstName": "Ann", "lastName": "Lee", "gender": "F", "level": "free",
+        "sessionId": 7, "location": "here", "userAgent": "agent", "method": "PUT"},
+    {"page": "Home", "artist": None, "song": None, "length": None, "ts": 1541105830800,
+        "userId": "1", "firstName": "Ann", "lastName": "Lee", "gender": "F", "level": "free",
+        "sessionId": 7, "location": "here", "userAgent": "agent", "method": "GET"}
+]
+
+
+def write_events(root, key, events):
+    path = os.path.join(root, "logs", *key.split("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("\n".join(json.dumps(e) for e in events) + "\n")
+
+
+def test_keeps_the_columns_of_every_event(tmp_path):
+    root = str(tmp_path)
+    write_events(root, "log_data/2018/11/a.json", EVENTS)
+    write_events(root, "log_data/2018/11/b.json", EVENTS[1:])
+    s3 = DirectoryS3Client(root)
+    objects = list_objects(s3, "s3://logs/log_data")
+
+    manifestUrl, report = preprocess_events({"root": root}, objects, "s3://logs/filtered", 1, workers=1)
+
+    assert (report["rows_in"], report["rows_out"], report["files_in"]) == (3, 3, 2)
+    rows = []
+    for entry in read_manifest(s3, manifestUrl)["entries"]:
+        body = s3.get_object(Bucket="logs", Key=entry["url"][len("s3://logs/"):])["Body"].read()
+        rows += list(csv.reader(io.StringIO(gzip.decompress(body).decode("utf-8"))))
+    assert all(len(row) == len(PROJECTED_FIELDS) for row in rows)
+    songs = [row[PROJECTED_FIELDS.index("song")] for row in rows]
+    assert sorted(songs) == ["", "", "S"]
@@ -0,0 +1,81 @@
+import pytest
+
+from sql_queries import final_tables, star_tables, shadow_table_name
+from publish import validate_shadows, swap_tables, rollback, existing_tables
+
+# one row for each table of the star schema, in column order
+STAR_ROWS = {
+    "songplay": ("2018-11-01 10:00:00", 1, "free", None, None, "7", "here", "agent"),
+    "users": (1, "Ann", "Lee", "F"),
+    "songs": ("S1", "Song", "A1", 2000, 200.5),
+    "artists": ("A1", "Artist", "There", None, None),
+    "time": ("2018-11-01 10:00:00", 10, 1, 44, 11, 2018)
+}
+
+
+@pytest.fixture
+def session(local_dwh):
+    pool = local_dwh[3]
+    pair = pool.acquire()
+    yield pair
+    pool.release(pair)
+
+
+def build_shadows(conn, cur, tables):
+    '''
+    Creates a shadow of every final table like the live one, holding the
+    row of STAR_ROWS for the given star schema tables
+    '''
+    for table in final_tables:
+        cur.execute("create table {} as select * from {} limit 0".format(
+            shadow_table_name.format(table), table))
+    for table in tables:
+        cur.execute("insert into {} values ({})".format(shadow_table_name.format(table),
+            ", ".join(["%s"] * len(STAR_ROWS[table]))), STAR_ROWS[table])
+    conn.commit()
+
+
+def count(cur, table):
+    cur.execute("select count(*) from {}".format(table))
+    return cur.fetchone()[0]
+
+
+def test_empty_aggregates_can_be_published(session):
+    conn, cur = session
+    build_shadows(conn, cur, star_tables)
+    counts = validate_shadows(cur)
+    assert [counts[table] for table in star_tables] == [1] * 5
+    assert counts["songplay_hourly"] == 0
+
+
+def test_empty_star_tables_are_not_published(session):
+    conn, cur = session
+    build_shadows(conn, cur, ["songplay", "users", "time"])
+    with pytest.raises(Exception, match="songs_shadow is empty, artists_shadow is empty"):
+        validate_shadows(cur)
+
+
+def test_swap_and_rollback(session):
+    conn, cur = session
+    build_shadows(conn, cur, star_tables)
+    swap_tables(cur, conn, "20181101T000000", 2)
+
+    tables = existing_tables(cur)
+    assert all(count(cur, table) == 1 for table in star_tables)
+    assert all("{}_v20181101t000000".format(table) in tables for table in final_tables)
+    assert not [table for table in tables if table.endswith("_shadow")]
+
+    restored = rollback(cur, conn)
+    assert restored["songplay"] == "songplay_v20181101t000000"
+    assert all(count(cur, table) == 0 for table in star_tables)
+    # the rolled back tables become the shadows the next publish replaces
+    assert all(count(cur, shadow_table_name.format(table)) == 1 for table in star_tables)
+
+
+def test_only_the_newest_versions_are_kept(session):
+    conn, cur = session
+    for run_id in ("20181101T000000", "20181102T000000", "20181103T000000"):
+        build_shadows(conn, cur, star_tables)
+        swap_tables(cur, conn, run_id, 2)
+    versions = sorted(table for table in existing_tables(cur) if table.startswith("songplay_v"))
+    assert versions == ["songplay_v20181102t000000", "songplay_v20181103t000000"]
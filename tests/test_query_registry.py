@@ -0,0 +1,81 @@
+import configparser
+import pytest
+
+from conftest import DWH
+from query_registry import QueryRegistry, PLACEHOLDER
+from partitions import backfill_steps
+
+
+def registry(schema=None, **options):
+    '''
+    A registry over a config file holding every setting, with options
+    given as (section, option) -> value replacing or removing (None) them
+    '''
+    sections = {
+        ("S3", "LOG_DATA"): "s3://udacity-dend/log_data",
+        ("S3", "LOG_JSONPATH"): "s3://udacity-dend/log_json_path.json",
+        ("S3", "SONG_DATA"): "s3://udacity-dend/song_data",
+        ("DWH", "dwh_s3_iam_arn"): DWH["DWH_S3_IAM_ARN"],
+        ("DWH", "dwh_schema"): "songsdwh"
+    }
+    for name, value in options.items():
+        sections[tuple(name.split("__"))] = value
+    config = configparser.ConfigParser()
+    for (section, option), value in sections.items():
+        if value is not None:
+            config.setdefault(section, {})
+            config[section][option] = value
+    return QueryRegistry(config, schema=schema)
+
+
+def test_renders_the_settings():
+    queries = registry(ETL__MAXERROR="10")
+    copy = queries.query("staging_events_copy")
+    assert "from 's3://udacity-dend/log_data' iam_role '{}'".format(DWH["DWH_S3_IAM_ARN"]) in copy
+    assert "json 's3://udacity-dend/log_json_path.json'" in copy
+    assert "maxerror 10" in copy
+    assert queries.query("dwh_schema_create") == "create schema if not exists songsdwh"
+    assert registry(schema="tenant_a").query("dwh_schema_create").endswith("tenant_a")
+
+
+def test_rejects_invalid_and_missing_values():
+    with pytest.raises(ValueError, match="dwh_schema"):
+        registry(DWH__dwh_schema="songs; drop table users")
+    with pytest.raises(ValueError, match="dwh_s3_iam_arn"):
+        registry(DWH__dwh_s3_iam_arn="arn:aws:iam::1:role/x' or 1=1").query("staging_songs_copy")
+    with pytest.raises(ValueError, match="MAXERROR"):
+        registry(ETL__MAXERROR="100001").query("staging_songs_copy")
+    with pytest.raises(ValueError, match="MATCH_KEY_DECIMALS"):
+        registry(ETL__MATCH_KEY_DECIMALS="x").query("staging_events_keyed_create")
+    with pytest.raises(ValueError, match="SONG_DATA is missing"):
+        registry(S3__SONG_DATA=None).query("staging_songs_copy")
+
+
+def test_settings_are_only_needed_by_the_statements_using_them():
+    queries = registry(S3__LOG_DATA=None, DWH__dwh_s3_iam_arn=None)
+    assert queries.query("dwh_schema_create") == "create schema if not exists songsdwh"
+
+
+def test_two_config_files_in_one_process():
+    first = registry(DWH__dwh_s3_iam_arn="arn:aws:iam::123456789012:role/a")
+    second = registry(DWH__dwh_s3_iam_arn="arn:aws:iam::123456789012:role/b",
+        S3__SONG_DATA="s3://other-bucket/song_data")
+    assert "role/a" in first.query("staging_songs_copy")
+    copy = second.query("staging_songs_copy")
+    assert "role/b" in copy and "s3://other-bucket/song_data" in copy
+    assert "role/a" not in copy
+    assert second.steps("copy") != first.steps("copy")
+    # the same settings share what was rendered
+    assert registry(DWH__dwh_s3_iam_arn="arn:aws:iam::123456789012:role/a").query(
+        "staging_songs_copy") is first.query("staging_songs_copy")
+
+
+def test_backfill_steps_are_rendered():
+    queries = registry(ETL__MATCH_KEY_DECIMALS="3")
+    steps = backfill_steps(queries, [(2018, 11), (2018, 12)])
+    assert not [step.name for step in steps if PLACEHOLDER.search(step.query)]
+    keyed = [step for step in steps if step.name == "key_staging_events"][0]
+    assert "numeric(12,3)" in keyed.query
+    replace = [step for step in steps if step.name == "replace_songplay"][0]
+    assert "start_time >= '2018-11-01' and start_time < '2019-01-01'" in replace.query
+    assert len([step for step in steps if step.name.startswith("refresh_")]) == 4
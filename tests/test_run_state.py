@@ -0,0 +1,100 @@
+import pytest
+
+from sql_queries import Step
+from run_state import RunState, input_hashes
+from validation import QualityError, THRESHOLDS
+import etl
+
+PIPELINE = [
+    Step("copy", "select 1", (), ("staging",), "copy"),
+    Step("insert", "select 2", ("staging",), ("final",), "insert")
+]
+
+NO_STAGES = {"from": None, "only": []}
+
+
+def test_a_run_failing_the_quality_checks_is_closed(local_dwh):
+    _, _, _, pool = local_dwh
+    state = RunState(pool)
+    hashes = input_hashes(PIPELINE, {})
+    run_id, steps = etl.plan_run(state, PIPELINE, hashes, NO_STAGES)
+    etl.run_steps(steps, pool, 1, run=state.runner(run_id, hashes))
+
+    # the final tables are empty, below min_rows
+    with pytest.raises(QualityError):
+        etl.close_failed(state, run_id, lambda: etl.validate_tables(pool, dict(THRESHOLDS), None))
+    assert state.openRun() is None
+    _, steps = etl.plan_run(state, PIPELINE, hashes, NO_STAGES)
+    assert [step.name for step in steps] == ["copy", "insert"]
+
+
+def run(state, pool, pipeline, hashes, stages=NO_STAGES, fail=()):
+    '''
+    Plans and runs a full load of pipeline like run_full_load, with the
+    steps named in fail raising
+
+    Returns:
+        (run id, names of the steps it ran)
+    '''
+    run_id, steps = etl.plan_run(state, pipeline, hashes, stages)
+    ran = []
+
+    def execute(cur, step):
+        ran.append(step.name)
+        if step.name in fail:
+            raise Exception("{} failed".format(step.name))
+        return None
+    try:
+        etl.run_steps(steps, pool, 1, run=state.runner(run_id, hashes, execute=execute))
+        etl.finish_forced(state, run_id)
+    except Exception:
+        pass
+    return run_id, ran
+
+
+THREE_STEPS = PIPELINE + [Step("aggregate", "select 3", ("final",), ("daily",), "aggregate")]
+
+
+def test_a_failed_run_resumes_at_its_first_unfinished_step(local_dwh):
+    state = RunState(local_dwh[3])
+    hashes = input_hashes(THREE_STEPS, {"copy": "listing"})
+    run_id, ran = run(state, local_dwh[3], THREE_STEPS, hashes, fail=("insert",))
+    assert ran == ["copy", "insert"]
+
+    resumed, ran = run(state, local_dwh[3], THREE_STEPS, hashes)
+    assert (resumed, ran) == (run_id, ["insert", "aggregate"])
+
+
+def test_changed_inputs_start_the_run_over(local_dwh):
+    state = RunState(local_dwh[3])
+    run(state, local_dwh[3], THREE_STEPS, input_hashes(THREE_STEPS, {"copy": "listing"}), fail=("insert",))
+
+    # a new file under the COPY's prefix changes the hash of every step after it
+    hashes = input_hashes(THREE_STEPS, {"copy": "listing with a new file"})
+    _, ran = run(state, local_dwh[3], THREE_STEPS, hashes)
+    assert ran == ["copy", "insert", "aggregate"]
+
+
+def test_forced_steps_without_an_unfinished_run(local_dwh):
+    state = RunState(local_dwh[3])
+    hashes = input_hashes(THREE_STEPS, {})
+    only = {"from": None, "only": ["insert", "aggregate"]}
+
+    run_id, ran = run(state, local_dwh[3], THREE_STEPS, hashes, only, fail=("aggregate",))
+    assert run_id.startswith(etl.FORCED_RUN_PREFIX) and ran == ["insert", "aggregate"]
+    # a plain run doesn't resume the forced one
+    assert state.openRun(exclude=("backfill_", etl.FORCED_RUN_PREFIX)) is None
+
+    # forcing again retries only the forced step that failed, then closes the run
+    retried, ran = run(state, local_dwh[3], THREE_STEPS, hashes, only)
+    assert (retried, ran) == (run_id, ["aggregate"])
+    assert state.openRun() is None
+
+
+def test_forced_steps_join_an_unfinished_run(local_dwh):
+    state = RunState(local_dwh[3])
+    hashes = input_hashes(THREE_STEPS, {})
+    run_id, _ = run(state, local_dwh[3], THREE_STEPS, hashes, fail=("aggregate",))
+
+    forced, ran = run(state, local_dwh[3], THREE_STEPS, hashes, {"from": "insert", "only": []})
+    assert (forced, ran) == (run_id, ["insert", "aggregate"])
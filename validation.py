@@ -0,0 +1,169 @@
+import configparser
+import getopt
+import sys
+from sql_queries import dimension_quality, songplay_quality, quality_dimensions
+from sql_queries import final_tables, shadow_table_name
+from query_registry import QueryRegistry
+
+# Limits a loaded star schema has to stay within; override any of them in
+# the VALIDATION section of the config file
+THRESHOLDS = {
+    "min_rows": 1,
+    "max_key_null_rate": 0.0,
+    "max_duplicate_keys": 0,
+    "min_match_rate": 0.0,
+    "max_orphan_rate": 0.0
+}
+
+
+def quality_thresholds(config):
+    '''
+    Reads the thresholds from the VALIDATION section of the config file
+
+    Returns:
+        dict of threshold -> value, or None when validation is disabled
+    '''
+    if not config.getboolean("VALIDATION","enabled", fallback=True):
+        return None
+    return dict((name, config.getfloat("VALIDATION", name, fallback=default))
+        for name, default in THRESHOLDS.items())
+
+
+def rate(part, whole):
+    return round(part / float(whole), 6) if whole else 0.0
+
+
+def measure(cur, shadow=False):
+    '''
+    Computes the quality metrics of the final tables with one query per
+    table: row counts, null and duplicate business keys, the songplay
+    match rate and the songplays referencing a missing dimension row
+
+    Args:
+        shadow: boolean
+            measure the shadow tables a publishing run built
+    Returns:
+        dict of table -> metric -> value
+    '''
+    names = dict((t, shadow_table_name.format(t) if shadow else t) for t in final_tables)
+    metrics = {}
+    for table, key in quality_dimensions:
+        cur.execute(dimension_quality.format(table=names[table], key=key))
+        rows, keys, distinct = cur.fetchone()
+        metrics[table] = {"rows": rows, "key_null_rate": rate(rows - keys, rows),
+            "duplicate_keys": keys - distinct}
+
+    cur.execute(songplay_quality.format(**names))
+    rows, startTimes, matched, *orphans = cur.fetchone()
+    metrics["songplay"] = {"rows": rows, "key_null_rate": rate(rows - startTimes, rows),
+        "match_rate": rate(matched, rows)}
+    for (table, key), orphaned in zip(quality_dimensions, orphans):
+        metrics["songplay"]["orphan_rate_" + table] = rate(orphaned or 0, rows)
+    return metrics
+
+
+def breaches(metrics, thresholds):
+    '''
+    Compares metrics with thresholds
+
+    Returns:
+        list of str describing each metric out of bounds
+    '''
+    found = []
+
+    def check(table, metric, breached, limit):
+        if breached:
+            found.append("{}.{} is {} (limit {})".format(table, metric, metrics[table][metric], limit))
+
+    for table, values in sorted(metrics.items()):
+        check(table, "rows", values["rows"] < thresholds["min_rows"], thresholds["min_rows"])
+        check(table, "key_null_rate", values["key_null_rate"] > thresholds["max_key_null_rate"],
+            thresholds["max_key_null_rate"])
+        if "duplicate_keys" in values:
+            check(table, "duplicate_keys", values["duplicate_keys"] > thresholds["max_duplicate_keys"],
+                thresholds["max_duplicate_keys"])
+        if "match_rate" in values:
+            check(table, "match_rate", values["match_rate"] < thresholds["min_match_rate"],
+                thresholds["min_match_rate"])
+        for metric in sorted(m for m in values if m.startswith("orphan_rate_")):
+            check(table, metric, values[metric] > thresholds["max_orphan_rate"],
+                thresholds["max_orphan_rate"])
+    return found
+
+
+class QualityError(Exception):
+    '''
+    Raised when the loaded tables breach a data quality threshold
+    '''
+
+
+def check_quality(cur, thresholds, report=None, shadow=False):
+    '''
+    Validates the final tables (or their shadows) and records the metrics
+    and any breaches in the report's "validation" section. Runs on the
+    caller's transaction, so a load can be checked before it commits.
+
+    Raises:
+        QualityError listing the breached thresholds
+    '''
+    metrics = measure(cur, shadow)
+    found = breaches(metrics, thresholds)
+    if report is not None:
+        for table, values in metrics.items():
+            report.addSection("validation", table, values)
+        report.addSection("validation", "breaches", found)
+    print("Validated {}".format(", ".join("{} ({} rows)".format(t, m["rows"])
+        for t, m in sorted(metrics.items()))))
+    if found:
+        raise QualityError("Data quality checks failed: " + "; ".join(found))
+    return metrics
+
+
+def usage(program_name):
+    print(('{} {} {}').format(program_name, '[-c <config file>]', '[-s]'))
+    print("checks the final tables against the thresholds in the VALIDATION section")
+    print("use the -s flag to check the shadow tables of a publishing run instead")
+
+
+def main(argv):
+    config_file = "dwh.cfg"
+    shadow = False
+
+    try:
+        program_name = argv[0]
+        opts, _ = getopt.getopt(argv[1:], "c:s")
+        for k, v in opts:
+            if k == '-c':
+                config_file = v
+            if k == '-s':
+                shadow = True
+    except getopt.GetoptError as e:
+        print(e)
+        usage(program_name)
+        return 2
+
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    import psycopg2
+    try:
+        conn = psycopg2.connect(host=config.get("DWH","dwh_endpoint"),
+            dbname=config.get("DWH","dwh_db"), user=config.get("DWH","dwh_db_user"),
+            password=config.get("DWH","dwh_db_password"), port=config.get("DWH","dwh_db_port"))
+        try:
+            cur = conn.cursor()
+            cur.execute("set search_path to " + QueryRegistry(config).schema)
+            metrics = check_quality(cur, quality_thresholds(config) or THRESHOLDS, shadow=shadow)
+        finally:
+            conn.close()
+    except Exception as e:
+        print(e)
+        return 1
+
+    for table, values in sorted(metrics.items()):
+        print("{:<10} {}".format(table, ", ".join("{} {}".format(k, v) for k, v in sorted(values.items()))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))